@@ -0,0 +1,37 @@
+import asyncio
+import sys
+
+from pymongo import UpdateOne
+
+from server import client, db, ensure_indexes, materialize_deal_window
+
+async def backfill_deal_windows(fix):
+    await ensure_indexes()
+
+    projection = {"id": 1, "special_offer_start": 1, "special_offer_end": 1, "offer_expires_at": 1, "deal_starts_at": 1, "deal_ends_at": 1}
+    checked = 0
+    ops = []
+    async for p in db.products.find({}, projection):
+        checked += 1
+        window = materialize_deal_window(dict(p))
+        stored = (p.get('deal_starts_at'), p.get('deal_ends_at'))
+        # Mongo hands back naive UTC datetimes, compare on the UTC wall clock
+        expected = tuple(d.replace(tzinfo=None) if d else None for d in (window['deal_starts_at'], window['deal_ends_at']))
+        if 'deal_ends_at' not in p or stored != expected:
+            ops.append(UpdateOne({"_id": p['_id']}, {"$set": {
+                "deal_starts_at": window['deal_starts_at'],
+                "deal_ends_at": window['deal_ends_at'],
+            }}))
+
+    print(f"Products: checked {checked}, {len(ops)} missing or stale deal windows")
+    if fix:
+        for i in range(0, len(ops), 1000):
+            await db.products.bulk_write(ops[i:i + 1000], ordered=False)
+        if ops:
+            print("  Deal windows written")
+    else:
+        print("Dry run only. Re-run with --fix to write deal windows")
+    client.close()
+
+if __name__ == "__main__":
+    asyncio.run(backfill_deal_windows(fix="--fix" in sys.argv))
@@ -0,0 +1,24 @@
+import asyncio
+import sys
+
+from server import backfill_login_keys, client, ensure_login_key_indexes
+
+async def migrate_login_keys(fix):
+    report = await backfill_login_keys(fix=fix)
+
+    for name, result in report.items():
+        print(f"{name}: checked {result['checked']}, {result['missing']} missing or stale login keys")
+        for field, duplicates in result['duplicates'].items():
+            for key, ids in list(duplicates.items())[:10]:
+                print(f"  Duplicate {field} {key}: {', '.join(ids)}")
+
+    if fix:
+        # Unique indexes only build once duplicates have been merged by hand
+        await ensure_login_key_indexes()
+        print("Login keys written and indexes ensured")
+    else:
+        print("Dry run only. Re-run with --fix to write login keys")
+    client.close()
+
+if __name__ == "__main__":
+    asyncio.run(migrate_login_keys(fix="--fix" in sys.argv))
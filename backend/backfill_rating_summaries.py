@@ -0,0 +1,25 @@
+import asyncio
+import sys
+
+from server import client, ensure_indexes, reconcile_rating_summaries, reconcile_vendor_stats
+
+def print_report(label, report, fix):
+    print(f"{label}: checked {report['checked']}, {report['drifted']} drifted")
+    if report['drifted_ids']:
+        print("  Sample drifted ids:", ", ".join(report['drifted_ids'][:10]))
+    if fix and report['drifted']:
+        print("  Rewritten from source collections")
+
+async def backfill_rating_summaries(fix):
+    await ensure_indexes()
+
+    # Vendor rollups are derived from product summaries, so products go first
+    print_report("Product rating summaries", await reconcile_rating_summaries(fix=fix), fix)
+    print_report("Vendor stats", await reconcile_vendor_stats(fix=fix), fix)
+
+    if not fix:
+        print("Dry run only. Re-run with --fix to write summaries")
+    client.close()
+
+if __name__ == "__main__":
+    asyncio.run(backfill_rating_summaries(fix="--fix" in sys.argv))
@@ -0,0 +1,87 @@
+import argparse
+import random
+import sys
+import time
+from datetime import datetime, timezone, timedelta
+
+from server import BULK_PRICING_MIN_PRODUCTS, sync_product_price, bulk_sync_product_prices
+
+PRICE_FIELDS = ["price", "originalPrice", "discount", "is_special_active"]
+
+def iso(dt):
+    return dt.isoformat().replace('+00:00', 'Z')
+
+def make_products(n, seed=7):
+    """Synthetic catalog covering every pricing branch"""
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    products = []
+    for i in range(n):
+        p = {
+            "id": f"bench-{i}",
+            "base_price": rng.choice([0, round(rng.uniform(1, 5000), 2), rng.randint(1, 99999)]),
+            "originalPrice": round(rng.uniform(1, 5000), 2),
+            "normal_discount_type": rng.choice(["percentage", "fixed"]),
+            "normal_discount_value": rng.choice([0, 5, 12.5, 33.33, rng.uniform(0, 60)]),
+            "special_offer_enabled": rng.random() < 0.5,
+            "special_offer_type": rng.choice(["percentage", "fixed"]),
+            "special_offer_value": rng.choice([10, 25, 49.99, rng.uniform(0, 80)]),
+        }
+        # Offer windows stay well clear of "now" so both paths agree on it
+        if rng.random() < 0.6:
+            p["special_offer_start"] = iso(now + timedelta(days=rng.choice([-3, -1, 2])))
+        if rng.random() < 0.6:
+            p["special_offer_end"] = iso(now + timedelta(days=rng.choice([-2, 1, 5])))
+        if rng.random() < 0.2:
+            p["offer_expires_at"] = rng.choice([iso(now + timedelta(days=rng.choice([-1, 3]))), "not-a-date"])
+        products.append(p)
+    return products
+
+def raw(value):
+    # Type and repr, so int vs float and 0.0 vs -0.0 both count as differences
+    return type(value), repr(value)
+
+def best_time(fn, repeats):
+    """Best of several timed runs, after one untimed warm-up run."""
+    fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def main(sizes, repeats):
+    ok = True
+    for n in sizes:
+        products = make_products(n)
+
+        scalar = [sync_product_price(dict(p)) for p in products]
+        bulk = bulk_sync_product_prices([dict(p) for p in products])
+        mismatches = [
+            (s['id'], field, s[field], b[field])
+            for s, b in zip(scalar, bulk)
+            for field in PRICE_FIELDS
+            if raw(s[field]) != raw(b[field])
+        ]
+
+        scalar_time = best_time(lambda: [sync_product_price(dict(p)) for p in products], repeats)
+        bulk_time = best_time(lambda: bulk_sync_product_prices([dict(p) for p in products]), repeats)
+
+        path = "vectorized" if n >= BULK_PRICING_MIN_PRODUCTS else "scalar fallback"
+        print(f"{n} products, best of {repeats} after warm-up")
+        print(f"  scalar sync_product_price: {scalar_time * 1000:8.3f} ms")
+        print(f"  bulk_sync_product_prices:  {bulk_time * 1000:8.3f} ms  ({scalar_time / bulk_time:.1f}x, {path})")
+        if mismatches:
+            print(f"  {len(mismatches)} mismatches, first: {mismatches[:5]}")
+            ok = False
+        else:
+            print("  Results identical")
+    return ok
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares bulk_sync_product_prices with sync_product_price.")
+    parser.add_argument("sizes", type=int, nargs="*", default=[20, 1000, 10000])
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+    sys.exit(0 if main(args.sizes, args.repeats) else 1)
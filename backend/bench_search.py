@@ -0,0 +1,69 @@
+import random
+import statistics
+import sys
+import time
+
+from server import SearchIndex
+
+BRANDS = ["Apple", "Samsung", "Sony", "Nike", "Adidas", "Puma", "Lenovo", "Dell", "Boat", "Philips",
+          "Prestige", "Milton", "Tata", "Amul", "Levis", "Zara", "Canon", "Nikon", "Bosch", "Havells"]
+NOUNS = ["phone", "laptop", "headphones", "speaker", "shoes", "shirt", "jeans", "watch", "camera", "bottle",
+         "kettle", "mixer", "charger", "cable", "backpack", "jacket", "tablet", "monitor", "keyboard", "mouse",
+         "lamp", "fan", "iron", "cooker", "tshirt", "sandals", "sneakers", "earbuds", "router", "printer"]
+ADJECTIVES = ["wireless", "smart", "cotton", "stainless", "portable", "gaming", "running", "leather", "bluetooth",
+              "ultra", "slim", "pro", "mini", "classic", "sports", "premium", "waterproof", "foldable", "digital", "organic"]
+CATEGORIES = {
+    "electronics": ["mobiles", "audio", "computers", "cameras"],
+    "fashion": ["men", "women", "footwear"],
+    "home": ["kitchen", "lighting", "appliances"],
+}
+QUERIES = ["wireless headphones", "phone", "smart watch", "cotton shirt", "gaming laptop", "apple",
+           "running shoes", "stainless bottle", "bluetooth speaker", "sam", "portable charger cable", "zz nothing"]
+
+def make_products(n, seed=11):
+    rng = random.Random(seed)
+    products = []
+    for i in range(n):
+        category = rng.choice(list(CATEGORIES))
+        words = rng.sample(ADJECTIVES, 2) + [rng.choice(NOUNS)]
+        products.append({
+            "id": f"bench-{i}",
+            "name": f"{rng.choice(BRANDS)} {' '.join(words).title()} {rng.randint(1, 999)}",
+            "brand": rng.choice(BRANDS),
+            "search_tags": rng.sample(ADJECTIVES + NOUNS, 3),
+            "category": category,
+            "sub_category": rng.choice(CATEGORIES[category]),
+        })
+    return products
+
+def main(n):
+    products = make_products(n)
+    index = SearchIndex()
+
+    start = time.perf_counter()
+    for p in products:
+        index.upsert(p)
+    build_time = time.perf_counter() - start
+    print(f"Indexed {len(index)} products in {build_time:.2f} s")
+
+    worst = 0.0
+    for q in QUERIES:
+        timings = []
+        for _ in range(20):
+            start = time.perf_counter()
+            total, hits = index.search(q, limit=20)
+            timings.append((time.perf_counter() - start) * 1000)
+        p50 = statistics.median(timings)
+        p95 = sorted(timings)[int(len(timings) * 0.95) - 1]
+        worst = max(worst, p95)
+        print(f"  {q!r:28} {total:7d} matches  p50 {p50:6.2f} ms  p95 {p95:6.2f} ms")
+
+    # Incremental update cost
+    start = time.perf_counter()
+    for p in products[:1000]:
+        index.upsert(dict(p, name=p['name'] + " Edition"))
+    print(f"Re-indexed 1000 products in {(time.perf_counter() - start) * 1000:.1f} ms")
+    print(f"Worst p95 {worst:.2f} ms")
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
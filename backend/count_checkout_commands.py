@@ -0,0 +1,91 @@
+"""
+Checks that checkout issues the same number of database commands whatever
+the cart size. Runs checkout directly against a scratch database on
+MONGO_URL, counting commands with a pymongo command listener.
+
+    python count_checkout_commands.py --lines 1 5 30
+
+The scratch database (<DB_NAME>_checkout_check) is dropped afterwards.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import uuid
+from collections import Counter
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import monitoring
+
+import server
+
+IGNORED = {"endSessions", "hello", "isMaster", "ismaster", "ping"}
+
+class CommandCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.commands = Counter()
+
+    def started(self, event):
+        if event.command_name not in IGNORED:
+            self.commands[event.command_name] += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+def order_for(lines, vendors=3):
+    items = [server.OrderItem(
+        product_id=f"check-{i}",
+        name=f"Check product {i}",
+        price=100.0,
+        quantity=1 + i % 3,
+        image="",
+        vendor_id=f"vendor-{i % vendors}"
+    ) for i in range(lines)]
+    return server.OrderCreate(
+        customer_name="Checkout Check",
+        email="check@example.com",
+        address="1 Test Street",
+        items=items,
+        total_amount=sum(item.price * item.quantity for item in items)
+    )
+
+async def count_checkout_commands(line_counts):
+    counter = CommandCounter()
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'], event_listeners=[counter])
+    scratch = client[f"{os.environ['DB_NAME']}_checkout_check"]
+    server.client, server.db = client, scratch
+
+    user = {"id": str(uuid.uuid4()), "user_type": "user"}
+    await scratch.products.insert_many([
+        {"id": f"check-{i}", "status": "approved", "sales_count": 0, "stock": 1000} for i in range(max(line_counts))
+    ])
+
+    results = {}
+    try:
+        for lines in line_counts:
+            counter.commands.clear()
+            await server.place_order(order_for(lines), user)
+            results[lines] = dict(counter.commands)
+            total = sum(counter.commands.values())
+            print(f"{lines:>4} lines: {total} commands {results[lines]}")
+
+        sold = await scratch.products.find_one({"id": "check-0"})
+        expected = len(line_counts)
+        print(f"sales_count for check-0 after {expected} orders: {sold['sales_count']}")
+        ok = sold['sales_count'] == expected and len({sum(c.values()) for c in results.values()}) == 1
+    finally:
+        await client.drop_database(scratch.name)
+        client.close()
+
+    print("Transactions:", server.checkout_transactions.metrics())
+    print("OK: constant command count" if ok else "FAIL: command count grows with the cart")
+    return ok
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lines", type=int, nargs="+", default=[1, 5, 30])
+    args = parser.parse_args()
+    sys.exit(0 if asyncio.run(count_checkout_commands(args.lines)) else 1)
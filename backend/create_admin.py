@@ -7,6 +7,8 @@ from pathlib import Path
 import datetime
 import uuid
 
+from server import normalize_email, with_login_keys
+
 # Load environment variables
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -30,10 +32,12 @@ async def create_admin():
     admin_password = "admin_password"
     
     # Check if admin already exists in users (admin stored in users collection with user_type='admin')
-    existing_admin = await db.users.find_one({"email": admin_email})
+    existing_admin = await db.users.find_one({"$or": [{"email_lc": normalize_email(admin_email)}, {"email": admin_email}]})
     
     if existing_admin:
         print(f"Admin user {admin_email} already exists.")
+        # Logins look accounts up by their login keys
+        await db.users.update_one({"_id": existing_admin['_id']}, {"$set": with_login_keys({"email": existing_admin.get('email', admin_email)})})
         
         # Optional: Update password if needed
         # new_hash = get_password_hash(admin_password)
@@ -42,7 +46,7 @@ async def create_admin():
         
     else:
         print(f"Creating new admin user: {admin_email}")
-        new_admin = {
+        new_admin = with_login_keys({
             "id": str(uuid.uuid4()),
             "name": "Super Admin",
             "email": admin_email,
@@ -53,7 +57,7 @@ async def create_admin():
             "token_version": 1,
             "created_at": datetime.datetime.utcnow().isoformat(),
             "avatar": "https://api.dicebear.com/7.x/avataaars/svg?seed=Admin"
-        }
+        })
         
         result = await db.users.insert_one(new_admin)
         print(f"Admin created with ID: {result.inserted_id}")
@@ -0,0 +1,83 @@
+"""
+Coupon limit check: fires concurrent checkouts that all apply one coupon
+with a usage limit and verifies that no more orders than the limit get it.
+Runs checkout directly against a scratch database on MONGO_URL, which is
+dropped afterwards.
+
+    python load_test_coupons.py --limit 10 --checkouts 300
+
+With --stock below --limit, orders that fail on stock must give their
+coupon use back, so usage ends equal to the orders written.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+import uuid
+from collections import Counter
+
+from fastapi import HTTPException
+from motor.motor_asyncio import AsyncIOMotorClient
+
+import server
+
+SKU = "coupon-check-sku"
+CODE = "LOADTEST10"
+
+def order():
+    item = server.OrderItem(
+        product_id=SKU, name="Coupon check", price=499.0, quantity=1, image="", vendor_id="vendor-coupon"
+    )
+    return server.OrderCreate(
+        customer_name="Load Test", email="load@example.com", address="1 Test Street",
+        items=[item], total_amount=item.price, coupon_code=CODE
+    )
+
+async def attempt():
+    user = {"id": str(uuid.uuid4()), "user_type": "user"}
+    try:
+        await server.place_order(order(), user)
+        return "ok"
+    except HTTPException as e:
+        return f"{e.status_code} {e.detail}"
+
+async def run(limit, checkouts, stock):
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'], maxPoolSize=200)
+    scratch = client[f"{os.environ['DB_NAME']}_coupon_check"]
+    server.client, server.db = client, scratch
+
+    try:
+        await server.stock_reservations.setup()
+        await scratch.products.insert_one({"id": SKU, "name": "Coupon check", "price": 499.0, "status": "approved", "stock": stock, "sales_count": 0})
+        await scratch.coupons.insert_one(server.Coupon(
+            vendor_id="vendor-coupon", code=CODE, discount="10%", limit=limit, expires="2999-12-31"
+        ).model_dump())
+
+        start = time.perf_counter()
+        results = Counter(await asyncio.gather(*(attempt() for _ in range(checkouts))))
+        elapsed = time.perf_counter() - start
+
+        coupon = await scratch.coupons.find_one({"code": CODE})
+        orders = await scratch.orders.count_documents({"coupon_code": CODE})
+        expected = min(limit, stock, checkouts)
+        print(f"{checkouts} concurrent checkouts with a coupon limited to {limit}, stock {stock}, in {elapsed:.2f}s")
+        print(f"  Outcomes: {dict(results)}")
+        print(f"  Orders with the coupon: {orders}, coupon usage: {coupon['usage']}")
+        print(f"  Coupons: {server.coupon_stats}")
+
+        ok = results["ok"] == expected and orders == expected and coupon['usage'] == expected
+    finally:
+        await client.drop_database(scratch.name)
+        client.close()
+
+    print("OK: coupon limit held" if ok else "FAIL: coupon usage and orders disagree")
+    return ok
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--checkouts", type=int, default=300)
+    parser.add_argument("--stock", type=int, default=1000)
+    args = parser.parse_args()
+    sys.exit(0 if asyncio.run(run(args.limit, args.checkouts, args.stock)) else 1)
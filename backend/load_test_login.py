@@ -0,0 +1,124 @@
+"""
+Login burst load test: measures catalog latency before and during a burst of
+password logins against a running server.
+
+    python load_test_login.py --base-url http://localhost:8000 \\
+        --identifier user@example.com --password secret --rate 50 --duration 10
+
+Logins from one address are limited per minute, so a burst from a single
+machine mostly gets 429 without reaching bcrypt. --mode signup exercises the
+same hashing path through throwaway signups instead.
+"""
+import argparse
+import statistics
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+def sample_catalog(base_url, stop, latencies, interval=0.05):
+    session = requests.Session()
+    while not stop.is_set():
+        start = time.perf_counter()
+        try:
+            session.get(f"{base_url}/api/products", params={"limit": 20}, timeout=30)
+            latencies.append((time.perf_counter() - start) * 1000)
+        except requests.RequestException:
+            pass
+        time.sleep(interval)
+
+def measure_catalog(base_url, seconds):
+    stop = threading.Event()
+    latencies = []
+    thread = threading.Thread(target=sample_catalog, args=(base_url, stop, latencies))
+    thread.start()
+    time.sleep(seconds)
+    stop.set()
+    thread.join()
+    return latencies
+
+def auth_request(args):
+    if args.mode == "signup":
+        tag = uuid.uuid4().hex[:12]
+        return requests.post(f"{args.base_url}/api/users/signup", json={
+            "name": "Load Test",
+            "email": f"loadtest+{tag}@example.com",
+            "phone": f"9{int(tag, 16) % 10**9:09d}",
+            "password": "load-test-password",
+            "user_type": "user"
+        }, timeout=60)
+    return requests.post(f"{args.base_url}/api/users/login", json={
+        "identifier": args.identifier,
+        "password": args.password,
+        "user_type": args.user_type
+    }, timeout=60)
+
+def report(label, latencies):
+    print(f"  {label:8} n={len(latencies):4d}  p50 {percentile(latencies, 0.5):7.1f} ms  "
+          f"p95 {percentile(latencies, 0.95):7.1f} ms  p99 {percentile(latencies, 0.99):7.1f} ms")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--mode", choices=["login", "signup"], default="login")
+    parser.add_argument("--identifier", default="user@example.com")
+    parser.add_argument("--password", default="password")
+    parser.add_argument("--user-type", default="user")
+    parser.add_argument("--rate", type=float, default=50, help="auth requests per second")
+    parser.add_argument("--duration", type=float, default=10, help="burst length in seconds")
+    args = parser.parse_args()
+
+    print(f"Baseline catalog latency ({args.duration:.0f}s)")
+    baseline = measure_catalog(args.base_url, args.duration)
+    report("catalog", baseline)
+
+    print(f"Catalog latency during {args.rate:.0f} {args.mode}s/s for {args.duration:.0f}s")
+    stop = threading.Event()
+    during = []
+    sampler = threading.Thread(target=sample_catalog, args=(args.base_url, stop, during))
+    sampler.start()
+
+    statuses = Counter()
+    auth_latencies = []
+
+    def one():
+        start = time.perf_counter()
+        try:
+            response = auth_request(args)
+            statuses[response.status_code] += 1
+        except requests.RequestException:
+            statuses["error"] += 1
+        auth_latencies.append((time.perf_counter() - start) * 1000)
+
+    total = int(args.rate * args.duration)
+    with ThreadPoolExecutor(max_workers=max(8, int(args.rate * 2))) as pool:
+        started = time.perf_counter()
+        for i in range(total):
+            # Open-loop arrivals: fire on schedule regardless of responses
+            delay = started + i / args.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(one)
+    stop.set()
+    sampler.join()
+
+    report("catalog", during)
+    report(args.mode, auth_latencies)
+    print(f"  {args.mode} statuses: {dict(statuses)}")
+    if statuses.get(429, 0) > total // 2:
+        print("  Most logins were rate limited before hashing; re-run with --mode signup")
+    if baseline and during:
+        drift = statistics.median(during) / max(statistics.median(baseline), 0.001)
+        print(f"  Catalog p50 during burst is {drift:.2f}x baseline")
+
+if __name__ == "__main__":
+    main()
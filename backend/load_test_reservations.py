@@ -0,0 +1,91 @@
+"""
+Oversell check: fires concurrent checkouts at one SKU with limited stock and
+verifies that exactly that many succeed. Runs checkout directly against a
+scratch database on MONGO_URL, which is dropped afterwards.
+
+    python load_test_reservations.py --stock 10 --checkouts 300
+
+--expire also holds stock through /orders/reserve with a short TTL, sweeps,
+and checks that the stock comes back.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+import uuid
+from collections import Counter
+
+from fastapi import HTTPException
+from motor.motor_asyncio import AsyncIOMotorClient
+
+import server
+
+SKU = "flash-deal-sku"
+
+def order_for(quantity):
+    item = server.OrderItem(
+        product_id=SKU, name="Flash deal", price=499.0, quantity=quantity, image="", vendor_id="vendor-flash"
+    )
+    return server.OrderCreate(
+        customer_name="Load Test", email="load@example.com", address="1 Test Street",
+        items=[item], total_amount=item.price * quantity
+    )
+
+async def attempt(quantity):
+    user = {"id": str(uuid.uuid4()), "user_type": "user"}
+    try:
+        await server.place_order(order_for(quantity), user)
+        return "ok"
+    except HTTPException as e:
+        return e.status_code
+
+async def check_expiry(scratch, stock):
+    await scratch.products.update_one({"id": SKU}, {"$set": {"stock": stock}})
+    lines = [server.OrderLine(product_id=SKU, quantity=stock)]
+    await server.stock_reservations.reserve("expiry-check", lines, ttl=0)
+    held = (await scratch.products.find_one({"id": SKU}))['stock']
+    swept = await server.stock_reservations.sweep()
+    restored = (await scratch.products.find_one({"id": SKU}))['stock']
+    print(f"Expiry: stock {held} while held, {restored} after sweeping {swept} reservation(s)")
+    return held == 0 and restored == stock
+
+async def run(stock, checkouts, quantity, expire):
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'], maxPoolSize=200)
+    scratch = client[f"{os.environ['DB_NAME']}_reservation_check"]
+    server.client, server.db = client, scratch
+
+    try:
+        await server.stock_reservations.setup()
+        await scratch.products.insert_one({"id": SKU, "name": "Flash deal", "status": "approved", "stock": stock, "sales_count": 0})
+
+        start = time.perf_counter()
+        results = Counter(await asyncio.gather(*(attempt(quantity) for _ in range(checkouts))))
+        elapsed = time.perf_counter() - start
+
+        product = await scratch.products.find_one({"id": SKU})
+        orders = await scratch.orders.count_documents({})
+        expected = stock // quantity
+        print(f"{checkouts} concurrent checkouts of {quantity} against stock {stock} in {elapsed:.2f}s")
+        print(f"  Outcomes: {dict(results)}")
+        print(f"  Orders written: {orders}, stock left: {product['stock']}, holds left: {len(product.get('stock_holds', {}))}")
+        print(f"  Reservations: {server.stock_reservations.metrics()}")
+
+        ok = results["ok"] == expected and orders == expected and product['stock'] == stock - expected * quantity
+        if expire:
+            ok = await check_expiry(scratch, stock) and ok
+    finally:
+        await client.drop_database(scratch.name)
+        client.close()
+
+    print("OK: no oversell" if ok else "FAIL: stock and successful checkouts disagree")
+    return ok
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stock", type=int, default=10)
+    parser.add_argument("--checkouts", type=int, default=300)
+    parser.add_argument("--quantity", type=int, default=1)
+    parser.add_argument("--expire", action="store_true")
+    args = parser.parse_args()
+    sys.exit(0 if asyncio.run(run(args.stock, args.checkouts, args.quantity, args.expire)) else 1)
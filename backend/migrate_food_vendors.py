@@ -4,6 +4,8 @@ from motor.motor_asyncio import AsyncIOMotorClient
 import os
 from dotenv import load_dotenv
 
+from server import legacy_account_filter, with_login_keys
+
 load_dotenv()
 
 async def migrate_collection():
@@ -28,7 +30,7 @@ async def migrate_collection():
             # Alternative: copy documents
             print("Trying fallback: copying documents...")
             async for doc in db["food_vendors"].find():
-                await db["restuarent"].insert_one(doc)
+                await db["restuarent"].insert_one(with_login_keys(doc))
             print("Copy complete.")
     else:
         print("food_vendors collection not found. Maybe already renamed or empty.")
@@ -41,5 +43,13 @@ async def migrate_collection():
     )
     print(f"Updated {result.modified_count} documents to user_type 'restaurant'.")
 
+    # Logins look accounts up by email_lc / phone_e164
+    keyed = 0
+    async for doc in db["restuarent"].find(legacy_account_filter()):
+        keys = with_login_keys({k: doc[k] for k in ("email", "phone") if k in doc})
+        await db["restuarent"].update_one({"_id": doc["_id"]}, {"$set": keys})
+        keyed += 1
+    print(f"Added login keys to {keyed} documents.")
+
 if __name__ == "__main__":
     asyncio.run(migrate_collection())
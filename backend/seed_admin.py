@@ -9,6 +9,8 @@ from passlib.context import CryptContext
 import uuid
 from datetime import datetime, timezone
 
+from server import normalize_email, with_login_keys
+
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 async def seed_admin():
@@ -25,10 +27,10 @@ async def seed_admin():
     admin_password = "admin_password" # Default password, user can change later
     
     # Check if admin already exists
-    existing_admin = await db.users.find_one({"email": admin_email})
+    existing_admin = await db.users.find_one({"$or": [{"email_lc": normalize_email(admin_email)}, {"email": admin_email}]})
     
     if not existing_admin:
-        admin_doc = {
+        admin_doc = with_login_keys({
             "id": str(uuid.uuid4()),
             "name": "System Admin",
             "email": admin_email,
@@ -38,14 +40,14 @@ async def seed_admin():
             "is_blocked": False,
             "created_at": datetime.now(timezone.utc),
             "avatar": "https://api.dicebear.com/7.x/avataaars/svg?seed=Admin"
-        }
+        })
         await db.users.insert_one(admin_doc)
         print(f"Successfully seeded admin user: {admin_email}")
     else:
         # Ensure it is an admin
         await db.users.update_one(
-            {"email": admin_email},
-            {"$set": {"user_type": "admin"}}
+            {"_id": existing_admin['_id']},
+            {"$set": with_login_keys({"user_type": "admin", "email": existing_admin.get('email', admin_email)})}
         )
         print(f"Admin user already exists: {admin_email}. Ensured user_type is 'admin'.")
 
@@ -13,17 +13,28 @@ from datetime import datetime, timezone, timedelta
 from contextlib import asynccontextmanager
 from passlib.context import CryptContext
 import jwt
-from typing import Optional, Annotated
+from typing import Optional, Annotated, Literal
 from fastapi import HTTPException, Depends, Header, Request, Body
 import shutil
 import requests
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, Response
+from fastapi.encoders import jsonable_encoder
 import io
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
 import random
+import asyncio
+import heapq
+import re
+import html
+import math
+import json
+import time
+import functools
+import copy
+import numpy as np
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -274,10 +285,83 @@ async def lifespan(app: FastAPI):
                         )
                         break
 
+    await ensure_indexes()
+    await response_cache.start()
+    if isinstance(rate_limiter.backend, MongoRateLimitBackend):
+        await rate_limiter.backend.setup()
+    search_index.start()
+    history_buffer.start()
+    await stock_reservations.setup()
+    await idempotency_store.setup()
+    # Sweeps claim reservations atomically, so every worker may run one
+    if os.environ.get('RESERVATION_SWEEPER_ENABLED', '1') == '1':
+        stock_reservations.start()
+
+    # Workers share one lease, so only one of them runs scheduler passes
+    if os.environ.get('DEAL_SCHEDULER_ENABLED', '1') == '1':
+        deal_scheduler.start()
+
     yield
     # Shutdown
+    await deal_scheduler.stop()
+    await history_buffer.stop()
+    await stock_reservations.stop()
+    await response_cache.stop()
+    password_hasher.shutdown()
     client.close()
 
+def review_index_specs():
+    """One index per review sort, behind the product_id equality filter."""
+    return [[("product_id", 1)] + spec for spec in REVIEW_SORTS.values()]
+
+def catalog_index_specs():
+    """
+    Compound indexes backing every public catalog sort. Each sort order is
+    indexed behind the equality filters the listing can apply: status alone,
+    status + category, and status + category + sub_category.
+    """
+    specs = []
+    for sort, sort_spec in PRODUCT_SORTS.items():
+        if sort == "ending_soon":
+            continue
+        for prefix in (["status"], ["status", "category"], ["status", "category", "sub_category"]):
+            specs.append([(field, 1) for field in prefix] + sort_spec)
+    # Deal listings filter on status + special_offer_enabled, then range on
+    # the offer window
+    for sort in DEAL_SORTS:
+        specs.append([("status", 1), ("special_offer_enabled", 1)] + PRODUCT_SORTS[sort])
+    return specs
+
+async def ensure_indexes():
+    """Creates the indexes the read paths rely on. create_index is idempotent."""
+    await db.vendor_stats.create_index("vendor_id", unique=True)
+    await db.review_votes.create_index([("review_id", 1), ("user_id", 1)], unique=True)
+    await ensure_login_key_indexes()
+    await db.carts.create_index("guest_id", unique=True)
+    await db.carts.create_index("expires_at", expireAfterSeconds=0)
+    await db.coupons.create_index("code")
+    # Orders carry the idempotency record that placed them; at most one each
+    await db.orders.create_index("idempotency_id", unique=True, sparse=True)
+    await food_db.food_orders.create_index("idempotency_id", unique=True, sparse=True)
+    for keys in review_index_specs():
+        try:
+            await db.reviews.create_index(keys)
+        except Exception as e:
+            logging.error(f"Failed to create review index {keys}: {e}")
+
+    for keys in catalog_index_specs():
+        try:
+            await db.products.create_index(keys)
+        except Exception as e:
+            logging.error(f"Failed to create catalog index {keys}: {e}")
+
+    existing = await db.products.index_information()
+    missing = [keys for keys in catalog_index_specs() if not any(
+        info.get('key') == keys for info in existing.values()
+    )]
+    if missing:
+        logging.warning(f"Catalog indexes missing, listing sorts will scan: {missing}")
+
 # Create the main app with lifespan
 app = FastAPI(lifespan=lifespan)
 
@@ -295,9 +379,6 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 # 24 hours
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
-# Rate Limiting In-Memory Store
-login_attempts = {}
-order_attempts = {}
 
 def get_password_hash(password):
     return pwd_context.hash(password)
@@ -305,6 +386,85 @@ def get_password_hash(password):
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
+class PasswordHasher:
+    """
+    Runs bcrypt on a dedicated thread pool so a login burst cannot stall the
+    event loop (bcrypt releases the GIL while hashing). Work beyond the pool
+    plus a bounded queue is refused with 503 instead of piling up.
+    """
+
+    def __init__(self, workers, queue_limit):
+        from concurrent.futures import ThreadPoolExecutor
+        from collections import deque
+
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self._in_flight = 0
+        self._latencies = deque(maxlen=1000)
+        self._waits = deque(maxlen=1000)
+        self.stats = {"completed": 0, "rejected": 0}
+
+    async def _run(self, fn, *args):
+        if self._in_flight >= self.workers + self.queue_limit:
+            self.stats["rejected"] += 1
+            raise HTTPException(
+                status_code=503,
+                detail="Authentication service is busy. Please retry shortly.",
+                headers={"Retry-After": "1"}
+            )
+        self._in_flight += 1
+        submitted = time.perf_counter()
+
+        def timed():
+            started = time.perf_counter()
+            result = fn(*args)
+            return result, started - submitted, time.perf_counter() - started
+
+        try:
+            result, waited, took = await asyncio.get_running_loop().run_in_executor(self._executor, timed)
+        finally:
+            self._in_flight -= 1
+        self._waits.append(waited)
+        self._latencies.append(took)
+        self.stats["completed"] += 1
+        return result
+
+    async def hash(self, password):
+        return await self._run(get_password_hash, password)
+
+    async def verify(self, plain_password, hashed_password):
+        return await self._run(verify_password, plain_password, hashed_password)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+    def metrics(self):
+        def percentiles(samples):
+            if not samples:
+                return {"p50_ms": 0, "p95_ms": 0, "max_ms": 0}
+            ordered = sorted(samples)
+            return {
+                "p50_ms": round(ordered[len(ordered) // 2] * 1000, 1),
+                "p95_ms": round(ordered[int(len(ordered) * 0.95) - 1 if len(ordered) > 1 else 0] * 1000, 1),
+                "max_ms": round(ordered[-1] * 1000, 1),
+            }
+
+        return {
+            **self.stats,
+            "workers": self.workers,
+            "queue_limit": self.queue_limit,
+            "in_flight": self._in_flight,
+            "queue_depth": max(0, self._in_flight - self.workers),
+            "hash_latency": percentiles(self._latencies),
+            "queue_wait": percentiles(self._waits),
+        }
+
+password_hasher = PasswordHasher(
+    workers=int(os.environ.get('PASSWORD_HASH_WORKERS', str(min(4, os.cpu_count() or 1)))),
+    queue_limit=int(os.environ.get('PASSWORD_HASH_QUEUE', '64'))
+)
+
 def create_access_token(data: dict):
     to_encode = data.copy()
     expire = datetime.now(timezone.utc) + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -343,6 +503,12 @@ class CartItem(BaseModel):
     delivery_charge: float = 0.0
     free_delivery_above: float = 0.0
 
+class CartOperation(BaseModel):
+    op: Literal["add", "set_qty", "remove", "move_to_wishlist", "select", "deselect"]
+    id: str
+    quantity: Optional[int] = None
+    item: Optional[CartItem] = None
+
 class WishlistItem(BaseModel):
     id: str
     name: str
@@ -720,6 +886,7 @@ class Order(BaseModel):
     tip_amount: float = 0.0
     coupon_code: Optional[str] = None
     discount_amount: float = 0
+    platform_fee: float = 0.0
     status: str = "processing"
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     # Food delivery fields
@@ -749,6 +916,20 @@ class OrderCreate(BaseModel):
     delivery_date: Optional[datetime] = None
     delivery_time_slot: Optional[str] = None
     delivery_notes: Optional[str] = None
+    # Stock held earlier through /orders/reserve
+    reservation_id: Optional[str] = None
+
+class OrderLine(BaseModel):
+    product_id: str
+    quantity: int
+
+class StockReservationCreate(BaseModel):
+    items: List[OrderLine]
+
+class OrderQuoteRequest(BaseModel):
+    items: List[OrderLine]
+    coupon_code: Optional[str] = None
+    tip_amount: float = 0.0
 
 class DeliveryUpdate(BaseModel):
     delivery_date: Optional[datetime] = None
@@ -920,7 +1101,134 @@ class AboutData(BaseModel):
 # Add your routes to the router instead of directly to app
 
 # Dependency for Protected Routes
-async def get_current_user(authorization: Annotated[Optional[str], Header()] = None):
+# --- Principal Cache ---
+# get_current_user runs on every authenticated request. Resolved principals
+# are cached per (sub, token version) for a short TTL; blocking, forced
+# logout and profile changes invalidate them immediately through the
+# response cache purge stream (tag principal:<id>). With more than one
+# worker that stream only reaches the others through the shared (mongo)
+# purge backend, so without it the cache stays off and every request reads
+# the principal from the database. Entries leave out the password hash and
+# the cart, wishlist and history arrays, which handlers read from the user
+# collection, and every hit is a deep copy so handlers cannot change them.
+
+PRINCIPAL_UNCACHED_FIELDS = {
+    "password", "cart", "cart_changes", "wishlist", "recently_viewed", "pickup_items", "recent_searches",
+}
+
+def principal_cache_enabled():
+    setting = os.environ.get('PRINCIPAL_CACHE_ENABLED', 'auto')
+    if setting != 'auto':
+        return setting == '1'
+    workers = int(os.environ.get('WEB_CONCURRENCY', '1'))
+    if workers > 1 and os.environ.get('RESPONSE_CACHE_BACKEND') != 'mongo':
+        logging.warning(
+            "Principal cache disabled: WEB_CONCURRENCY > 1 needs RESPONSE_CACHE_BACKEND=mongo "
+            "for blocks and logouts to reach every worker"
+        )
+        return False
+    return True
+
+class PrincipalCache:
+    def __init__(self, max_entries, ttl, enabled=True):
+        from collections import OrderedDict
+
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.enabled = enabled
+        self._entries = OrderedDict()
+        self._by_sub = {}
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def get(self, sub, version):
+        if not self.enabled:
+            return None
+        entry = self._entries.get((sub, version))
+        if entry is None or entry[1] <= time.monotonic():
+            if entry is not None:
+                self._remove((sub, version))
+            self.stats["misses"] += 1
+            return None
+        self._entries.move_to_end((sub, version))
+        self.stats["hits"] += 1
+        # Handlers may modify the principal they receive, nested values included
+        return copy.deepcopy(entry[0])
+
+    def set(self, sub, version, user):
+        if not self.enabled:
+            return
+        key = (sub, version)
+        if key in self._entries:
+            self._remove(key)
+        entry = {k: v for k, v in user.items() if k not in PRINCIPAL_UNCACHED_FIELDS}
+        self._entries[key] = (copy.deepcopy(entry), time.monotonic() + self.ttl)
+        self._by_sub.setdefault(sub, set()).add(key)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+            self.stats["evictions"] += 1
+
+    def _remove(self, key):
+        self._entries.pop(key, None)
+        keys = self._by_sub.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_sub[key[0]]
+
+    def invalidate(self, user_id):
+        for key in list(self._by_sub.get(user_id, ())):
+            self._remove(key)
+            self.stats["invalidations"] += 1
+
+    def on_purge(self, tags):
+        for tag in tags:
+            if tag.startswith("principal:"):
+                self.invalidate(tag[len("principal:"):])
+
+    def metrics(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "hit_ratio": round(self.stats["hits"] / lookups, 4) if lookups else 0,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl,
+            "enabled": self.enabled,
+        }
+
+principal_cache = PrincipalCache(
+    max_entries=int(os.environ.get('PRINCIPAL_CACHE_SIZE', '10000')),
+    ttl=float(os.environ.get('PRINCIPAL_CACHE_TTL', '30')),
+    enabled=principal_cache_enabled()
+)
+
+PRINCIPAL_COLLECTIONS = ["users", "vendors", "restuarent"]
+
+def principal_lookup_order(user_type):
+    """Collections to search for a token subject, the one its user_type claim points to first."""
+    if user_type in ["restaurant", "food_vendor", "vendor_food"]:
+        claimed = "restuarent"
+    elif user_type and user_type.startswith("vendor"):
+        claimed = "vendors"
+    elif user_type:
+        claimed = "users"
+    else:
+        return PRINCIPAL_COLLECTIONS
+    return [claimed] + [name for name in PRINCIPAL_COLLECTIONS if name != claimed]
+
+async def find_principal(user_id, user_type=None):
+    for name in principal_lookup_order(user_type):
+        collection = food_db.restuarent if name == "restuarent" else db[name]
+        user = await collection.find_one({"id": user_id})
+        if user:
+            return user
+    return None
+
+async def invalidate_principal(user_id):
+    """Drops the cached principal on every worker after its document changed."""
+    await response_cache.purge(f"principal:{user_id}")
+
+async def resolve_principal(authorization, fresh=False):
     if not authorization:
         raise HTTPException(status_code=401, detail="Authorization header missing.")
 
@@ -930,10 +1238,12 @@ async def get_current_user(authorization: Annotated[Optional[str], Header()] = N
         user_id: str = payload.get("sub")
         version: int = payload.get("version")
 
+        user = None if fresh else principal_cache.get(user_id, version)
+        if user is not None:
+            return user
+
         # Verify user in DB and check block status/version
-        user = await db.users.find_one({"id": user_id}) or \
-               await db.vendors.find_one({"id": user_id}) or \
-                   await food_db.restuarent.find_one({"id": user_id})
+        user = await find_principal(user_id, payload.get("user_type"))
 
         if not user:
             raise HTTPException(status_code=401, detail="Invalid identity.")
@@ -944,10 +1254,165 @@ async def get_current_user(authorization: Annotated[Optional[str], Header()] = N
         if user.get('token_version', 1) != version:
             raise HTTPException(status_code=401, detail="Session expired. Re-authentication required.")
 
+        principal_cache.set(user_id, version, user)
         return user
     except Exception:
         raise HTTPException(status_code=401, detail="Session protocol corrupted.")
 
+async def get_current_user(authorization: Annotated[Optional[str], Header()] = None):
+    return await resolve_principal(authorization)
+
+# --- Rate Limiting ---
+# Sliding-window counters: each key keeps only the current and previous
+# fixed-window counts, and the previous one is weighted by how much of it
+# still overlaps the sliding window. That smooths the burst a fixed window
+# allows at its edges while keeping O(1) state per active key.
+
+# route -> (limit, window seconds), optionally per user type. Override with
+# RATE_LIMIT_<ROUTE>=limit/window or RATE_LIMIT_<ROUTE>_<USER_TYPE>=limit/window
+RATE_LIMITS = {
+    "login": {"default": (5, 60)},
+    "checkout": {"default": (3, 60)},
+}
+
+def rate_limit_for(route, user_type=None):
+    def from_env(name):
+        value = os.environ.get(name)
+        if not value:
+            return None
+        limit, window = value.split("/")
+        return int(limit), float(window)
+
+    limits = RATE_LIMITS[route]
+    if user_type:
+        override = from_env(f"RATE_LIMIT_{route.upper()}_{user_type.upper()}")
+        if override:
+            return override
+        if user_type in limits:
+            return limits[user_type]
+    return from_env(f"RATE_LIMIT_{route.upper()}") or limits["default"]
+
+def sliding_window_retry_after(previous, current, elapsed, limit, window):
+    """Seconds until the weighted count leaves room for one more request."""
+    # Room appears within the current window as the previous one fades out
+    if current < limit and previous > 0:
+        wait = window * (1 - (limit - current) / previous) - elapsed
+        if wait < window - elapsed:
+            return max(1, math.ceil(wait))
+    # Otherwise wait for the current window to become the fading one
+    fade = window * (1 - limit / current) if current > limit else 0
+    return max(1, math.ceil(window - elapsed + fade))
+
+class MemoryRateLimitBackend:
+    def __init__(self, max_keys=100000):
+        from collections import OrderedDict
+
+        self.max_keys = max_keys
+        self._counters = OrderedDict()
+
+    async def hit(self, key, window):
+        """Counts one request; returns (previous count, current count, seconds into window)."""
+        now = time.time()
+        index = int(now // window)
+        stored = self._counters.pop(key, None)
+        if stored is None or stored[0] < index - 1:
+            previous, current = 0, 0
+        elif stored[0] == index - 1:
+            previous, current = stored[1], 0
+        else:
+            previous, current = stored[2], stored[1]
+        current += 1
+        self._counters[key] = (index, current, previous)
+        # Least recently used keys go first; idle ones are already stale
+        while len(self._counters) > self.max_keys:
+            self._counters.popitem(last=False)
+        return previous, current, now - index * window
+
+class MongoRateLimitBackend:
+    """Counters shared by all workers, one small document per key and window."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def setup(self):
+        await self.collection.create_index("expires_at", expireAfterSeconds=0)
+
+    async def hit(self, key, window):
+        from pymongo import ReturnDocument
+
+        now = time.time()
+        index = int(now // window)
+        expires_at = datetime.fromtimestamp((index + 2) * window, timezone.utc)
+        counter, previous = await asyncio.gather(
+            self.collection.find_one_and_update(
+                {"_id": f"{key}:{index}"},
+                {"$inc": {"count": 1}, "$setOnInsert": {"expires_at": expires_at}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            ),
+            self.collection.find_one({"_id": f"{key}:{index - 1}"})
+        )
+        return (previous or {}).get("count", 0), counter["count"], now - index * window
+
+class RateLimiter:
+    def __init__(self, backend):
+        self.backend = backend
+        self.stats = {"allowed": 0, "limited": 0, "backend_errors": 0}
+
+    async def check(self, route, key, user_type=None):
+        """Returns (limit, remaining, retry_after); retry_after is None when allowed."""
+        limit, window = rate_limit_for(route, user_type)
+        try:
+            previous, current, elapsed = await self.backend.hit(f"{route}:{key}", window)
+        except Exception as e:
+            # Fail open: a limiter outage must not lock everyone out
+            logging.error(f"Rate limiter backend failed: {e}")
+            self.stats["backend_errors"] += 1
+            return limit, limit, None
+
+        weighted = previous * (1 - elapsed / window) + current
+        if weighted > limit:
+            self.stats["limited"] += 1
+            return limit, 0, sliding_window_retry_after(previous, current, elapsed, limit, window)
+        self.stats["allowed"] += 1
+        return limit, max(0, int(limit - weighted)), None
+
+    def metrics(self):
+        return {**self.stats, "backend": type(self.backend).__name__}
+
+rate_limiter = RateLimiter(
+    MongoRateLimitBackend(db.rate_limits) if os.environ.get('RATE_LIMIT_BACKEND') == 'mongo' else MemoryRateLimitBackend()
+)
+
+async def enforce_rate_limit(route, key, user_type, response, detail):
+    limit, remaining, retry_after = await rate_limiter.check(route, key, user_type)
+    if retry_after is not None:
+        raise HTTPException(
+            status_code=429,
+            detail=detail,
+            headers={"Retry-After": str(retry_after), "X-RateLimit-Limit": str(limit), "X-RateLimit-Remaining": "0"}
+        )
+    response.headers["X-RateLimit-Limit"] = str(limit)
+    response.headers["X-RateLimit-Remaining"] = str(remaining)
+
+def rate_limit(route, per="ip", detail="Too many requests. Please retry later."):
+    """
+    Route dependency enforcing RATE_LIMITS[route]. per="ip" keys anonymous
+    routes by client address; per="user" keys by the authenticated account
+    and applies its user type's limit.
+    """
+    if per == "user":
+        async def dependency(response: Response, current_user: Annotated[dict, Depends(get_current_user)]):
+            await enforce_rate_limit(route, f"user:{current_user['id']}", current_user.get('user_type'), response, detail)
+    else:
+        async def dependency(request: Request, response: Response):
+            await enforce_rate_limit(route, f"ip:{request.client.host}", None, response, detail)
+    return dependency
+
+async def get_current_user_fresh(authorization: Annotated[Optional[str], Header()] = None):
+    """get_current_user for handlers that act on balances or status read from the principal."""
+    return await resolve_principal(authorization, fresh=True)
+
 @api_router.get("/")
 async def root():
     return {"message": "Hello World"}
@@ -976,28 +1441,197 @@ async def get_status_checks(current_user: Annotated[dict, Depends(get_current_us
 
     return status_checks
 
+# --- Login Keys ---
+# Accounts carry email_lc (trimmed, lowercased email) and phone_e164
+# (canonical +<country><number>) next to the raw values. Both sit behind
+# partial unique indexes, so a login is one index seek per collection and
+# "Foo@X.com" / "foo@x.com" or "98765 43210" / "+919876543210" can't be
+# registered twice. Every write of email or phone must go through
+# with_login_keys; backfill_login_keys.py migrates older documents. Until it
+# has run, collections found at startup to hold accounts without keys are
+# also searched on the raw fields, and a match gets its keys written.
+
+DEFAULT_PHONE_COUNTRY_CODE = os.environ.get('DEFAULT_PHONE_COUNTRY_CODE', '91')
+LOGIN_KEY_COLLECTIONS = [("db", "users"), ("db", "vendors"), ("food_db", "restuarent"), ("food_db", "food_vendors")]
+
+def normalize_email(value):
+    value = (value or "").strip().lower()
+    return value or None
+
+def normalize_phone(value):
+    value = (value or "").strip()
+    if not value or "@" in value or re.search(r"[A-Za-z]", value):
+        return None
+    digits = re.sub(r"\D", "", value)
+    if not digits:
+        return None
+    if value.startswith("+"):
+        return "+" + digits
+    if digits.startswith("00"):
+        return "+" + digits[2:]
+    if len(digits) == 11 and digits.startswith("0"):
+        digits = digits[1:]
+    if len(digits) == 10:
+        return "+" + DEFAULT_PHONE_COUNTRY_CODE + digits
+    return "+" + digits
+
+def with_login_keys(fields):
+    """Adds the derived login keys for whichever of email/phone `fields` sets."""
+    if 'email' in fields:
+        fields['email_lc'] = normalize_email(fields['email'])
+    if 'phone' in fields:
+        fields['phone_e164'] = normalize_phone(fields['phone'])
+    return fields
+
+def login_lookup(identifier):
+    """Single-key query for a login identifier, or None if it can't match anything."""
+    if "@" not in (identifier or ""):
+        phone = normalize_phone(identifier)
+        if phone:
+            return {"phone_e164": phone}
+    email = normalize_email(identifier)
+    return {"email_lc": email} if email else None
+
+def existing_account_query(email, phone):
+    clauses = [{"email_lc": key} for key in [normalize_email(email)] if key]
+    clauses += [{"phone_e164": key} for key in [normalize_phone(phone)] if key]
+    return {"$or": clauses} if clauses else None
+
+def login_key_collections():
+    databases = {"db": db, "food_db": food_db}
+    return [(name, databases[database][name]) for database, name in LOGIN_KEY_COLLECTIONS]
+
+def login_key_collection(name):
+    return dict(login_key_collections())[name]
+
+# Collections that still hold accounts without login keys, set at startup
+legacy_login_collections = set()
+
+def legacy_account_filter():
+    return {"$or": [
+        {"email": {"$exists": True}, "email_lc": {"$exists": False}},
+        {"phone": {"$exists": True}, "phone_e164": {"$exists": False}},
+    ]}
+
+async def find_legacy_account(name, identifier):
+    """
+    Matches an account that predates login keys on its raw email or phone,
+    the way logins worked before, and writes its keys so the next lookup
+    takes the index.
+    """
+    from pymongo.errors import DuplicateKeyError
+
+    query = login_lookup(identifier)
+    if query is None or name not in legacy_login_collections:
+        return None
+    raw = identifier.strip()
+    key = next(iter(query))
+    if key == "email_lc":
+        legacy = {"email": {"$regex": f"^{re.escape(raw)}$", "$options": "i"}}
+    else:
+        legacy = {"phone": raw}
+
+    collection = login_key_collection(name)
+    user = await collection.find_one({**legacy, key: {"$exists": False}})
+    if user:
+        keys = with_login_keys({k: user[k] for k in ("email", "phone") if k in user})
+        try:
+            await collection.update_one({"_id": user['_id']}, {"$set": keys})
+        except DuplicateKeyError:
+            # Another account owns the key; backfill_login_keys.py reports it
+            logging.warning(f"Login keys for {name} account {user.get('id')} collide with another account")
+        else:
+            user.update(keys)
+    return user
+
+async def find_login_account(name, identifier):
+    """Account in collection `name` whose email or phone matches identifier."""
+    query = login_lookup(identifier)
+    if query is None:
+        return None
+    # One seek on the unique email_lc / phone_e164 index
+    user = await login_key_collection(name).find_one(query)
+    return user or await find_legacy_account(name, identifier)
+
+async def ensure_login_key_indexes():
+    for name, collection in login_key_collections():
+        for field in ("email_lc", "phone_e164"):
+            try:
+                await collection.create_index(
+                    field, unique=True, name=f"{field}_unique",
+                    partialFilterExpression={field: {"$type": "string"}}
+                )
+            except Exception as e:
+                logging.error(f"Failed to create {name}.{field} index, run backfill_login_keys.py: {e}")
+
+        legacy = await collection.find_one(legacy_account_filter(), {"_id": 1})
+        if legacy:
+            legacy_login_collections.add(name)
+            logging.warning(f"{name} has accounts without login keys, run backfill_login_keys.py")
+        else:
+            legacy_login_collections.discard(name)
+
+async def backfill_login_keys(fix=False):
+    """Derives missing login keys and reports keys shared by several accounts."""
+    from pymongo import UpdateOne
+
+    report = {}
+    for name, collection in login_key_collections():
+        checked, missing, updates = 0, 0, []
+        seen = {"email_lc": {}, "phone_e164": {}}
+        cursor = collection.find({}, {"_id": 1, "id": 1, "email": 1, "phone": 1, "email_lc": 1, "phone_e164": 1})
+        async for doc in cursor:
+            checked += 1
+            keys = with_login_keys({k: doc.get(k) for k in ("email", "phone")})
+            for field, key in keys.items():
+                if field in seen and key:
+                    seen[field].setdefault(key, []).append(doc.get('id') or str(doc['_id']))
+            changed = {k: v for k, v in keys.items() if k in seen and doc.get(k, "missing") != v}
+            if changed:
+                missing += 1
+                updates.append(UpdateOne({"_id": doc['_id']}, {"$set": changed}))
+
+        if fix and updates:
+            for start in range(0, len(updates), 1000):
+                await collection.bulk_write(updates[start:start + 1000], ordered=False)
+
+        report[name] = {
+            "checked": checked,
+            "missing": missing,
+            "duplicates": {
+                field: {key: ids for key, ids in keys.items() if len(ids) > 1}
+                for field, keys in seen.items()
+            }
+        }
+    return report
+
+def login_key_conflict():
+    return HTTPException(status_code=400, detail="Email or phone is already registered to another account.")
+
 # User endpoints
 @api_router.post("/users/signup", response_model=User)
 async def signup_user(user_data: UserCreate):
+    from pymongo.errors import DuplicateKeyError
+
     # Determine collection based on user_type
     if user_data.user_type in ["restaurant", "food_vendor", "vendor_food"]:
-        collection = client["restuarent"].restuarent
+        name = "restuarent"
     else:
-        collection = db.vendors if user_data.user_type.startswith("vendor") else db.users
+        name = "vendors" if user_data.user_type.startswith("vendor") else "users"
+    collection = login_key_collection(name)
 
     # Check if user already exists
-    existing_user = await collection.find_one({
-        "$or": [
-            {"email": user_data.email},
-            {"phone": user_data.phone}
-        ]
-    })
+    existing_query = existing_account_query(user_data.email, user_data.phone)
+    existing_user = existing_query and await collection.find_one(existing_query, {"_id": 1})
+    for identifier in (user_data.email, user_data.phone):
+        if identifier and not existing_user:
+            existing_user = await find_legacy_account(name, identifier)
 
     if existing_user:
         raise HTTPException(status_code=400, detail="User already exists")
 
     user_dict = user_data.model_dump()
-    user_dict['password'] = get_password_hash(user_dict['password'])
+    user_dict['password'] = await password_hasher.hash(user_dict['password'])
     
     # Vendors and Restaurants start as pending (though I previously set restaurants to active by default)
     # Let's keep consistency: e-commerce vendors are pending, restaurants are active
@@ -1011,10 +1645,13 @@ async def signup_user(user_data: UserCreate):
         
     user_obj = User(**user_dict)
 
-    doc = user_obj.model_dump()
+    doc = with_login_keys(user_obj.model_dump())
     doc['created_at'] = doc['created_at'].isoformat()
 
-    result = await collection.insert_one(doc)
+    try:
+        result = await collection.insert_one(doc)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="User already exists")
     doc['_id'] = result.inserted_id
     
     # Generate Token
@@ -1022,65 +1659,26 @@ async def signup_user(user_data: UserCreate):
 
     return {**User(**doc).model_dump(), "token": token}
 
-@api_router.post("/users/login")
+@api_router.post("/users/login", dependencies=[Depends(rate_limit("login", detail="Too many connection attempts. Cooldown protocol active."))])
 async def login_user(login_data: UserLogin, request: Request):
-    # Rate Limiting Logic
-    client_ip = request.client.host
-    now = datetime.now(timezone.utc)
-    
-    if client_ip in login_attempts:
-        last_attempt, count = login_attempts[client_ip]
-        if (now - last_attempt).total_seconds() < 60: # 1 minute window
-            if count >= 5:
-                raise HTTPException(status_code=429, detail="Too many connection attempts. Cooldown protocol active.")
-            login_attempts[client_ip] = (last_attempt, count + 1)
-        else:
-            login_attempts[client_ip] = (now, 1)
-    else:
-        login_attempts[client_ip] = (now, 1)
-
-    # Food vendors/Restaurants are stored in the 'restuarent' database
+    identifier = login_data.identifier
     if login_data.user_type in ["restaurant", "food_vendor", "vendor_food"]:
-        # Food portal users - check 'restuarent' database
-        food_db_login = client["restuarent"]
-        
-        # Build query for email/phone
-        # Use regex for case-insensitive email match
-        query = {
-            "$or": [
-                {"email": {"$regex": f"^{login_data.identifier}$", "$options": "i"}},
-                {"phone": login_data.identifier}
-            ]
-        }
-        
-        # Search in the primary 'restuarent' collection
-        user = await food_db_login.restuarent.find_one(query)
-        
+        # Food portal users live in the 'restuarent' database
+        user = await find_login_account("restuarent", identifier)
+
         # Fallback to 'food_vendors' collection for legacy data
         if not user:
-            user = await food_db_login.food_vendors.find_one(query)
-            
+            user = await find_login_account("food_vendors", identifier)
+
     elif login_data.user_type.startswith("vendor"):
-        collection = db.vendors
-        user = await collection.find_one({
-            "$or": [
-                {"email": login_data.identifier},
-                {"phone": login_data.identifier}
-            ]
-        })
+        user = await find_login_account("vendors", identifier)
     else:
-        collection = db.users
-        user = await collection.find_one({
-            "$or": [
-                {"email": login_data.identifier},
-                {"phone": login_data.identifier}
-            ]
-        })
+        user = await find_login_account("users", identifier)
 
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
-    if not verify_password(login_data.password, user['password']):
+    if not await password_hasher.verify(login_data.password, user['password']):
         raise HTTPException(status_code=401, detail="Invalid credentials protocol.")
 
     if user.get('is_blocked', False):
@@ -1118,9 +1716,11 @@ async def verify_otp(identifier: str, otp: str):
         raise HTTPException(status_code=400, detail="Invalid OTP code protocol.")
         
     # Check if user exists
-    user = await db.users.find_one({"$or": [{"email": identifier}, {"phone": identifier}]}) or \
-           await db.vendors.find_one({"$or": [{"email": identifier}, {"phone": identifier}]}) or \
-           await food_db.restuarent.find_one({"$or": [{"email": identifier}, {"phone": identifier}]})
+    user = (
+        await find_login_account("users", identifier) or
+        await find_login_account("vendors", identifier) or
+        await find_login_account("restuarent", identifier)
+    )
            
     if not user:
         return {"message": "OTP verified. Redirecting to registration.", "verified": True, "user_exists": False}
@@ -1139,11 +1739,17 @@ async def update_vendor_profile(profile_data: UserUpdate, current_user: Annotate
     if not current_user['user_type'].startswith('vendor'):
         raise HTTPException(status_code=403, detail="Only vendors can update profile via this endpoint")
         
+    from pymongo.errors import DuplicateKeyError
+
     update_data = profile_data.model_dump(exclude_unset=True)
     if not update_data:
         return {"message": "No changes provided"}
 
-    await db.vendors.update_one({"id": current_user['id']}, {"$set": update_data})
+    try:
+        await db.vendors.update_one({"id": current_user['id']}, {"$set": with_login_keys(update_data)})
+    except DuplicateKeyError:
+        raise login_key_conflict()
+    await invalidate_principal(current_user['id'])
     return {"message": "Vendor profile updated"}
 
 
@@ -1155,6 +1761,7 @@ async def block_entity(user_id: str, current_admin: Annotated[dict, Depends(get_
         
     await db.users.update_one({"id": user_id}, {"$set": {"is_blocked": True, "token_version": datetime.now().timestamp()}})
     await db.vendors.update_one({"id": user_id}, {"$set": {"is_blocked": True, "token_version": datetime.now().timestamp()}})
+    await invalidate_principal(user_id)
     
     return {"message": "Entity blocked from global network."}
 
@@ -1165,6 +1772,7 @@ async def unblock_entity(user_id: str, current_admin: Annotated[dict, Depends(ge
         
     await db.users.update_one({"id": user_id}, {"$set": {"is_blocked": False}})
     await db.vendors.update_one({"id": user_id}, {"$set": {"is_blocked": False}})
+    await invalidate_principal(user_id)
     
     return {"message": "Entity re-synchronized with global network."}
 
@@ -1176,65 +1784,106 @@ async def force_logout(user_id: str, current_admin: Annotated[dict, Depends(get_
     new_version = int(datetime.now().timestamp())
     await db.users.update_one({"id": user_id}, {"$set": {"token_version": new_version}})
     await db.vendors.update_one({"id": user_id}, {"$set": {"token_version": new_version}})
+    await invalidate_principal(user_id)
     
     return {"message": "Sessions terminated. Entity must re-authenticate."}
 
-@api_router.get("/users/sync")
-async def sync_user(current_user: Annotated[dict, Depends(get_current_user)]):
-    # Determine the correct collection based on user_type
-    if current_user.get('user_type') == 'restaurant':
+def user_collection(user):
+    """Collection holding a principal's profile, cart and history."""
+    if user.get('user_type') == 'restaurant':
         # Food vendors are in the 'restuarent' database
-        sync_collection = food_db.restuarent
-    elif current_user['user_type'].startswith('vendor'):
-        sync_collection = db.vendors
-    else:
-        sync_collection = db.users
-    
-    user = await sync_collection.find_one({"id": current_user['id']}, {"_id": 0, "password": 0})
-    
-    if user and 'cart' in user and user['cart']:
-        # Refresh cart items with current prices from DB
-        try:
-            cart_items = user['cart']
-            product_ids = [item['id'] for item in cart_items]
-            
+        return food_db.restuarent
+    if user['user_type'].startswith('vendor'):
+        return db.vendors
+    return db.users
+
+CART_SYNC_FIELDS = [
+    ("price", None),
+    ("delivery_type", "free"),
+    ("delivery_charge", 0.0),
+    ("free_delivery_above", 0.0),
+]
+
+def cart_item_changes(item, product):
+    """Fields of a cart item that no longer match the product, as {field: {old, new}}."""
+    changes = {}
+    for field, default in CART_SYNC_FIELDS:
+        current = product.get(field, default)
+        if item.get(field) != current:
+            changes[field] = {"old": item.get(field), "new": current}
+    return changes
+
+async def refresh_cart_prices(collection, user, product_details=None, field="cart"):
+    """
+    Re-prices user['cart'] against the catalog. Only items whose price or
+    delivery terms drifted are written back, with one positional $set per
+    item, and user['cart_changes'] lists what changed so the UI can flag it.
+    Callers that already fetched and priced the cart's products pass them by
+    id. Guest carts keep their lines under `field` "items".
+    """
+    if not user or not user.get(field):
+        return user
+    user['cart_changes'] = []
+    try:
+        cart_items = user[field]
+        if product_details is None:
             # Fetch current product details
-            products_cursor = db.products.find({"id": {"$in": product_ids}})
-            product_details = {}
-            async for p in products_cursor:
-                # Sync price for each product to get active deal price
-                p = sync_product_price(p)
-                product_details[p['id']] = p
-                
-            # Update prices in cart if they changed
-            any_changed = False
-            for item in cart_items:
-                product = product_details.get(item['id'])
-                if product:
-                    # Sync delivery details
-                    item['delivery_type'] = product.get('delivery_type', 'free')
-                    item['delivery_charge'] = product.get('delivery_charge', 0.0)
-                    item['free_delivery_above'] = product.get('free_delivery_above', 0.0)
-
-                    # If offer expired or price changed, update to current price
-                    if item.get('price') != product.get('price'):
-                        item['price'] = product.get('price')
-                        any_changed = True
-                    
-                    # Force update flag to True to save delivery details
-                    any_changed = True
-            
-            if any_changed:
-                await sync_collection.update_one(
-                    {"id": current_user['id']}, 
-                    {"$set": {"cart": cart_items}}
-                )
-                user['cart'] = cart_items
-        except Exception as e:
-            logging.error(f"Error refreshing cart prices: {e}")
-            
+            product_ids = [item['id'] for item in cart_items]
+            products = await db.products.find({"id": {"$in": product_ids}}).to_list(None)
+            # Price the whole cart in one pass to get active deal prices
+            product_details = {p['id']: p for p in bulk_sync_product_prices(products)}
+
+        updates, slots, cart_changes = {}, {}, []
+        for item in cart_items:
+            product = product_details.get(item['id'])
+            if not product:
+                continue
+            changes = cart_item_changes(item, product)
+            if not changes:
+                continue
+            # The filter matches every line for the product, so one slot each.
+            # Duplicate lines can drift on different fields; all of them get
+            # the product's value, so the slot sets the union of their changes.
+            slot = slots.setdefault(item['id'], f"c{len(slots)}")
+            for name, change in changes.items():
+                updates[f"{field}.$[{slot}].{name}"] = change["new"]
+            for name, change in changes.items():
+                item[name] = change["new"]
+            cart_changes.append({"id": item['id'], "name": item.get('name'), "changes": changes})
+
+        # Steady state: nothing drifted, nothing written
+        if updates:
+            await collection.update_one(
+                {"id": user['id']},
+                {"$set": updates},
+                array_filters=[{f"{slot}.id": item_id} for item_id, slot in slots.items()]
+            )
+        user['cart_changes'] = cart_changes
+    except Exception as e:
+        logging.error(f"Error refreshing cart prices: {e}")
     return user
 
+def ordered_products(product_ids, products_map):
+    """Products for product_ids in the given order, skipping missing ones."""
+    ordered = []
+    for p_id in product_ids:
+        if p_id in products_map:
+            p = dict(products_map[p_id])
+            p['id'] = p.get('id') or str(p['_id'])
+            p.pop('_id', None)
+            ordered.append(p)
+    return ordered
+
+def pickup_product_ids(user):
+    # Fallback to the last 4 recently viewed if pickup_items is empty
+    return user.get('pickup_items') or user.get('recently_viewed', [])[:4]
+
+@api_router.get("/users/sync")
+async def sync_user(current_user: Annotated[dict, Depends(get_current_user)]):
+    sync_collection = user_collection(current_user)
+    user = await sync_collection.find_one({"id": current_user['id']}, {"_id": 0, "password": 0})
+    return await refresh_cart_prices(sync_collection, user)
+
 @api_router.put("/users/cart")
 async def update_cart(cart: List[CartItem], current_user: Annotated[dict, Depends(get_current_user)]):
     # Determine the correct collection based on user_type
@@ -1291,6 +1940,86 @@ async def remove_from_cart(item_id: str, current_user: Annotated[dict, Depends(g
     
     return {"message": "Item removed from cart"}
 
+CART_BATCH_LIMIT = 100
+
+def cart_operation_writes(user_id, operation, cart_lines):
+    """
+    The UpdateOne writes for one PATCH /users/cart operation, in order.
+    cart_lines is the cart as the batch has left it so far and is updated
+    here, so a wishlist move sees lines added earlier in the same batch.
+    """
+    from pymongo import UpdateOne
+
+    line_filter = {"id": user_id, "cart.id": operation.id}
+    remove = UpdateOne({"id": user_id}, {"$pull": {"cart": {"id": operation.id}}})
+    line = cart_lines.get(operation.id)
+
+    if operation.op == "add":
+        item = operation.item.model_dump()
+        cart_lines[operation.id] = {**line, "quantity": line['quantity'] + item['quantity']} if line else item
+        return [
+            UpdateOne(line_filter, {"$inc": {"cart.$.quantity": item['quantity']}}),
+            # Matches only when the $inc above found nothing to bump
+            UpdateOne({"id": user_id, "cart.id": {"$ne": operation.id}}, {"$push": {"cart": item}}),
+        ]
+    if operation.op == "set_qty":
+        if operation.quantity <= 0:
+            cart_lines.pop(operation.id, None)
+            return [remove]
+        if line:
+            cart_lines[operation.id] = {**line, "quantity": operation.quantity}
+        return [UpdateOne(line_filter, {"$set": {"cart.$.quantity": operation.quantity}})]
+    if operation.op in ("select", "deselect"):
+        if line:
+            cart_lines[operation.id] = {**line, "selected": operation.op == "select"}
+        return [UpdateOne(line_filter, {"$set": {"cart.$.selected": operation.op == "select"}})]
+    cart_lines.pop(operation.id, None)
+    if operation.op == "move_to_wishlist" and line:
+        wish = WishlistItem(**{**line, "image": line.get('image') or ""}).model_dump()
+        return [
+            remove,
+            UpdateOne({"id": user_id, "wishlist.id": {"$ne": operation.id}}, {"$push": {"wishlist": wish}}),
+        ]
+    return [remove]
+
+@api_router.patch("/users/cart")
+async def patch_cart(operations: List[CartOperation], current_user: Annotated[dict, Depends(get_current_user)]):
+    """
+    Applies an ordered list of cart operations in one bulk write against the
+    user document and returns the resulting, server-priced cart.
+    """
+    if not operations:
+        raise HTTPException(status_code=400, detail="No cart operations provided.")
+    if len(operations) > CART_BATCH_LIMIT:
+        raise HTTPException(status_code=400, detail=f"At most {CART_BATCH_LIMIT} cart operations per request.")
+    for operation in operations:
+        if operation.op == "add" and (operation.item is None or operation.item.id != operation.id or operation.item.quantity <= 0):
+            raise HTTPException(status_code=400, detail="add needs an item with the same id and a positive quantity.")
+        if operation.op == "set_qty" and operation.quantity is None:
+            raise HTTPException(status_code=400, detail="set_qty needs a quantity.")
+
+    collection = user_collection(current_user)
+
+    # Wishlist moves copy the line as stored or as added earlier in the
+    # batch, so read the cart before the batch and track it through
+    cart_lines = {}
+    if any(operation.op == "move_to_wishlist" for operation in operations):
+        user = await collection.find_one({"id": current_user['id']}, {"_id": 0, "cart": 1})
+        cart_lines = {line['id']: line for line in (user or {}).get('cart') or []}
+
+    writes = [w for operation in operations for w in cart_operation_writes(current_user['id'], operation, cart_lines)]
+    await collection.bulk_write(writes, ordered=True)
+
+    user = await collection.find_one({"id": current_user['id']}, {"_id": 0, "id": 1, "cart": 1})
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    user = await refresh_cart_prices(collection, user)
+    return {
+        "applied": len(operations),
+        "cart": user.get('cart', []),
+        "cart_changes": user.get('cart_changes', []),
+    }
+
 @api_router.put("/users/wishlist")
 async def update_wishlist(wishlist: List[WishlistItem], current_user: Annotated[dict, Depends(get_current_user)]):
     # Determine the correct collection based on user_type
@@ -1347,9 +2076,142 @@ async def remove_from_wishlist(item_id: str, current_user: Annotated[dict, Depen
     
     return {"message": "Item removed from wishlist"}
 
+# --- Browsing History ---
+# Recently viewed, pickup items and recent searches are capped, most-recent-
+# first lists on the user document. Append endpoints take one event and
+# apply it atomically in the database: a pipeline update that drops earlier
+# copies, prepends and trims in one step (a classic $pull + $push on the same
+# array would conflict), so concurrent tabs never lose entries. Events are
+# coalesced in memory per user and field and flushed in one bulk write every
+# HISTORY_FLUSH_SECONDS (1 by default), so the endpoints answer without
+# waiting on the database; HISTORY_FLUSH_SECONDS=0 writes each event inline.
+
+HISTORY_LIMITS = {"recently_viewed": 20, "pickup_items": 10, "recent_searches": 10}
+
+def history_key(field, value):
+    # Searches dedupe case-insensitively, like the storefront does
+    return value.lower() if field == "recent_searches" else value
+
+def history_prepend_update(field, values):
+    """
+    Pipeline update putting `values` (most recent first) at the head of
+    `field`. The values come from users, so they go in as $literal: a bare
+    "$password" would otherwise be read as a field path of the document.
+    """
+    if field == "recent_searches":
+        seen = {"$in": [{"$toLower": "$$entry"}, {"$literal": [history_key(field, v) for v in values]}]}
+    else:
+        seen = {"$in": ["$$entry", {"$literal": values}]}
+    kept = {"$filter": {"input": {"$ifNull": [f"${field}", []]}, "as": "entry", "cond": {"$eq": [seen, False]}}}
+    return [{"$set": {field: {"$slice": [{"$concatArrays": [{"$literal": values}, kept]}, HISTORY_LIMITS[field]]}}}]
+
+class HistoryBuffer:
+    def __init__(self, flush_seconds, max_pending):
+        self.flush_seconds = flush_seconds
+        self.max_pending = max_pending
+        self._pending = {}
+        self._collections = {}
+        self._task = None
+        self._flushing = set()
+        self.stats = {"events": 0, "coalesced": 0, "flushes": 0, "writes": 0, "errors": 0}
+
+    @property
+    def enabled(self):
+        return self.flush_seconds > 0
+
+    async def record(self, collection, user_id, field, value):
+        """Applies one history event, or queues it when coalescing is on."""
+        self.stats["events"] += 1
+        if not self.enabled:
+            await collection.update_one({"id": user_id}, history_prepend_update(field, [value]))
+            self.stats["writes"] += 1
+            return
+
+        key = (collection.full_name, user_id, field)
+        self._collections[collection.full_name] = collection
+        values = self._pending.setdefault(key, [])
+        if values:
+            self.stats["coalesced"] += 1
+        values[:] = [value] + [v for v in values if history_key(field, v) != history_key(field, value)]
+        del values[HISTORY_LIMITS[field]:]
+        if len(self._pending) >= self.max_pending:
+            # The request that fills the buffer doesn't wait on the write either
+            task = asyncio.create_task(self.flush())
+            self._flushing.add(task)
+            task.add_done_callback(self._flushing.discard)
+
+    async def flush(self):
+        from pymongo import UpdateOne
+
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        self.stats["flushes"] += 1
+        writes = {}
+        for (name, user_id, field), values in pending.items():
+            writes.setdefault(name, []).append(UpdateOne({"id": user_id}, history_prepend_update(field, values)))
+        for name, ops in writes.items():
+            try:
+                await self._collections[name].bulk_write(ops, ordered=False)
+                self.stats["writes"] += len(ops)
+            except Exception as e:
+                # History is best effort; a failed flush is dropped, not retried
+                self.stats["errors"] += 1
+                logging.error(f"History flush to {name} failed: {e}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_seconds)
+            await self.flush()
+
+    def start(self):
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await asyncio.gather(*self._flushing)
+        await self.flush()
+
+    def metrics(self):
+        return {
+            **self.stats,
+            "enabled": self.enabled,
+            "flush_seconds": self.flush_seconds,
+            "pending": len(self._pending),
+        }
+
+history_buffer = HistoryBuffer(
+    flush_seconds=float(os.environ.get('HISTORY_FLUSH_SECONDS', '1')),
+    max_pending=int(os.environ.get('HISTORY_MAX_PENDING', '5000'))
+)
+
+@api_router.post("/users/recently-viewed/{product_id}", status_code=202)
+async def append_recently_viewed(product_id: str, current_user: Annotated[dict, Depends(get_current_user)]):
+    await history_buffer.record(user_collection(current_user), current_user['id'], "recently_viewed", product_id)
+    return {"message": "Recently viewed history updated"}
+
+@api_router.post("/users/pickup-items/{product_id}", status_code=202)
+async def append_pickup_item(product_id: str, current_user: Annotated[dict, Depends(get_current_user)]):
+    await history_buffer.record(user_collection(current_user), current_user['id'], "pickup_items", product_id)
+    return {"message": "Pick up where you left off history updated"}
+
+@api_router.post("/users/recent-searches", status_code=202)
+async def append_recent_search(current_user: Annotated[dict, Depends(get_current_user)], query: str = Body(..., embed=True)):
+    query = query.strip()
+    if not query:
+        raise HTTPException(status_code=400, detail="Search query is empty.")
+    await history_buffer.record(user_collection(current_user), current_user['id'], "recent_searches", query[:200])
+    return {"message": "Recent searches updated"}
+
 @api_router.put("/users/recently-viewed")
 async def update_recently_viewed(product_ids: List[str], current_user: Annotated[dict, Depends(get_current_user)]):
-    print(f"DEBUG: update_recently_viewed called with: {product_ids} for user {current_user['id']}")
     # Determine the correct collection based on user_type
     if current_user.get('user_type') == 'restaurant':
         collection = food_db.restuarent
@@ -1360,8 +2222,7 @@ async def update_recently_viewed(product_ids: List[str], current_user: Annotated
     
     # Keep only last 20 items
     product_ids = product_ids[:20]
-    result = await collection.update_one({"id": current_user['id']}, {"$set": {"recently_viewed": product_ids}})
-    print(f"DEBUG: update matched: {result.matched_count}, modified: {result.modified_count}")
+    await collection.update_one({"id": current_user['id']}, {"$set": {"recently_viewed": product_ids}})
     return {"message": "Recently viewed history updated"}
 
 @api_router.get("/users/recently-viewed")
@@ -1380,21 +2241,9 @@ async def get_recently_viewed(current_user: Annotated[dict, Depends(get_current_
     if not product_ids:
         return []
         
-    # Fetch actual product details
-    products_cursor = db.products.find({"id": {"$in": product_ids}})
-    products = await products_cursor.to_list(None)
-    
-    # Sort products based on the order in product_ids (recent first)
-    products_map = {p['id']: p for p in products}
-    ordered_products = []
-    for p_id in product_ids:
-        if p_id in products_map:
-            p = products_map[p_id]
-            p['id'] = p.get('id') or str(p['_id'])
-            if '_id' in p: del p['_id']
-            ordered_products.append(p)
-            
-    return ordered_products
+    # Fetch actual product details, recent first
+    products = await db.products.find({"id": {"$in": product_ids}}).to_list(None)
+    return ordered_products(product_ids, {p['id']: p for p in products})
 
 @api_router.put("/users/pickup-items")
 async def update_pickup_items(product_ids: List[str], current_user: Annotated[dict, Depends(get_current_user)]):
@@ -1421,32 +2270,15 @@ async def get_pickup_items(current_user: Annotated[dict, Depends(get_current_use
     else:
         collection = db.users
     
-    user = await collection.find_one({"id": current_user['id']}, {"pickup_items": 1})
-    product_ids = user.get('pickup_items', [])
-    
-    if not product_ids:
-        # Fallback to recently_viewed if pickup_items is empty
-        user = await collection.find_one({"id": current_user['id']}, {"recently_viewed": 1})
-        product_ids = user.get('recently_viewed', [])[:4] # Just the last 4
+    user = await collection.find_one({"id": current_user['id']}, {"pickup_items": 1, "recently_viewed": 1})
+    product_ids = pickup_product_ids(user)
         
     if not product_ids:
         return []
         
     # Fetch actual product details
-    products_cursor = db.products.find({"id": {"$in": product_ids}})
-    products = await products_cursor.to_list(None)
-    
-    # Sort products based on the order in product_ids
-    products_map = {p['id']: p for p in products}
-    ordered_products = []
-    for p_id in product_ids:
-        if p_id in products_map:
-            p = products_map[p_id]
-            p['id'] = p.get('id') or str(p['_id'])
-            if '_id' in p: del p['_id']
-            ordered_products.append(p)
-            
-    return ordered_products
+    products = await db.products.find({"id": {"$in": product_ids}}).to_list(None)
+    return ordered_products(product_ids, {p['id']: p for p in products})
 
 @api_router.put("/users/recent-searches")
 async def update_recent_searches(searches: List[str], current_user: Annotated[dict, Depends(get_current_user)]):
@@ -1476,6 +2308,256 @@ async def get_recent_searches(current_user: Annotated[dict, Depends(get_current_
     user = await collection.find_one({"id": current_user['id']}, {"recent_searches": 1})
     return user.get('recent_searches', [])
 
+# --- User Bootstrap ---
+# The storefront shell used to make six authenticated calls on load. The
+# bootstrap endpoint resolves the principal once, reads the user document
+# once with a projection covering the requested sections, and hydrates
+# cart, recently viewed and pickup products with a single $in query.
+
+BOOTSTRAP_SECTIONS = ["profile", "recently_viewed", "pickup_items", "recent_searches", "notifications", "permissions"]
+
+def bootstrap_projection(sections):
+    if "profile" in sections:
+        return {"_id": 0, "password": 0}
+    projection = {"_id": 0, "id": 1}
+    if "recently_viewed" in sections or "pickup_items" in sections:
+        projection.update({"recently_viewed": 1, "pickup_items": 1})
+    if "recent_searches" in sections:
+        projection["recent_searches"] = 1
+    return projection
+
+@api_router.get("/users/bootstrap")
+async def bootstrap_user(current_user: Annotated[dict, Depends(get_current_user)], include: Optional[str] = None):
+    sections = [s.strip() for s in include.split(",") if s.strip()] if include else BOOTSTRAP_SECTIONS
+    unknown = [s for s in sections if s not in BOOTSTRAP_SECTIONS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown bootstrap sections: {', '.join(unknown)}. Use {', '.join(BOOTSTRAP_SECTIONS)}.")
+
+    collection = user_collection(current_user)
+    needs_user = any(s in sections for s in ["profile", "recently_viewed", "pickup_items", "recent_searches"])
+
+    async def noop():
+        return None
+
+    # The remaining sections don't depend on the user document
+    user, notifications, permissions = await asyncio.gather(
+        collection.find_one({"id": current_user['id']}, bootstrap_projection(sections)) if needs_user else noop(),
+        take_unread_notifications(current_user['id']) if "notifications" in sections else noop(),
+        resolve_permissions(current_user.get('user_type', 'user')) if "permissions" in sections else noop(),
+    )
+    user = user or {}
+
+    recently_viewed = user.get('recently_viewed', []) if "recently_viewed" in sections else []
+    pickup_ids = pickup_product_ids(user) if "pickup_items" in sections else []
+    cart_ids = [item['id'] for item in user.get('cart') or []] if "profile" in sections else []
+
+    product_ids = list(dict.fromkeys(recently_viewed + pickup_ids + cart_ids))
+    products_map = {}
+    if product_ids:
+        products = await db.products.find({"id": {"$in": product_ids}}).to_list(None)
+        products_map = {p['id']: p for p in bulk_sync_product_prices(products)}
+
+    result = {}
+    if "profile" in sections:
+        result["profile"] = await refresh_cart_prices(collection, user, products_map) if user else None
+    if "recently_viewed" in sections:
+        result["recently_viewed"] = ordered_products(recently_viewed, products_map)
+    if "pickup_items" in sections:
+        result["pickup_items"] = ordered_products(pickup_ids, products_map)
+    if "recent_searches" in sections:
+        result["recent_searches"] = user.get('recent_searches', [])
+    if "notifications" in sections:
+        result["notifications"] = notifications
+    if "permissions" in sections:
+        result["permissions"] = permissions
+    return result
+
+# --- Guest Carts ---
+# Anonymous shoppers get a server cart in db.carts keyed by the X-Guest-Id
+# header the client generates once. Lines are priced by the server on every
+# read, so guests no longer poll /products/refresh-prices, and every change
+# is a single item-level update. Each write pushes expires_at forward; the
+# TTL index drops carts abandoned for GUEST_CART_TTL_DAYS. Signed-in carts
+# stay on the user document, and POST /users/cart/merge folds a guest cart
+# into it at login.
+
+GUEST_CART_TTL = timedelta(days=float(os.environ.get('GUEST_CART_TTL_DAYS', '30')))
+GUEST_CART_MERGE_LEASE = timedelta(seconds=60)
+
+class CartQuantity(BaseModel):
+    quantity: int
+
+def require_guest_id(x_guest_id):
+    if not x_guest_id or not re.fullmatch(r"[A-Za-z0-9-]{8,64}", x_guest_id):
+        raise HTTPException(status_code=400, detail="A valid X-Guest-Id header is required.")
+    return x_guest_id
+
+def guest_cart_touch():
+    now = datetime.now(timezone.utc)
+    return {"updated_at": now, "expires_at": now + GUEST_CART_TTL}
+
+async def priced_cart_line(item: CartItem):
+    """The cart line with name, price and delivery terms taken from the catalog."""
+    projection = {**PRICE_PROJECTION, **{field: 1 for field, _ in CART_SYNC_FIELDS}, "name": 1}
+    product = await db.products.find_one({"id": item.id}, projection)
+    if not product:
+        raise HTTPException(status_code=404, detail="Product not found.")
+    product = bulk_sync_product_prices([product])[0]
+    line = item.model_dump()
+    line.update({field: product.get(field, default) for field, default in CART_SYNC_FIELDS})
+    line['name'] = product.get('name', item.name)
+    return line
+
+def guest_cart_response(guest_id, cart):
+    cart = cart or {}
+    return {
+        "guest_id": guest_id,
+        "items": cart.get('items', []),
+        "cart_changes": cart.get('cart_changes', []),
+        "expires_at": cart.get('expires_at'),
+    }
+
+@api_router.get("/guest/cart")
+async def get_guest_cart(x_guest_id: Optional[str] = Header(None)):
+    guest_id = require_guest_id(x_guest_id)
+    cart = await db.carts.find_one({"guest_id": guest_id}, {"_id": 0})
+    return guest_cart_response(guest_id, await refresh_cart_prices(db.carts, cart, field="items"))
+
+@api_router.post("/guest/cart/items")
+async def add_to_guest_cart(item: CartItem, x_guest_id: Optional[str] = Header(None)):
+    from pymongo.errors import DuplicateKeyError
+
+    guest_id = require_guest_id(x_guest_id)
+    if item.quantity <= 0:
+        raise HTTPException(status_code=400, detail="Quantity must be positive.")
+    line = await priced_cart_line(item)
+
+    for _ in range(2):
+        # Existing line: bump the quantity in place
+        result = await db.carts.update_one(
+            {"guest_id": guest_id, "items.id": item.id},
+            {"$inc": {"items.$.quantity": item.quantity}, "$set": guest_cart_touch()}
+        )
+        if result.matched_count:
+            break
+        # New line, creating the cart on first add. If another request adds
+        # the same line first the upsert collides on guest_id and we retry
+        try:
+            await db.carts.update_one(
+                {"guest_id": guest_id, "items.id": {"$ne": item.id}},
+                {
+                    "$push": {"items": line},
+                    "$set": guest_cart_touch(),
+                    "$setOnInsert": {"id": str(uuid.uuid4()), "created_at": datetime.now(timezone.utc)}
+                },
+                upsert=True
+            )
+            break
+        except DuplicateKeyError:
+            continue
+    else:
+        raise HTTPException(status_code=409, detail="Cart changed while adding the item. Please try again.")
+
+    return {"message": "Item added to cart", "item": line}
+
+@api_router.put("/guest/cart/items/{item_id}")
+async def set_guest_cart_quantity(item_id: str, body: CartQuantity, x_guest_id: Optional[str] = Header(None)):
+    guest_id = require_guest_id(x_guest_id)
+    if body.quantity <= 0:
+        return await remove_from_guest_cart(item_id, x_guest_id)
+    result = await db.carts.update_one(
+        {"guest_id": guest_id, "items.id": item_id},
+        {"$set": {"items.$.quantity": body.quantity, **guest_cart_touch()}}
+    )
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="Item not in cart.")
+    return {"message": "Quantity updated", "id": item_id, "quantity": body.quantity}
+
+@api_router.delete("/guest/cart/items/{item_id}")
+async def remove_from_guest_cart(item_id: str, x_guest_id: Optional[str] = Header(None)):
+    guest_id = require_guest_id(x_guest_id)
+    await db.carts.update_one(
+        {"guest_id": guest_id},
+        {"$pull": {"items": {"id": item_id}}, "$set": guest_cart_touch()}
+    )
+    return {"message": "Item removed from cart"}
+
+@api_router.post("/users/cart/merge")
+async def merge_guest_cart(current_user: Annotated[dict, Depends(get_current_user)], x_guest_id: Optional[str] = Header(None)):
+    """
+    Folds the guest cart into the signed-in cart. Lines already in the user
+    cart get their quantities summed, new lines are appended, all in one
+    ordered bulk write on the user document. The guest cart is claimed
+    first so a retried login cannot merge it twice, and only deleted once
+    the write has gone through; claim, write and delete share a transaction
+    where the server supports one.
+    """
+    from pymongo import UpdateOne
+    from pymongo.errors import BulkWriteError
+
+    guest_id = require_guest_id(x_guest_id)
+    collection = user_collection(current_user)
+    merge_id = str(uuid.uuid4())
+
+    async def merge(session):
+        now = datetime.now(timezone.utc)
+        # A claim older than the lease belongs to a merge that died midway
+        guest_cart = await db.carts.find_one_and_update(
+            {"guest_id": guest_id, "$or": [
+                {"merging_at": {"$exists": False}},
+                {"merging_at": {"$lt": now - GUEST_CART_MERGE_LEASE}},
+            ]},
+            {"$set": {"merge_id": merge_id, "merging_at": now}},
+            session=session
+        )
+        lines = (guest_cart or {}).get('items', [])
+
+        ops = []
+        for line in lines:
+            ops.append(UpdateOne(
+                {"id": current_user['id'], "cart.id": line['id']},
+                {"$inc": {"cart.$.quantity": line.get('quantity', 1)}}
+            ))
+            # Matches only when the $inc above found nothing to bump
+            ops.append(UpdateOne(
+                {"id": current_user['id'], "cart.id": {"$ne": line['id']}},
+                {"$push": {"cart": line}}
+            ))
+        if ops:
+            try:
+                await collection.bulk_write(ops, ordered=True, session=session)
+            except BulkWriteError as e:
+                if session is None:
+                    # Without a transaction the lines before the failing op
+                    # stay merged; drop them so a retry doesn't add them twice
+                    merged = [line['id'] for line in lines[:e.details['writeErrors'][0]['index'] // 2]]
+                    await db.carts.update_one(
+                        {"_id": guest_cart['_id'], "merge_id": merge_id},
+                        {"$pull": {"items": {"id": {"$in": merged}}}}
+                    )
+                raise
+        if guest_cart:
+            await db.carts.delete_one({"_id": guest_cart['_id'], "merge_id": merge_id}, session=session)
+        return lines
+
+    try:
+        lines = await checkout_transactions.run(merge)
+    except Exception:
+        # A transaction rolls the claim back; without one release it here
+        await db.carts.update_one(
+            {"guest_id": guest_id, "merge_id": merge_id},
+            {"$unset": {"merge_id": "", "merging_at": ""}}
+        )
+        raise
+
+    user = await collection.find_one({"id": current_user['id']}, {"_id": 0, "id": 1, "cart": 1})
+    user = await refresh_cart_prices(collection, user or {"id": current_user['id']})
+    return {
+        "merged": len(lines),
+        "cart": user.get('cart', []),
+        "cart_changes": user.get('cart_changes', []),
+    }
+
 @api_router.put("/users/delivery-location")
 async def update_delivery_location(current_user: Annotated[dict, Depends(get_current_user)], delivery_location: str = Body(..., embed=True)):
     # Determine the correct collection based on user_type
@@ -1489,96 +2571,747 @@ async def update_delivery_location(current_user: Annotated[dict, Depends(get_cur
     await collection.update_one({"id": current_user['id']}, {"$set": {"delivery_location": delivery_location}})
     return {"message": "Delivery location updated"}
 
-@api_router.post("/orders/checkout")
-async def checkout(order_data: OrderCreate, request: Request, current_user: Annotated[dict, Depends(get_current_user)]):
-    # Rate Limiting Logic for Checkout (max 3 per minute)
-    client_ip = request.client.host
-    now = datetime.now(timezone.utc)
-
-    if client_ip in order_attempts:
-        last_attempt, count = order_attempts[client_ip]
-        if (now - last_attempt).total_seconds() < 60:
-            if count >= 3:
-                raise HTTPException(status_code=429, detail="Transaction limit exceeded. Deceleration protocol active.")
-            order_attempts[client_ip] = (last_attempt, count + 1)
-        else:
-            order_attempts[client_ip] = (now, 1)
-    else:
-        order_attempts[client_ip] = (now, 1)
+# --- Idempotency Keys ---
+# Order placement accepts an Idempotency-Key header. The first request with a
+# key records it in db.idempotency_keys (unique _id per route, user and key)
+# before doing any work and stores the response when done; a retry replays
+# that response without placing another order or touching the rate limiter.
+# Duplicates that arrive while the first is still running wait for it: in
+# the same worker on a shared future, across workers by polling the record.
+# A holder that dies leaves a lease that lapses so a retry can take over.
+# Failures worth retrying (409, 429, 5xx) are not stored. Orders record the
+# key's record id with the order itself, and every run first asks recover()
+# for an order already placed under it: a holder that placed the order but
+# died or failed before storing the response is answered from that order
+# instead of placing it again.
+
+IDEMPOTENCY_TTL = timedelta(hours=float(os.environ.get('IDEMPOTENCY_TTL_HOURS', '24')))
+IDEMPOTENCY_LEASE_SECONDS = 30
+IDEMPOTENCY_WAIT_SECONDS = 30
+IDEMPOTENCY_RETRYABLE = {409, 429}
+
+def request_fingerprint(payload):
+    import hashlib
+
+    encoded = json.dumps(jsonable_encoder(payload), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+class IdempotencyStore:
+    def __init__(self, poll_seconds=0.1):
+        self.poll_seconds = poll_seconds
+        self._inflight = {}
+        self.stats = {"executed": 0, "replayed": 0, "waited": 0, "taken_over": 0, "recovered": 0, "mismatched": 0}
+
+    @property
+    def collection(self):
+        return db.idempotency_keys
+
+    async def setup(self):
+        await self.collection.create_index("expires_at", expireAfterSeconds=0)
+
+    def replay(self, record):
+        self.stats["replayed"] += 1
+        return Response(
+            content=record['body'],
+            status_code=record['status_code'],
+            media_type="application/json",
+            headers={"Idempotent-Replayed": "true"}
+        )
 
-    # Validate and apply coupon if provided
-    coupon = None
-    if order_data.coupon_code:
-        coupon = await db.coupons.find_one({
-            "code": order_data.coupon_code.upper(),
-            "status": "active",
-            "expires": {"$gte": datetime.now(timezone.utc).strftime("%Y-%m-%d")}
-        })
+    async def run(self, route, user_id, key, payload, work, recover=None):
+        """
+        Runs work(record_id) once per (route, user, key) and returns its
+        result, or the stored response for a key that already completed.
+        recover(record_id) returns the response of work that already landed,
+        or None; without a key work gets None.
+        """
+        from pymongo import ReturnDocument
+        from pymongo.errors import DuplicateKeyError
+
+        if not key:
+            return await work(None)
+        if len(key) > 255:
+            raise HTTPException(status_code=400, detail="Idempotency-Key must be at most 255 characters.")
+
+        record_id = f"{route}:{user_id}:{key}"
+        fingerprint = request_fingerprint(payload)
+        deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+
+        while time.monotonic() < deadline:
+            now = datetime.now(timezone.utc)
+            lease = {"status": "in_flight", "lease_until": now + timedelta(seconds=IDEMPOTENCY_LEASE_SECONDS)}
+            try:
+                await self.collection.insert_one({
+                    "_id": record_id, "fingerprint": fingerprint, "created_at": now,
+                    "expires_at": now + IDEMPOTENCY_TTL, **lease
+                })
+                return await self._execute(record_id, work, recover)
+            except DuplicateKeyError:
+                pass
 
-        if not coupon:
-            raise HTTPException(status_code=400, detail="Invalid or expired coupon code.")
+            record = await self.collection.find_one({"_id": record_id})
+            if record is None:
+                # The holder failed and removed its claim; try again
+                continue
+            if record['fingerprint'] != fingerprint:
+                self.stats["mismatched"] += 1
+                raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request.")
+            if record['status'] == "done":
+                return self.replay(record)
+
+            self.stats["waited"] += 1
+            local = self._inflight.get(record_id)
+            if local is not None:
+                try:
+                    await asyncio.wait_for(asyncio.shield(local), max(0.0, deadline - time.monotonic()))
+                except Exception:
+                    pass
+                continue
+
+            lease_until = record['lease_until']
+            if lease_until.tzinfo is None:
+                lease_until = lease_until.replace(tzinfo=timezone.utc)
+            if lease_until <= now:
+                taken = await self.collection.find_one_and_update(
+                    {"_id": record_id, "status": "in_flight", "lease_until": record['lease_until']},
+                    {"$set": lease},
+                    return_document=ReturnDocument.AFTER
+                )
+                if taken:
+                    self.stats["taken_over"] += 1
+                    return await self._execute(record_id, work, recover)
+                continue
+            await asyncio.sleep(self.poll_seconds)
+
+        raise HTTPException(
+            status_code=409,
+            detail="A request with this Idempotency-Key is still being processed. Retry shortly.",
+            headers={"Retry-After": "1"}
+        )
 
-        # Check usage limit
-        if coupon.get('usage', 0) >= coupon.get('limit', 0):
-            raise HTTPException(status_code=400, detail="Coupon usage limit exceeded.")
+    async def _execute(self, record_id, work, recover):
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[record_id] = future
+        try:
+            try:
+                result = await recover(record_id) if recover else None
+                if result is not None:
+                    self.stats["recovered"] += 1
+                else:
+                    result = await work(record_id)
+                    self.stats["executed"] += 1
+            except HTTPException as e:
+                if e.status_code in IDEMPOTENCY_RETRYABLE or e.status_code >= 500:
+                    await self.collection.delete_one({"_id": record_id})
+                else:
+                    await self._store(record_id, e.status_code, {"detail": e.detail})
+                raise
+            except BaseException:
+                await self.collection.delete_one({"_id": record_id})
+                raise
+            await self._store(record_id, 200, result)
+            return result
+        finally:
+            self._inflight.pop(record_id, None)
+            future.set_result(None)
+
+    async def _store(self, record_id, status_code, result):
+        await self.collection.update_one({"_id": record_id}, {"$set": {
+            "status": "done",
+            "status_code": status_code,
+            "body": json.dumps(jsonable_encoder(result)),
+            "completed_at": datetime.now(timezone.utc)
+        }})
+
+    def metrics(self):
+        return {**self.stats, "in_flight": len(self._inflight), "ttl_hours": IDEMPOTENCY_TTL.total_seconds() / 3600}
+
+idempotency_store = IdempotencyStore()
+
+# --- Order Pricing ---
+# Totals are computed by the server from the catalog, never taken from the
+# client. One $in query loads every ordered product; prices follow
+# sync_product_price, delivery follows each product's delivery_type rules
+# and the coupon is applied to the lines it covers, all in one pass. The
+# rules mirror what the storefront shows on the payment page.
+#
+# Quotes and /coupons/validate read coupons through the response cache,
+# misses included, tagged coupon:<CODE>. Checkout instead takes a use with
+# one conditional update (active, unexpired, usage < limit) before anything
+# else is written, and gives it back if the order then fails, so concurrent
+# checkouts cannot redeem a coupon past its limit.
+
+PLATFORM_FEE_RATE = float(os.environ.get('PLATFORM_FEE_RATE', '0.10'))
+# Products predating delivery_type ship free above this line total
+LEGACY_FREE_DELIVERY_ABOVE = 500.0
+LEGACY_DELIVERY_CHARGE = 40.0
+
+def line_delivery_charge(product, line_total):
+    delivery_type = product.get('delivery_type')
+    if not delivery_type:
+        return 0.0 if line_total >= LEGACY_FREE_DELIVERY_ABOVE else LEGACY_DELIVERY_CHARGE
+    if delivery_type == "free":
+        return 0.0
+    free_above = product.get('free_delivery_above') or 0.0
+    if delivery_type == "fixed" and free_above > 0 and line_total >= free_above:
+        return 0.0
+    return float(product.get('delivery_charge') or 0.0)
+
+def coupon_discount(coupon, eligible_subtotal):
+    """Discount for a coupon's "10%" / "₹100" value, capped at what it covers."""
+    value = str(coupon.get('discount', '')).strip()
+    amount = float(re.sub(r"[^\d.]", "", value) or 0)
+    if value.endswith("%"):
+        amount = eligible_subtotal * amount / 100
+    return round(min(amount, eligible_subtotal), 2)
+
+def active_coupon_query(code):
+    return {
+        "code": code.upper(),
+        "status": "active",
+        "expires": {"$gte": datetime.now(timezone.utc).strftime("%Y-%m-%d")}
+    }
 
-    order_obj = Order(
-        **order_data.model_dump(),
-        user_id=current_user['id']
-    )
+async def find_active_coupon(code):
+    return await db.coupons.find_one(active_coupon_query(code))
 
-    doc = order_obj.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
+async def lookup_coupon(code):
+    """Active coupon by code, or None, served from the response cache when possible."""
+    code = code.upper()
+    cache_key = ("coupon", code)
+    body = response_cache.get(cache_key)
+    if body is not None:
+        return json.loads(body) or None
+    started_at = time.monotonic()
 
-    await db.orders.insert_one(doc)
-
-    # Increment coupon usage if coupon was applied
+    coupon = await find_active_coupon(code)
     if coupon:
-        await db.coupons.update_one(
-            {"id": coupon['id']},
-            {"$inc": {"usage": 1}}
+        coupon['id'] = str(coupon.get('id') or coupon['_id'])
+        del coupon['_id']
+    response_cache.set(cache_key, coupon or {}, {f"coupon:{code}"}, CACHE_TTL["coupons"], started_at)
+    return coupon
+
+coupon_stats = {"redeemed": 0, "rejected": 0, "released": 0}
+
+async def redeem_coupon(code):
+    """
+    Takes one use of a coupon in a single conditional update and returns the
+    coupon as updated, or raises 400 if it is unknown, expired or used up.
+    """
+    from pymongo import ReturnDocument
+
+    coupon = await db.coupons.find_one_and_update(
+        {**active_coupon_query(code), "$expr": {"$lt": [{"$ifNull": ["$usage", 0]}, "$limit"]}},
+        {"$inc": {"usage": 1}},
+        return_document=ReturnDocument.AFTER
+    )
+    if coupon is None:
+        coupon_stats["rejected"] += 1
+        if await lookup_coupon(code):
+            raise HTTPException(status_code=400, detail="Coupon usage limit exceeded.")
+        raise HTTPException(status_code=400, detail="Invalid or expired coupon code.")
+
+    coupon_stats["redeemed"] += 1
+    if coupon['usage'] >= coupon['limit']:
+        # Let /coupons/validate report it as used up
+        await response_cache.purge(f"coupon:{coupon['code']}")
+    return coupon
+
+async def release_coupon(coupon):
+    """Gives back a use taken by redeem_coupon for an order that failed."""
+    await db.coupons.update_one({"_id": coupon['_id'], "usage": {"$gt": 0}}, {"$inc": {"usage": -1}})
+    coupon_stats["released"] += 1
+    if coupon['usage'] >= coupon['limit']:
+        await response_cache.purge(f"coupon:{coupon['code']}")
+
+async def price_order(lines, coupon_code=None, tip_amount=0.0, redeemed=None):
+    """
+    Authoritative order totals. Returns (quote, coupon) where coupon is the
+    applied coupon document, or raises 400/409 if a product or the coupon
+    can't be used. redeemed is the coupon checkout has already taken a use
+    of; without it the coupon is looked up and its limit checked.
+    """
+    if not lines:
+        raise HTTPException(status_code=400, detail="Order has no items.")
+    reservation_quantities(lines)
+
+    product_ids = list(dict.fromkeys(line.product_id for line in lines))
+    projection = {
+        **PRICE_PROJECTION,
+        **{field: 1 for field, _ in CART_SYNC_FIELDS},
+        "name": 1, "image": 1, "images": 1, "vendor_id": 1, "category": 1,
+    }
+    # Pending and rejected products are hidden from the catalog, so they can't be bought either
+    products = await db.products.find({"id": {"$in": product_ids}, "status": "approved"}, projection).to_list(None)
+    products = {p['id']: p for p in bulk_sync_product_prices(products)}
+    coupon = redeemed
+    if coupon_code and coupon is None:
+        coupon = await lookup_coupon(coupon_code)
+
+    missing = [pid for pid in product_ids if pid not in products]
+    if missing:
+        raise HTTPException(status_code=409, detail=f"No longer available: {', '.join(missing)}")
+
+    items = []
+    subtotal = delivery = 0.0
+    for line in lines:
+        product = products[line.product_id]
+        line_total = round(product['price'] * line.quantity, 2)
+        charge = line_delivery_charge(product, line_total)
+        subtotal += line_total
+        delivery += charge
+        items.append({
+            "product_id": line.product_id,
+            "name": product.get('name', ""),
+            "price": product['price'],
+            "quantity": line.quantity,
+            "image": product.get('image') or (product.get('images') or [""])[0],
+            "vendor_id": product.get('vendor_id') or "",
+            "line_total": line_total,
+            "delivery_charge": charge,
+        })
+    subtotal, delivery = round(subtotal, 2), round(delivery, 2)
+
+    discount = 0.0
+    if coupon_code:
+        if not coupon:
+            raise HTTPException(status_code=400, detail="Invalid or expired coupon code.")
+        if redeemed is None and coupon.get('usage', 0) >= coupon.get('limit', 0):
+            raise HTTPException(status_code=400, detail="Coupon usage limit exceeded.")
+        # Vendor coupons cover that vendor's lines only
+        eligible = [i for i in items if not coupon.get('vendor_id') or i['vendor_id'] == coupon['vendor_id']]
+        if not eligible:
+            raise HTTPException(status_code=400, detail="Coupon does not apply to these items.")
+        discount = coupon_discount(coupon, sum(i['line_total'] for i in eligible))
+
+    # Whole rupees, rounding halves up like the storefront
+    platform_fee = float(math.floor(subtotal * PLATFORM_FEE_RATE + 0.5))
+    tip_amount = max(0.0, float(tip_amount or 0.0))
+    quote = {
+        "items": items,
+        "subtotal": subtotal,
+        "delivery_charge": delivery,
+        "discount_amount": discount,
+        "platform_fee": platform_fee,
+        "tax_amount": 0.0,
+        "tip_amount": tip_amount,
+        "total_amount": round(subtotal + delivery - discount + platform_fee + tip_amount, 2),
+        "coupon_code": coupon['code'] if coupon else None,
+    }
+    return quote, coupon
+
+@api_router.post("/orders/quote")
+async def quote_order(body: OrderQuoteRequest, current_user: Annotated[dict, Depends(get_current_user)]):
+    quote, _ = await price_order(body.items, body.coupon_code, body.tip_amount)
+    return quote
+
+# --- Stock Reservations ---
+# Checkout takes stock with conditional decrements (stock >= qty) for every
+# line in one bulk write. Each decrement also records a hold on the product,
+# stock_holds.<reservation id> = qty, which makes the batch all-or-nothing:
+# if any line falls short, every line still carrying the hold gets its
+# quantity back, and releasing twice is harmless. A reservation made through
+# /orders/reserve is held for RESERVATION_TTL_SECONDS while the shopper pays;
+# the sweeper returns the stock of reservations that were never checked out.
+# Checkout clears the holds once the order is written.
+
+RESERVATION_TTL_SECONDS = int(os.environ.get('RESERVATION_TTL_SECONDS', '600'))
+# Grace given to checkout between claiming a reservation and writing the order
+RESERVATION_CLAIM_SECONDS = 300
+
+def reservation_quantities(lines):
+    """Quantity per product, summing lines for the same product."""
+    quantities = {}
+    for line in lines:
+        if line.quantity <= 0:
+            raise HTTPException(status_code=400, detail="Quantities must be positive.")
+        quantities[line.product_id] = quantities.get(line.product_id, 0) + line.quantity
+    return quantities
+
+async def set_stock_on_hand(query, on_hand):
+    """
+    Vendor stock writes. The vendor's figure counts units on hand, held ones
+    included, so the stored stock is on_hand minus the open holds: releasing
+    a hold later returns it to on_hand instead of inflating it. Stock may
+    sit below zero while holds exceed the new figure. The write is
+    conditional on the holds read, and retried if a reservation moves them.
+    Returns False when no product matches.
+    """
+    for _ in range(5):
+        product = await db.products.find_one(query, {"stock_holds": 1})
+        if not product:
+            return False
+        holds = product.get('stock_holds')
+        result = await db.products.update_one(
+            {"_id": product['_id'], "stock_holds": holds},
+            {"$set": {"stock": on_hand - sum((holds or {}).values())}}
         )
+        if result.matched_count:
+            return True
+    raise HTTPException(status_code=409, detail="Stock is changing, please try again.")
+
+class StockReservations:
+    def __init__(self, sweep_seconds):
+        self.sweep_seconds = sweep_seconds
+        self._task = None
+        self.stats = {"reserved": 0, "rejected": 0, "committed": 0, "released": 0, "swept": 0}
+
+    @property
+    def collection(self):
+        return db.stock_reservations
+
+    async def setup(self):
+        await self.collection.create_index("id", unique=True)
+        await self.collection.create_index([("status", 1), ("expires_at", 1)])
+        # Closed reservations are kept a week for reconciliation
+        await self.collection.create_index("closed_at", expireAfterSeconds=7 * 24 * 3600)
+
+    async def reserve(self, user_id, lines, ttl, status="held"):
+        """
+        Takes stock for every line or for none. Raises 409 naming the
+        products that are short.
+        """
+        from pymongo import UpdateOne
+
+        quantities = reservation_quantities(lines)
+        if not quantities:
+            raise HTTPException(status_code=400, detail="Nothing to reserve.")
+        now = datetime.now(timezone.utc)
+        reservation = {
+            "id": str(uuid.uuid4()),
+            "user_id": user_id,
+            "lines": [{"product_id": pid, "quantity": qty} for pid, qty in quantities.items()],
+            "status": status,
+            "created_at": now,
+            "expires_at": now + timedelta(seconds=ttl),
+        }
+        # Recorded first so a crash mid-batch still gets swept
+        await self.collection.insert_one(dict(reservation))
+
+        hold = f"stock_holds.{reservation['id']}"
+        result = await db.products.bulk_write([
+            UpdateOne(
+                {"id": pid, "stock": {"$gte": qty}},
+                {"$inc": {"stock": -qty}, "$set": {hold: qty}}
+            )
+            for pid, qty in quantities.items()
+        ], ordered=False)
+
+        if result.matched_count < len(quantities):
+            held = await db.products.find(
+                {"id": {"$in": list(quantities)}, hold: {"$exists": True}}, {"id": 1}
+            ).to_list(None)
+            short = sorted(set(quantities) - {p['id'] for p in held})
+            await self.release(reservation, status="rejected")
+            self.stats["rejected"] += 1
+            raise HTTPException(status_code=409, detail=f"Insufficient stock for: {', '.join(short)}")
+
+        self.stats["reserved"] += 1
+        await self.purge_cached_stock(quantities)
+        return reservation
+
+    async def claim(self, reservation_id, user_id, lines):
+        """Takes a held reservation for checkout; its lines must cover the order."""
+        from pymongo import ReturnDocument
 
-    # Increment product sales count
-    for item in order_data.items:
-        await db.products.update_one(
-            {"id": item.product_id},
-            {"$inc": {"sales_count": item.quantity}}
+        now = datetime.now(timezone.utc)
+        reservation = await self.collection.find_one_and_update(
+            {"id": reservation_id, "user_id": user_id, "status": "held", "expires_at": {"$gt": now}},
+            {"$set": {"status": "claimed", "expires_at": now + timedelta(seconds=RESERVATION_CLAIM_SECONDS)}},
+            return_document=ReturnDocument.AFTER
         )
+        if not reservation:
+            raise HTTPException(status_code=409, detail="Reservation expired or already used. Please try again.")
+        held = {line['product_id']: line['quantity'] for line in reservation['lines']}
+        if any(held.get(pid, 0) < qty for pid, qty in reservation_quantities(lines).items()):
+            await self.release(reservation, status="released")
+            raise HTTPException(status_code=409, detail="Order items do not match the reservation.")
+        return reservation
+
+    def commit_writes(self, reservation, order_id):
+        """
+        Transaction body steps that turn the holds into a sale. close runs
+        before the order is written and only matches a reservation still
+        claimed, so a sweep that already gave the stock back aborts the
+        order with 409; clear drops the holds once the order is in.
+        """
+        async def close(session):
+            result = await self.collection.update_one(
+                {"id": reservation['id'], "status": "claimed"},
+                {"$set": {"status": "committed", "order_id": order_id, "closed_at": datetime.now(timezone.utc)}},
+                session=session
+            )
+            if result.matched_count == 0:
+                raise HTTPException(status_code=409, detail="Reservation expired before the order was placed. Please try again.")
+
+        async def clear(session):
+            await db.products.update_many(
+                {"id": {"$in": [line['product_id'] for line in reservation['lines']]}},
+                {"$unset": {f"stock_holds.{reservation['id']}": ""}},
+                session=session
+            )
+            self.stats["committed"] += 1
+        return close, clear
+
+    async def release(self, reservation, status="released"):
+        """Returns the held stock; lines whose hold is already gone are skipped."""
+        from pymongo import UpdateOne
+
+        hold = f"stock_holds.{reservation['id']}"
+        await db.products.bulk_write([
+            UpdateOne(
+                {"id": line['product_id'], hold: line['quantity']},
+                {"$inc": {"stock": line['quantity']}, "$unset": {hold: ""}}
+            )
+            for line in reservation['lines']
+        ], ordered=False)
+        await self.collection.update_one(
+            {"id": reservation['id']},
+            {"$set": {"status": status, "closed_at": datetime.now(timezone.utc)}}
+        )
+        self.stats["released"] += 1
+        await self.purge_cached_stock(line['product_id'] for line in reservation['lines'])
 
-    # Trigger Notifications for order placement
-    # Notify User
-    await db.notifications.insert_one({
+    async def purge_cached_stock(self, product_ids):
+        """Cached product pages and listings show stock, so they go when it moves."""
+        await response_cache.purge(*(f"product:{pid}" for pid in product_ids))
+
+    async def sweep(self, limit=500):
+        """Releases reservations whose hold or checkout claim has lapsed."""
+        now = datetime.now(timezone.utc)
+        swept = 0
+        while swept < limit:
+            # Claim one at a time so concurrent sweepers never double-release
+            reservation = await self.collection.find_one_and_update(
+                {"status": {"$in": ["held", "claimed"]}, "expires_at": {"$lte": now}},
+                {"$set": {"status": "releasing"}}
+            )
+            if not reservation:
+                break
+            await self.release(reservation, status="expired")
+            swept += 1
+        self.stats["swept"] += swept
+        return swept
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.sweep_seconds)
+            try:
+                await self.sweep()
+            except Exception as e:
+                logging.error(f"Reservation sweep failed: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def metrics(self):
+        return {**self.stats, "ttl_seconds": RESERVATION_TTL_SECONDS, "sweep_seconds": self.sweep_seconds}
+
+stock_reservations = StockReservations(sweep_seconds=int(os.environ.get('RESERVATION_SWEEP_SECONDS', '30')))
+
+@api_router.post("/orders/reserve")
+async def reserve_stock(body: StockReservationCreate, current_user: Annotated[dict, Depends(get_current_user)]):
+    """Holds stock for the given lines while the shopper completes payment."""
+    reservation = await stock_reservations.reserve(current_user['id'], body.items, RESERVATION_TTL_SECONDS)
+    return {
+        "reservation_id": reservation['id'],
+        "expires_at": reservation['expires_at'].isoformat(),
+        "lines": reservation['lines'],
+    }
+
+@api_router.delete("/orders/reserve/{reservation_id}")
+async def cancel_reservation(reservation_id: str, current_user: Annotated[dict, Depends(get_current_user)]):
+    reservation = await stock_reservations.collection.find_one_and_update(
+        {"id": reservation_id, "user_id": current_user['id'], "status": "held"},
+        {"$set": {"status": "releasing"}}
+    )
+    if reservation:
+        await stock_reservations.release(reservation)
+    return {"message": "Reservation released."}
+
+@api_router.post("/orders/checkout")
+async def checkout(
+    order_data: OrderCreate,
+    request: Request,
+    response: Response,
+    current_user: Annotated[dict, Depends(get_current_user)],
+    idempotency_key: Annotated[Optional[str], Header()] = None
+):
+    async def place(idempotency_id):
+        # Inside the idempotent section so replayed retries are not rate limited
+        await enforce_rate_limit(
+            "checkout", f"user:{current_user['id']}", current_user.get('user_type'), response,
+            "Transaction limit exceeded. Deceleration protocol active."
+        )
+        return await place_order(order_data, current_user, idempotency_id)
+
+    async def recover(idempotency_id):
+        order = await db.orders.find_one({"idempotency_id": idempotency_id}, {"_id": 0})
+        return placed_order_response(order) if order else None
+
+    return await idempotency_store.run("checkout", current_user['id'], idempotency_key, order_data, place, recover)
+
+ORDER_QUOTE_FIELDS = ["subtotal", "delivery_charge", "discount_amount", "platform_fee", "tax_amount", "tip_amount", "total_amount", "coupon_code"]
+
+def placed_order_response(doc):
+    return {
+        "message": "Transaction authorized.",
+        "order_id": doc['id'],
+        **{k: doc.get(k) for k in ORDER_QUOTE_FIELDS}
+    }
+
+async def place_order(order_data: OrderCreate, current_user, idempotency_id=None):
+    # The coupon use is taken first and given back if the order goes no further
+    coupon = await redeem_coupon(order_data.coupon_code) if order_data.coupon_code else None
+    reservation = None
+    written = {}
+    try:
+        # Prices, delivery, coupon and totals come from the catalog, not the client
+        quote, coupon = await price_order(order_data.items, order_data.coupon_code, order_data.tip_amount, redeemed=coupon)
+        priced_items = [
+            OrderItem(**{**item.model_dump(), **{k: line[k] for k in ("name", "price", "image", "vendor_id")}})
+            for item, line in zip(order_data.items, quote['items'])
+        ]
+
+        order_obj = Order(
+            **{
+                **order_data.model_dump(),
+                **{k: quote[k] for k in ("total_amount", "tax_amount", "delivery_charge", "discount_amount", "platform_fee", "tip_amount", "coupon_code")},
+                "items": priced_items,
+            },
+            user_id=current_user['id']
+        )
+
+        # Take the stock before anything is written; a short line fails the order
+        if order_data.reservation_id:
+            reservation = await stock_reservations.claim(order_data.reservation_id, current_user['id'], order_data.items)
+        else:
+            reservation = await stock_reservations.reserve(
+                current_user['id'], order_data.items, RESERVATION_CLAIM_SECONDS, status="claimed"
+            )
+
+        doc = order_obj.model_dump()
+        doc['created_at'] = doc['created_at'].isoformat()
+        doc['reservation_id'] = reservation['id']
+        doc['subtotal'] = quote['subtotal']
+        if idempotency_id:
+            doc['idempotency_id'] = idempotency_id
+
+        await checkout_transactions.run(checkout_writes(doc, order_obj, current_user['id'], reservation, written))
+    except BaseException as e:
+        # Without a transaction an order already inserted keeps the stock and
+        # coupon use it took; only the steps after it are lost
+        if not written.get("order"):
+            if reservation:
+                await stock_reservations.release(reservation, status="failed")
+            if coupon:
+                await release_coupon(coupon)
+        if not written.get("order") or not isinstance(e, Exception):
+            raise
+        logging.error(f"Order {order_obj.id} placed but the writes after it failed: {e}")
+    
+    return placed_order_response(doc)
+
+def checkout_writes(doc, order_obj, user_id, reservation, written):
+    """
+    The order's writes as a transaction body: the conditional reservation
+    close, the order, one bulk write for every product's sales_count, one
+    insert_many for the customer and vendor notifications and the update
+    dropping the holds. The command count does not depend on the cart size.
+    Run without a transaction, written["order"] is set once the order is in
+    so a later failure is not compensated.
+    """
+    from pymongo import UpdateOne
+
+    # Lines for the same product count once, with their quantities summed
+    sold = {}
+    for item in order_obj.items:
+        sold[item.product_id] = sold.get(item.product_id, 0) + item.quantity
+    sales_updates = [UpdateOne({"id": pid}, {"$inc": {"sales_count": qty}}) for pid, qty in sold.items()]
+
+    now = datetime.now(timezone.utc).isoformat()
+    notifications = [{
         "id": str(uuid.uuid4()),
-        "user_id": current_user['id'],
+        "user_id": user_id,
         "title": "Order Protocol Authenticated",
         "message": f"Your transaction {order_obj.id} has been synchronized with the global ledger.",
         "type": "success",
         "is_read": False,
-        "created_at": datetime.now(timezone.utc).isoformat()
-    })
-
-    # Update product sales count for deals tracking
-    for item in order_data.items:
-        await db.products.update_one(
-            {"id": item.product_id},
-            {"$inc": {"sales_count": item.quantity}}
-        )
-    
-    # Notify Vendors
-    vendor_ids = {item.vendor_id for item in order_obj.items}
-    for v_id in vendor_ids:
-        await db.notifications.insert_one({
+        "created_at": now
+    }]
+    for v_id in dict.fromkeys(item.vendor_id for item in order_obj.items):
+        notifications.append({
             "id": str(uuid.uuid4()),
             "user_id": v_id,
             "title": "New Sales Protocol",
             "message": f"A new order {order_obj.id} has been received for your inventory.",
             "type": "info",
             "is_read": False,
-            "created_at": datetime.now(timezone.utc).isoformat()
+            "created_at": now
         })
-    
-    return {"message": "Transaction authorized.", "order_id": order_obj.id}
+
+    async def write(session):
+        await close_reservation(session)
+        await db.orders.insert_one(dict(doc), session=session)
+        if session is None:
+            written["order"] = True
+
+        if sales_updates:
+            await db.products.bulk_write(sales_updates, ordered=False, session=session)
+        await db.notifications.insert_many([dict(n) for n in notifications], ordered=False, session=session)
+        await clear_holds(session)
+
+    close_reservation, clear_holds = stock_reservations.commit_writes(reservation, order_obj.id)
+    return write
+
+class Transactions:
+    """
+    Runs multi-document writes in a MongoDB transaction. Transactions need a
+    replica set; with MONGO_TRANSACTIONS=auto the first refusal from a
+    standalone server switches to running the same writes without one.
+    """
+
+    def __init__(self, mode):
+        self.mode = mode
+        self.supported = {"on": True, "off": False}.get(mode)
+        self.stats = {"committed": 0, "without_transaction": 0}
+
+    async def run(self, work):
+        from pymongo.errors import ConfigurationError, OperationFailure
+
+        if self.supported is False:
+            self.stats["without_transaction"] += 1
+            return await work(None)
+        try:
+            async with await client.start_session() as session:
+                # with_transaction retries transient errors and unknown commits
+                result = await session.with_transaction(work)
+            self.supported = True
+            self.stats["committed"] += 1
+            return result
+        except (ConfigurationError, OperationFailure) as e:
+            standalone = getattr(e, 'code', None) == 20 or "replica set" in str(e)
+            if self.supported is not None or not standalone:
+                raise
+            logging.warning(f"MongoDB transactions unavailable, running writes without one: {e}")
+            self.supported = False
+            self.stats["without_transaction"] += 1
+            return await work(None)
+
+    def metrics(self):
+        return {**self.stats, "mode": self.mode, "supported": self.supported}
+
+checkout_transactions = Transactions(os.environ.get('MONGO_TRANSACTIONS', 'auto'))
 
 @api_router.post("/newsletter/subscribe")
 async def subscribe_newsletter(data: NewsletterCreate):
@@ -1631,13 +3364,558 @@ Message:
     
     return {"message": "Message sent successfully. We'll get back to you soon!"}
 
+# --- Response Cache ---
+# Anonymous catalog responses are identical for every visitor, so they are
+# cached as encoded JSON. Entries carry surrogate-key tags (product:<id>,
+# vendor:<id>, category:<slug>, ...) and writes purge exactly the tags they
+# affect. With several workers, purges are also published through a shared
+# backend so every worker drops its copies.
+
+class CacheEntry:
+    __slots__ = ("body", "expires_at", "tags", "size")
+
+    def __init__(self, body, expires_at, tags):
+        self.body = body
+        self.expires_at = expires_at
+        self.tags = tags
+        self.size = len(body)
+
+class LocalCacheBackend:
+    """Single worker: purges only need to reach this process."""
+
+    async def publish(self, tags):
+        pass
+
+    async def poll(self):
+        return []
+
+    async def setup(self):
+        pass
+
+class MongoCacheBackend:
+    """
+    Shares purges between workers through a small TTL collection. Each worker
+    publishes its purges and polls for the others', so a write on one worker
+    is visible everywhere within one poll interval.
+    """
+
+    def __init__(self, collection, retention_seconds=300):
+        self.collection = collection
+        self.retention_seconds = retention_seconds
+        self.origin = str(uuid.uuid4())
+        self.since = datetime.now(timezone.utc)
+        self.seen = {}
+
+    async def setup(self):
+        await self.collection.create_index("created_at", expireAfterSeconds=self.retention_seconds)
+
+    async def publish(self, tags):
+        await self.collection.insert_one({
+            "origin": self.origin,
+            "tags": list(tags),
+            "created_at": datetime.now(timezone.utc)
+        })
+
+    async def poll(self):
+        # Look back a little to tolerate clock skew between workers; ids
+        # already applied are skipped
+        cursor = self.collection.find({
+            "created_at": {"$gte": self.since - timedelta(seconds=5)},
+            "origin": {"$ne": self.origin}
+        }).sort("created_at", 1)
+        tags = []
+        async for doc in cursor:
+            if doc['_id'] in self.seen:
+                continue
+            self.seen[doc['_id']] = doc['created_at']
+            tags.extend(doc.get('tags', []))
+        now = datetime.now(timezone.utc)
+        self.since = now
+        cutoff = (now - timedelta(seconds=30)).replace(tzinfo=None)
+        self.seen = {k: v for k, v in self.seen.items() if v.replace(tzinfo=None) >= cutoff}
+        return tags
+
+class ResponseCache:
+    def __init__(self, max_bytes, backend=None, enabled=True, sync_seconds=1.0):
+        from collections import OrderedDict
+
+        self.max_bytes = max_bytes
+        self.backend = backend or LocalCacheBackend()
+        self.enabled = enabled
+        self.sync_seconds = sync_seconds
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._purged_at = {}
+        self._bytes = 0
+        self._task = None
+        self._listeners = []
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "purged_entries": 0, "stale_fills": 0}
+
+    def get(self, key):
+        """Returns the cached JSON body, or None on a miss."""
+        if not self.enabled:
+            return None
+        entry = self._entries.get(key)
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        if entry.expires_at <= time.monotonic():
+            self._remove(key)
+            self.stats["expirations"] += 1
+            self.stats["misses"] += 1
+            return None
+        self._entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return entry.body
+
+    def set(self, key, value, tags, ttl, started_at):
+        """
+        Encodes and stores value. started_at is the time.monotonic() taken
+        before the data was read; if any tag was purged since, the value may
+        predate the write and is not cached.
+        """
+        # Same encoding FastAPI's JSONResponse uses
+        body = json.dumps(jsonable_encoder(value), ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+        if not self.enabled:
+            return body
+        tags = frozenset(tags)
+        if any(self._purged_at.get(tag, -1.0) >= started_at for tag in tags):
+            self.stats["stale_fills"] += 1
+            return body
+        if len(body) > self.max_bytes // 8:
+            return body
+
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = CacheEntry(body, time.monotonic() + ttl, tags)
+        self._bytes += len(body)
+        for tag in tags:
+            self._tags.setdefault(tag, set()).add(key)
+
+        while self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.stats["evictions"] += 1
+        return body
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+        for tag in entry.tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def purge_local(self, tags):
+        now = time.monotonic()
+        for tag in tags:
+            self._purged_at[tag] = now
+            for key in list(self._tags.get(tag, ())):
+                self._remove(key)
+                self.stats["purged_entries"] += 1
+        # Fills in flight finish well within a minute
+        if len(self._purged_at) > 10000:
+            self._purged_at = {tag: at for tag, at in self._purged_at.items() if now - at < 60}
+        for listener in self._listeners:
+            try:
+                listener(tags)
+            except Exception as e:
+                logging.error(f"Cache purge listener failed: {e}")
+
+    def add_listener(self, listener):
+        """
+        Registers listener(tags), called for every purge applied on this
+        worker, local or received from another worker.
+        """
+        self._listeners.append(listener)
+
+    async def purge(self, *tags):
+        """Drops every entry carrying any of the tags, on all workers."""
+        tags = [tag for tag in tags if tag]
+        if not tags:
+            return
+        self.purge_local(tags)
+        try:
+            await self.backend.publish(tags)
+        except Exception as e:
+            logging.error(f"Failed to publish cache purge {tags}: {e}")
+
+    def metrics(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "hit_ratio": round(self.stats["hits"] / lookups, 4) if lookups else 0,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "backend": type(self.backend).__name__,
+        }
+
+    async def _sync(self):
+        while True:
+            try:
+                tags = await self.backend.poll()
+                if tags:
+                    self.purge_local(tags)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Cache purge sync failed: {e}")
+            await asyncio.sleep(self.sync_seconds)
+
+    async def start(self):
+        await self.backend.setup()
+        if self._task is None and not isinstance(self.backend, LocalCacheBackend):
+            self._task = asyncio.create_task(self._sync())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+def cached_json(body):
+    return Response(content=body, media_type="application/json")
+
+def product_tags(products):
+    """Tags for a response listing products: each product and its vendor."""
+    tags = set()
+    for p in products:
+        tags.add(f"product:{p.get('id')}")
+        if p.get('vendor_id'):
+            tags.add(f"vendor:{p['vendor_id']}")
+    return tags
+
+async def purge_product(product, listed=False):
+    """
+    Purges a product's cached responses. listed=True when the product may now
+    appear in listings it was not part of (approval, deal start), so category
+    listings are purged as well.
+    """
+    tags = [f"product:{product.get('id')}"]
+    if listed:
+        tags += [f"category:{product.get('category')}", "category:*"]
+    await response_cache.purge(*tags)
+
+CACHE_TTL = {
+    "products": 30,
+    "facets": 30,
+    "product": 60,
+    "categories": 300,
+    "stats": 60,
+    "reviews": 60,
+    "coupons": 30,
+}
+
+response_cache = ResponseCache(
+    max_bytes=int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', str(64 * 1024 * 1024))),
+    # Use "mongo" whenever more than one worker serves the API
+    backend=MongoCacheBackend(db.cache_invalidations) if os.environ.get('RESPONSE_CACHE_BACKEND') == 'mongo' else LocalCacheBackend(),
+    enabled=os.environ.get('RESPONSE_CACHE_ENABLED', '1') == '1'
+)
+
+# --- Product Search ---
+# In-process inverted index over approved products with BM25 ranking. Field
+# matches are weighted (a hit in the name counts more than one in the
+# category) and folded into a single term frequency per product. The index
+# is built at startup and follows product writes through the response
+# cache's purge stream, which every worker receives.
+
+SEARCH_FIELDS = {
+    "name": 3.0,
+    "brand": 2.0,
+    "search_tags": 2.0,
+    "category": 1.0,
+    "sub_category": 1.0,
+}
+SEARCH_HIGHLIGHT_FIELDS = ["name", "brand"]
+SEARCH_TOKEN_RE = re.compile(r"[^\W_]+")
+
+def search_stem(token):
+    """Folds common English plurals so 'phones' matches 'phone'."""
+    if len(token) > 4 and token.endswith("ies"):
+        return token[:-3] + "y"
+    if len(token) > 4 and token.endswith(("ses", "xes", "zes", "ches", "shes")):
+        return token[:-2]
+    if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+        return token[:-1]
+    return token
+
+def search_terms(text):
+    return [search_stem(token) for token in SEARCH_TOKEN_RE.findall(str(text).lower())]
+
+def search_field_text(p, field):
+    value = p.get(field)
+    if isinstance(value, list):
+        return " ".join(str(v) for v in value)
+    return value or ""
+
+class SearchIndex:
+    """
+    Products live in integer slots so scoring can run over NumPy arrays.
+    Postings are kept as dicts for cheap incremental updates and packed into
+    arrays lazily, the first time a changed term is queried.
+    """
+
+    def __init__(self, k1=1.2, b=0.75, max_prefix_terms=30):
+        self.k1 = k1
+        self.b = b
+        self.max_prefix_terms = max_prefix_terms
+        self._slots = {}
+        self._ids = []
+        self._free = []
+        self._tf = []
+        self._lengths = np.zeros(1024)
+        self._categories = np.zeros(1024, dtype=np.int32)
+        self._sub_categories = np.zeros(1024, dtype=np.int32)
+        self._codes = {None: 0}
+        self._total_length = 0.0
+        self._postings = {}
+        self._packed = {}
+        self._vocab = []
+        self._vocab_dirty = False
+        self._pending = set()
+        self._refresh_task = None
+        self._build_task = None
+        self.ready = asyncio.Event()
+
+    def __len__(self):
+        return len(self._slots)
+
+    def _code(self, value):
+        # Code 0 stands for "no value"; filters never ask for it
+        return self._codes.setdefault(value or None, len(self._codes))
+
+    def _allocate(self, product_id):
+        if self._free:
+            slot = self._free.pop()
+            self._ids[slot] = product_id
+            return slot
+        slot = len(self._ids)
+        self._ids.append(product_id)
+        self._tf.append(None)
+        if slot >= len(self._lengths):
+            size = len(self._lengths) * 2
+            self._lengths = np.resize(self._lengths, size)
+            self._categories = np.resize(self._categories, size)
+            self._sub_categories = np.resize(self._sub_categories, size)
+        return slot
+
+    def upsert(self, p):
+        """Indexes (or re-indexes) one approved product."""
+        product_id = p['id']
+        self.remove(product_id)
+
+        tf = {}
+        for field, weight in SEARCH_FIELDS.items():
+            for term in search_terms(search_field_text(p, field)):
+                tf[term] = tf.get(term, 0.0) + weight
+        if not tf:
+            return
+        slot = self._allocate(product_id)
+        self._slots[product_id] = slot
+        self._tf[slot] = tf
+        length = sum(tf.values())
+        self._lengths[slot] = length
+        self._categories[slot] = self._code(p.get('category'))
+        self._sub_categories[slot] = self._code(p.get('sub_category'))
+        self._total_length += length
+        for term, freq in tf.items():
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = {}
+                self._vocab_dirty = True
+            postings[slot] = freq
+            self._packed.pop(term, None)
+
+    def remove(self, product_id):
+        slot = self._slots.pop(product_id, None)
+        if slot is None:
+            return
+        tf = self._tf[slot]
+        self._total_length -= self._lengths[slot]
+        for term in tf:
+            postings = self._postings[term]
+            del postings[slot]
+            self._packed.pop(term, None)
+            if not postings:
+                del self._postings[term]
+                self._vocab_dirty = True
+        self._ids[slot] = None
+        self._tf[slot] = None
+        self._lengths[slot] = 0
+        self._free.append(slot)
+
+    def _arrays(self, term):
+        packed = self._packed.get(term)
+        if packed is None:
+            postings = self._postings[term]
+            slots = np.fromiter(postings.keys(), dtype=np.int64, count=len(postings))
+            freqs = np.fromiter(postings.values(), dtype=np.float64, count=len(postings))
+            packed = self._packed[term] = (slots, freqs)
+        return packed
+
+    def expand(self, term):
+        """Terms starting with term, for the word still being typed."""
+        import bisect
+
+        if self._vocab_dirty:
+            self._vocab = sorted(self._postings)
+            self._vocab_dirty = False
+        start = bisect.bisect_left(self._vocab, term)
+        matches = []
+        for candidate in self._vocab[start:start + self.max_prefix_terms]:
+            if not candidate.startswith(term):
+                break
+            matches.append(candidate)
+        return matches
+
+    def query_terms(self, q):
+        """
+        Stemmed query terms; the last word also matches as a prefix unless the
+        query ends with a space.
+        """
+        raw = SEARCH_TOKEN_RE.findall(q.lower())
+        terms = [search_stem(token) for token in raw]
+        if raw and not q[-1:].isspace():
+            prefix_terms = self.expand(raw[-1])
+            terms = terms[:-1] + ([terms[-1]] if terms[-1] in self._postings else []) + prefix_terms
+        return list(dict.fromkeys(terms))
+
+    def search(self, q, offset=0, limit=20, category=None, sub_category=None):
+        """Returns (total_matches, [(product_id, score), ...]) for one page."""
+        n = len(self._slots)
+        terms = [term for term in self.query_terms(q) if term in self._postings]
+        if n == 0 or not terms:
+            return 0, []
+        k1, b = self.k1, self.b
+        norm = k1 * (1 - b)
+        norm_per_length = k1 * b / (self._total_length / n)
+
+        # Every contribution is positive, so a non-zero score means a match
+        scores = np.zeros(len(self._ids))
+        for term in terms:
+            slots, freqs = self._arrays(term)
+            idf = math.log(1 + (n - len(slots) + 0.5) / (len(slots) + 0.5))
+            scores[slots] += idf * freqs * (k1 + 1) / (freqs + norm + norm_per_length * self._lengths[slots])
+
+        mask = scores > 0
+        if category:
+            mask &= self._categories[:len(scores)] == self._codes.get(category, -1)
+        if sub_category:
+            mask &= self._sub_categories[:len(scores)] == self._codes.get(sub_category, -1)
+        candidates = np.flatnonzero(mask)
+        total = len(candidates)
+
+        wanted = offset + limit
+        if total > wanted:
+            top = np.argpartition(-scores[candidates], wanted - 1)[:wanted]
+            candidates = candidates[top]
+        # Ties broken by slot so pages are stable
+        order = np.lexsort((candidates, -scores[candidates]))[offset:wanted]
+        return total, [(self._ids[slot], float(scores[slot])) for slot in candidates[order]]
+
+    def highlight(self, text, terms):
+        """HTML-escaped text with matching words wrapped in <mark>."""
+        text = str(text)
+        out = []
+        last = 0
+        for match in SEARCH_TOKEN_RE.finditer(text):
+            token = match.group().lower()
+            stem = search_stem(token)
+            if stem in terms:
+                out.append(html.escape(text[last:match.start()]))
+                out.append(f"<mark>{html.escape(match.group())}</mark>")
+                last = match.end()
+        if not out:
+            return None
+        out.append(html.escape(text[last:]))
+        return "".join(out)
+
+    async def build(self):
+        projection = {"_id": 0, "id": 1, **{field: 1 for field in SEARCH_FIELDS}}
+        count = 0
+        try:
+            async for p in db.products.find({"status": "approved", "id": {"$exists": True}}, projection):
+                self.upsert(p)
+                count += 1
+            logging.info(f"Search index built over {count} products")
+        except Exception as e:
+            logging.error(f"Search index build stopped after {count} products: {e}")
+        finally:
+            # Serve what was indexed rather than hang searches
+            self.ready.set()
+
+    def start(self):
+        """Builds in the background so startup is not held up by large catalogs."""
+        self._build_task = asyncio.create_task(self.build())
+
+    def on_purge(self, tags):
+        ids = {tag[len("product:"):] for tag in tags if tag.startswith("product:")}
+        if ids:
+            self._pending |= ids
+            if self._refresh_task is None or self._refresh_task.done():
+                self._refresh_task = asyncio.create_task(self._refresh())
+
+    async def _refresh(self):
+        """Re-reads changed products; anything no longer approved drops out."""
+        # Let the write that triggered the purge land first
+        await self.ready.wait()
+        while self._pending:
+            ids, self._pending = list(self._pending), set()
+            try:
+                projection = {"_id": 0, "id": 1, "status": 1, **{field: 1 for field in SEARCH_FIELDS}}
+                found = {p['id']: p for p in await db.products.find({"id": {"$in": ids}}, projection).to_list(None)}
+                for product_id in ids:
+                    p = found.get(product_id)
+                    if p and p.get('status') == 'approved':
+                        self.upsert(p)
+                    else:
+                        self.remove(product_id)
+            except Exception as e:
+                logging.error(f"Search index refresh failed: {e}")
+
+search_index = SearchIndex()
+response_cache.add_listener(search_index.on_purge)
+response_cache.add_listener(principal_cache.on_purge)
+
 # --- Product Endpoints ---
 
+def parse_offer_datetime(s):
+    if not s: return None
+    if isinstance(s, datetime):
+        return s if s.tzinfo else s.replace(tzinfo=timezone.utc)
+    dt = datetime.fromisoformat(s.replace('Z', '+00:00'))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt
+
+def normalize_product_datetimes(p):
+    """Normalize Datetimes for JSON consistency (Force UTC 'Z')"""
+    for key, value in p.items():
+        if isinstance(value, datetime):
+            if value.tzinfo is None:
+                value = value.replace(tzinfo=timezone.utc)
+            p[key] = value.isoformat().replace('+00:00', 'Z')
+    return p
+
 def sync_product_price(p):
     """
     Dynamically recalculates the product price based on whether 
     special offers are currently active.
     """
+    apply_product_price(p)
+
+    # 4. Normalize Datetimes for JSON consistency (Force UTC 'Z')
+    return normalize_product_datetimes(p)
+
+def apply_product_price(p):
+    """Sets the effective price fields on p, leaving its datetimes as they are."""
     base = p.get('base_price', 0.0)
     if base <= 0:
         base = p.get('originalPrice', p.get('price', 0.0))
@@ -1653,68 +3931,698 @@ def sync_product_price(p):
         normal_price -= n_val
     normal_price = max(0.0, normal_price)
 
-    # 2. Check if Special Offer is currently Active
-    is_deal_active = False
-    if p.get('special_offer_enabled'):
-        now = datetime.now(timezone.utc)
-        start_str = p.get('special_offer_start')
-        end_str = p.get('special_offer_end')
-        
-        is_timing_pass = True
-        try:
-            def parse_dt(s):
-                if not s: return None
-                if isinstance(s, datetime):
-                    return s if s.tzinfo else s.replace(tzinfo=timezone.utc)
-                dt = datetime.fromisoformat(s.replace('Z', '+00:00'))
-                if dt.tzinfo is None:
-                    dt = dt.replace(tzinfo=timezone.utc)
-                return dt
+    # 2. Check if Special Offer is currently Active
+    is_deal_active = False
+    if p.get('special_offer_enabled'):
+        now = datetime.now(timezone.utc)
+        start_str = p.get('special_offer_start')
+        end_str = p.get('special_offer_end')
+        
+        is_timing_pass = True
+        try:
+            parse_dt = parse_offer_datetime
+
+            if start_str:
+                start = parse_dt(start_str)
+                if start and now < start: is_timing_pass = False
+            if end_str and is_timing_pass:
+                end = parse_dt(end_str)
+                if end and now > end: is_timing_pass = False
+            
+            # Check legacy expiration field as well
+            exp_str = p.get('offer_expires_at')
+            if exp_str and is_timing_pass:
+                exp = parse_dt(exp_str)
+                if exp and now > exp: is_timing_pass = False
+        except Exception:
+            is_timing_pass = False 
+            
+        if is_timing_pass:
+            is_deal_active = True
+
+    # 3. Final Price Determination
+    final_price = normal_price
+    if is_deal_active:
+        s_type = p.get('special_offer_type', 'percentage')
+        s_val = p.get('special_offer_value', 0.0)
+        if s_type == "percentage":
+            final_price -= (normal_price * (s_val / 100))
+        else:
+            final_price -= s_val
+    
+    p['price'] = max(0.0, round(final_price, 2))
+    p['originalPrice'] = base
+    p['is_special_active'] = is_deal_active
+    if base > 0:
+        p['discount'] = int(round(((base - p['price']) / base) * 100))
+    else:
+        p['discount'] = 0
+    return p
+
+# --- Bulk Price Engine ---
+# Columnar version of sync_product_price for pricing many products at once
+# (cart sync, refresh-prices, the deal scheduler). It must stay bit-for-bit
+# compatible with the scalar path, so every step mirrors the float64
+# operations sync_product_price performs, in the same order.
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+# Below this many products the array setup costs more than it saves (about
+# 30 in bench_pricing.py), so carts and single products take the scalar path
+BULK_PRICING_MIN_PRODUCTS = 32
+
+@functools.lru_cache(maxsize=4096)
+def offer_datetime_us(value):
+    """
+    Offer timestamp as integer microseconds since the epoch. Returns None when
+    unset and raises ValueError when unparseable, like parse_offer_datetime.
+    Campaigns share offer windows across many products, so parses are cached.
+    """
+    dt = parse_offer_datetime(value)
+    if dt is None:
+        return None
+    return (dt - EPOCH) // timedelta(microseconds=1)
+
+def round_prices(values):
+    """
+    Python's round(x, 2) over an array. rint(x * 100) / 100 gives the same
+    result except where x * 100 lands within rounding error of a .5 tie;
+    those few values go through the scalar round.
+    """
+    scaled = values * 100
+    rounded = np.rint(scaled) / 100
+    frac = np.abs(scaled - np.floor(scaled) - 0.5)
+    suspect = ~np.isfinite(scaled) | (frac <= np.abs(scaled) * 1e-12 + 1e-12)
+    for i in np.flatnonzero(suspect):
+        rounded[i] = round(float(values[i]), 2)
+    return rounded
+
+def bulk_sync_product_prices(products, now=None):
+    """
+    Sets price, originalPrice, discount and is_special_active on every product
+    in one vectorized pass. Unlike sync_product_price it leaves datetime
+    fields untouched. Returns the same list.
+    """
+    n = len(products)
+    if n == 0:
+        return products
+    if n < BULK_PRICING_MIN_PRODUCTS and now is None:
+        for p in products:
+            apply_product_price(p)
+        return products
+    now = now or datetime.now(timezone.utc)
+    now_us = (now - EPOCH) // timedelta(microseconds=1)
+
+    # Columns are gathered as Python lists and converted once; per-element
+    # writes into NumPy arrays cost more than the arithmetic saves
+    originals = []
+    normal_pct, normal_val = [], []
+    special_pct, special_val = [], []
+    # Int base and fixed int discounts keep the scalar price an int
+    normal_int, special_int = [], []
+    enabled = []
+    window_ok = []
+    # Missing bounds never close the window
+    open_start, open_end = int(np.iinfo(np.int64).min), int(np.iinfo(np.int64).max)
+    start_us, end_us = [], []
+
+    for p in products:
+        b = p.get('base_price', 0.0)
+        if b <= 0:
+            b = p.get('originalPrice', p.get('price', 0.0))
+            p['base_price'] = b
+        originals.append(b)
+        n_pct = p.get('normal_discount_type', 'percentage') == "percentage"
+        n_val = p.get('normal_discount_value', 0.0)
+        s_pct = p.get('special_offer_type', 'percentage') == "percentage"
+        s_val = p.get('special_offer_value', 0.0)
+        normal_pct.append(n_pct)
+        normal_val.append(n_val)
+        special_pct.append(s_pct)
+        special_val.append(s_val)
+        normal_int.append(isinstance(b, int) and not n_pct and isinstance(n_val, int))
+        special_int.append(not s_pct and isinstance(s_val, int))
+        is_enabled = bool(p.get('special_offer_enabled'))
+        enabled.append(is_enabled)
+        start, end, ok = open_start, open_end, True
+        if is_enabled:
+            try:
+                parsed_start = offer_datetime_us(p.get('special_offer_start'))
+                ends = [offer_datetime_us(p.get(field)) for field in ('special_offer_end', 'offer_expires_at')]
+            except Exception:
+                ok = False
+            else:
+                if parsed_start is not None:
+                    start = parsed_start
+                ends = [e for e in ends if e is not None]
+                if ends:
+                    end = min(ends)
+        window_ok.append(ok)
+        start_us.append(start)
+        end_us.append(end)
+
+    base = np.array(originals, dtype=np.float64)
+    normal_pct = np.array(normal_pct, dtype=bool)
+    normal_val = np.array(normal_val, dtype=np.float64)
+    special_pct = np.array(special_pct, dtype=bool)
+    special_val = np.array(special_val, dtype=np.float64)
+    enabled = np.array(enabled, dtype=bool)
+    window_ok = np.array(window_ok, dtype=bool)
+    start_us = np.array(start_us, dtype=np.int64)
+    end_us = np.array(end_us, dtype=np.int64)
+
+    # 1. Normal price
+    normal_price = np.where(normal_pct, base - base * (normal_val / 100), base - normal_val)
+    normal_price = np.where(normal_price > 0.0, normal_price, 0.0)
+
+    # 2. Deal activity: start <= now <= earliest end
+    active = enabled & window_ok & (start_us <= now_us) & (now_us <= end_us)
+
+    # 3. Final price and discount
+    special_price = np.where(special_pct, normal_price - normal_price * (special_val / 100), normal_price - special_val)
+    final_price = np.where(active, special_price, normal_price)
+    price = round_prices(final_price)
+    price = np.where(price > 0.0, price, 0.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        discount = np.where(base > 0, np.rint(((base - price) / base) * 100), 0)
+    # Where sync_product_price stays in int arithmetic (max(0.0, x) keeps an
+    # int x > 0), its price is an int
+    is_int = (
+        np.array(normal_int, dtype=bool) & (normal_price > 0.0)
+        & (~active | np.array(special_int, dtype=bool)) & (price > 0.0)
+    )
+
+    for p, original, pr, disc, act, whole in zip(products, originals, price.tolist(), discount.tolist(), active.tolist(), is_int.tolist()):
+        p['price'] = int(pr) if whole else pr
+        p['originalPrice'] = original
+        p['is_special_active'] = act
+        p['discount'] = int(disc)
+    return products
+
+# --- Deal Scheduler ---
+# Stored price, discount and is_special_active are the effective values.
+# The scheduler keeps a time-ordered heap of upcoming offer start/end/expiry
+# boundaries and rewrites the affected products in bulk when one passes, so
+# read paths and price sorting can trust the stored fields.
+#
+# Every worker starts a scheduler but only the holder of the deal_scheduler
+# lease in db.scheduler_leases runs passes. Writes on other workers only
+# reach their own heap, so the holder also polls every DEAL_POLL_SECONDS for
+# products whose stored deal state disagrees with their materialized offer
+# window (deal_starts_at / deal_ends_at) and reprices those.
+
+DEAL_LEASE_ID = "deal_scheduler"
+
+def stale_deal_query(now):
+    """Products whose stored is_special_active no longer matches their window."""
+    active = active_deal_filter(now)
+    return {
+        # Windows not materialized yet are left to the full rescan
+        "deal_ends_at": {"$exists": True},
+        "$or": [
+            {**active, "is_special_active": {"$ne": True}},
+            {"is_special_active": True, "$nor": [active]},
+        ]
+    }
+
+# Inputs to sync_product_price. The scheduler only writes its result if
+# none of these changed since it read the product (compare-and-set).
+PRICE_INPUT_FIELDS = [
+    "base_price", "normal_discount_type", "normal_discount_value",
+    "special_offer_enabled", "special_offer_type", "special_offer_value",
+    "special_offer_start", "special_offer_end", "offer_expires_at"
+]
+PRICE_OUTPUT_FIELDS = ["price", "originalPrice", "discount", "is_special_active"]
+PRICE_PROJECTION = {field: 1 for field in ["id", *PRICE_INPUT_FIELDS, *PRICE_OUTPUT_FIELDS]}
+
+def deal_transitions(p, now):
+    """Returns the future instants at which the product's deal state can flip."""
+    if not p.get('special_offer_enabled'):
+        return []
+    transitions = []
+    for field in ("special_offer_start", "special_offer_end", "offer_expires_at"):
+        try:
+            when = parse_offer_datetime(p.get(field))
+        except Exception:
+            continue
+        if not when:
+            continue
+        # Offers stay active through their end instant and flip just after it
+        if field != "special_offer_start":
+            when += timedelta(milliseconds=1)
+        if when > now:
+            transitions.append(when)
+    return transitions
+
+class DealScheduler:
+    def __init__(self, rescan_seconds: int = 300, poll_seconds: int = 5, lease_seconds: int = 30):
+        self.rescan_seconds = rescan_seconds
+        self.poll_seconds = poll_seconds
+        self.lease_seconds = lease_seconds
+        self.owner = str(uuid.uuid4())
+        self.is_leader = False
+        self._heap = []
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.stats = {"rescans": 0, "boundary_passes": 0, "polled_reprices": 0}
+
+    def schedule(self, p):
+        """Queues the product's upcoming deal boundaries (call after writes)."""
+        if not p.get('id'):
+            return
+        now = datetime.now(timezone.utc)
+        for when in deal_transitions(p, now):
+            heapq.heappush(self._heap, (when, p['id']))
+        self._wakeup.set()
+
+    async def reprice(self, query):
+        """
+        Recomputes the effective price of every product matching query and
+        bulk-writes the ones whose stored values are stale. Returns the docs.
+        """
+        from pymongo import UpdateOne
+
+        projection = {field: 1 for field in ["id", "vendor_id", "category", "originalPrice", *PRICE_INPUT_FIELDS, *PRICE_OUTPUT_FIELDS]}
+        docs = await db.products.find(query, projection).to_list(None)
+
+        docs = [doc for doc in docs if doc.get('id')]
+        synced_docs = bulk_sync_product_prices([dict(doc) for doc in docs])
+
+        ops = []
+        changed = []
+        for doc, synced in zip(docs, synced_docs):
+            stored = {field: doc.get(field) for field in PRICE_OUTPUT_FIELDS}
+            inputs = {field: doc.get(field) for field in PRICE_INPUT_FIELDS}
+            effective = {field: synced.get(field) for field in PRICE_OUTPUT_FIELDS}
+            if effective != stored:
+                ops.append(UpdateOne({"id": doc['id'], **inputs}, {"$set": effective}))
+                changed.append(doc)
+
+        for i in range(0, len(ops), 1000):
+            await db.products.bulk_write(ops[i:i + 1000], ordered=False)
+        # Deals starting or ending change prices and deal listings
+        tags = set()
+        for doc in changed:
+            tags |= {f"product:{doc['id']}", f"category:{doc.get('category')}", "category:*"}
+        await response_cache.purge(*tags)
+        return changed
+
+    async def rescan(self):
+        """Full pass over deal products; rebuilds the boundary heap."""
+        query = {"$or": [
+            {"special_offer_enabled": True},
+            {"is_special_active": True},
+            {"is_special_active": {"$exists": False}}
+        ]}
+        await self.reprice(query)
+
+        now = datetime.now(timezone.utc)
+        heap = []
+        projection = {"id": 1, "special_offer_enabled": 1, "special_offer_start": 1, "special_offer_end": 1, "offer_expires_at": 1}
+        async for p in db.products.find({"special_offer_enabled": True}, projection):
+            if p.get('id'):
+                heap.extend((when, p['id']) for when in deal_transitions(p, now))
+        heapq.heapify(heap)
+        self._heap = heap
+        self.stats["rescans"] += 1
+
+    async def acquire_lease(self):
+        """Takes or renews the scheduler lease. Returns whether this worker holds it."""
+        from pymongo.errors import DuplicateKeyError
+
+        now = datetime.now(timezone.utc)
+        try:
+            await db.scheduler_leases.update_one(
+                {"_id": DEAL_LEASE_ID, "$or": [{"owner": self.owner}, {"expires_at": {"$lte": now}}]},
+                {"$set": {"owner": self.owner, "expires_at": now + timedelta(seconds=self.lease_seconds)}},
+                upsert=True
+            )
+            self.is_leader = True
+        except DuplicateKeyError:
+            # Held by a live worker: the upsert collided with its document
+            self.is_leader = False
+        return self.is_leader
+
+    async def poll(self):
+        """Reprices products whose deal boundary passed without reaching this heap."""
+        changed = await self.reprice(stale_deal_query(datetime.now(timezone.utc)))
+        if changed:
+            self.stats["polled_reprices"] += len(changed)
+            logging.info(f"Deal scheduler repriced {len(changed)} products scheduled on other workers")
+        return changed
+
+    async def _run(self):
+        next_rescan = datetime.now(timezone.utc)
+        while True:
+            try:
+                now = datetime.now(timezone.utc)
+                was_leader = self.is_leader
+                if await self.acquire_lease():
+                    # A new holder's heap may be stale, so start from a full pass
+                    if not was_leader or now >= next_rescan:
+                        await self.rescan()
+                        next_rescan = now + timedelta(seconds=self.rescan_seconds)
+                    else:
+                        await self.poll()
+
+                    due = set()
+                    while self._heap and self._heap[0][0] <= datetime.now(timezone.utc):
+                        due.add(heapq.heappop(self._heap)[1])
+                    if due:
+                        await self.reprice({"id": {"$in": list(due)}})
+                        self.stats["boundary_passes"] += 1
+                        logging.info(f"Deal scheduler repriced {len(due)} products at a deal boundary")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Deal scheduler pass failed: {e}")
+
+            # Sleep until the next boundary, rescan, poll or lease retry, or a new schedule
+            wake_at = datetime.now(timezone.utc) + timedelta(seconds=self.poll_seconds)
+            if self.is_leader:
+                wake_at = min(wake_at, next_rescan)
+                if self._heap and self._heap[0][0] < wake_at:
+                    wake_at = self._heap[0][0]
+            timeout = max(0.0, (wake_at - datetime.now(timezone.utc)).total_seconds())
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.is_leader:
+            # Hand over without waiting for the lease to lapse
+            await db.scheduler_leases.delete_one({"_id": DEAL_LEASE_ID, "owner": self.owner})
+            self.is_leader = False
+
+    def metrics(self):
+        return {**self.stats, "is_leader": self.is_leader, "queued_boundaries": len(self._heap), "poll_seconds": self.poll_seconds}
+
+# Offer windows that fail to parse are stored as long ended, matching
+# sync_product_price which treats them as inactive
+DEAL_WINDOW_INVALID = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def materialize_deal_window(p):
+    """
+    Stores the offer window as BSON dates so deal activity can be filtered and
+    sorted in the database. deal_ends_at is the earlier of special_offer_end
+    and the legacy offer_expires_at. Call after sync_product_price, which
+    turns datetimes back into strings.
+    """
+    try:
+        starts_at = parse_offer_datetime(p.get('special_offer_start'))
+        ends = [parse_offer_datetime(p.get(field)) for field in ('special_offer_end', 'offer_expires_at')]
+        ends = [end for end in ends if end]
+        ends_at = min(ends) if ends else None
+    except Exception:
+        starts_at, ends_at = None, DEAL_WINDOW_INVALID
+    p['deal_starts_at'] = starts_at
+    p['deal_ends_at'] = ends_at
+    return p
+
+def active_deal_filter(now=None):
+    """Query predicate equivalent to is_special_active at the given instant."""
+    now = now or datetime.now(timezone.utc)
+    return {
+        "special_offer_enabled": True,
+        # $not also matches documents with no start/end, i.e. open windows
+        "deal_starts_at": {"$not": {"$gt": now}},
+        "deal_ends_at": {"$not": {"$lt": now}},
+    }
+
+def stored_product_price(p):
+    """
+    Read-path counterpart of sync_product_price: serves the effective price
+    the deal scheduler materialized, computing live only for documents it
+    has not priced yet.
+    """
+    if 'is_special_active' not in p or p.get('price') is None:
+        return sync_product_price(p)
+    return normalize_product_datetimes(p)
+
+deal_scheduler = DealScheduler(
+    rescan_seconds=int(os.environ.get('DEAL_RESCAN_SECONDS', '300')),
+    poll_seconds=int(os.environ.get('DEAL_POLL_SECONDS', '5'))
+)
+
+async def resolve_vendors(vendor_ids):
+    """
+    Resolves raw product vendor_ids to vendor documents in a fixed number of
+    queries. Lookup precedence matches the legacy per-product chain:
+    vendors.id, users.id, then vendors._id and users._id for ObjectId strings.
+    """
+    from bson import ObjectId
+
+    pending = {str(v_id) for v_id in vendor_ids if v_id}
+    resolved = {}
+    if not pending:
+        return resolved
+
+    async for v in db.vendors.find({"id": {"$in": list(pending)}}):
+        resolved.setdefault(v['id'], v)
+    pending -= resolved.keys()
+
+    if pending:
+        async for v in db.users.find({"id": {"$in": list(pending)}}):
+            resolved.setdefault(v['id'], v)
+        pending -= resolved.keys()
+
+    object_ids = {}
+    for v_id in pending:
+        try:
+            object_ids[ObjectId(v_id)] = v_id
+        except Exception:
+            pass
+
+    if object_ids:
+        async for v in db.vendors.find({"_id": {"$in": list(object_ids)}}):
+            resolved.setdefault(object_ids[v['_id']], v)
+        remaining = [o for o, v_id in object_ids.items() if v_id not in resolved]
+        if remaining:
+            async for v in db.users.find({"_id": {"$in": remaining}}):
+                resolved.setdefault(object_ids[v['_id']], v)
+
+    return resolved
+
+# --- Rating Summaries ---
+# Each product carries rating_sum, rating_count and a 1-5 star
+# rating_histogram that are $inc'd when a review is written, so read paths
+# never have to load review documents to compute averages.
+
+RATING_STARS = ("1", "2", "3", "4", "5")
+
+def empty_rating_summary():
+    return {"rating_sum": 0, "rating_count": 0, "rating_histogram": {star: 0 for star in RATING_STARS}}
+
+def rating_summary_inc(rating, direction=1):
+    """Builds the $inc document that applies (or reverts) one review."""
+    inc = {"rating_sum": rating * direction, "rating_count": direction}
+    star = str(int(rating))
+    if star in RATING_STARS:
+        inc[f"rating_histogram.{star}"] = direction
+    return inc
+
+def product_rating(p):
+    """Returns (average, count) from a product's stored rating summary."""
+    count = p.get('rating_count') or 0
+    if not count:
+        return 0, 0
+    return round((p.get('rating_sum') or 0) / count, 1), count
+
+def rating_histogram(p):
+    stored = p.get('rating_histogram') or {}
+    return {star: stored.get(star, 0) for star in RATING_STARS}
+
+async def aggregate_review_summaries(product_ids=None):
+    """
+    Recomputes rating summaries from the reviews collection in one aggregation.
+    Returns {product_id: summary}; used by the backfill and drift reconciliation.
+    """
+    pipeline = []
+    if product_ids is not None:
+        pipeline.append({"$match": {"product_id": {"$in": list(product_ids)}}})
+    group = {"_id": "$product_id", "rating_sum": {"$sum": "$rating"}, "rating_count": {"$sum": 1}}
+    for star in RATING_STARS:
+        group[f"star_{star}"] = {"$sum": {"$cond": [{"$eq": ["$rating", int(star)]}, 1, 0]}}
+    pipeline.append({"$group": group})
+
+    summaries = {}
+    async for row in db.reviews.aggregate(pipeline):
+        summaries[row['_id']] = {
+            "rating_sum": row['rating_sum'],
+            "rating_count": row['rating_count'],
+            "rating_histogram": {star: row[f"star_{star}"] for star in RATING_STARS}
+        }
+    return summaries
+
+async def reconcile_rating_summaries(fix: bool = False):
+    """
+    Compares every product's stored rating summary with the reviews collection.
+    Reports drifted product ids and, when fix is set, rewrites them in bulk.
+    Doubles as the one-shot backfill for products that predate summaries.
+    """
+    from pymongo import UpdateOne
+
+    summaries = await aggregate_review_summaries()
+    drifted = []
+    checked = 0
+    cursor = db.products.find({}, {"id": 1, "rating_sum": 1, "rating_count": 1, "rating_histogram": 1})
+    async for p in cursor:
+        if not p.get('id'):
+            continue
+        checked += 1
+        expected = summaries.get(p['id'], empty_rating_summary())
+        stored = {
+            "rating_sum": p.get('rating_sum'),
+            "rating_count": p.get('rating_count'),
+            "rating_histogram": p.get('rating_histogram')
+        }
+        if stored != expected:
+            drifted.append((p['id'], expected))
+
+    if fix and drifted:
+        ops = [UpdateOne({"id": p_id}, {"$set": expected}) for p_id, expected in drifted]
+        for i in range(0, len(ops), 1000):
+            await db.products.bulk_write(ops[i:i + 1000], ordered=False)
+
+    return {
+        "checked": checked,
+        "drifted": len(drifted),
+        "drifted_ids": [p_id for p_id, _ in drifted[:100]],
+        "fixed": fix
+    }
+
+# --- Vendor Stats ---
+# One vendor_stats document per vendor holds review_count, rating_sum,
+# product_count and approved_product_count. Product and review writes apply
+# deltas so the business rating and dashboard counts are a single lookup.
+
+async def bump_vendor_stats(vendor_id, **deltas):
+    deltas = {k: v for k, v in deltas.items() if v}
+    if not vendor_id or not deltas:
+        return
+    await db.vendor_stats.update_one(
+        {"vendor_id": vendor_id},
+        {"$inc": deltas, "$set": {"updated_at": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+
+def vendor_business_rating(stats):
+    """Returns (rating, review_count) from a vendor_stats document."""
+    count = (stats or {}).get('review_count') or 0
+    if not count:
+        return 0, 0
+    return round((stats.get('rating_sum') or 0) / count, 1), count
+
+async def reconcile_vendor_stats(fix: bool = False):
+    """
+    Rebuilds vendor_stats from the products collection (using the products'
+    rating summaries) and reports vendors whose stored rollup has drifted.
+    """
+    from pymongo import UpdateOne
+
+    pipeline = [
+        {"$match": {"vendor_id": {"$nin": [None, ""]}}},
+        {"$group": {
+            "_id": "$vendor_id",
+            "product_count": {"$sum": 1},
+            "approved_product_count": {"$sum": {"$cond": [{"$eq": ["$status", "approved"]}, 1, 0]}},
+            "review_count": {"$sum": "$rating_count"},
+            "rating_sum": {"$sum": "$rating_sum"}
+        }}
+    ]
+    expected = {}
+    async for row in db.products.aggregate(pipeline):
+        vendor_id = row.pop('_id')
+        expected[vendor_id] = row
+
+    fields = ("product_count", "approved_product_count", "review_count", "rating_sum")
+    drifted = []
+    seen = set()
+    async for stats in db.vendor_stats.find({}, {"_id": 0}):
+        vendor_id = stats['vendor_id']
+        seen.add(vendor_id)
+        want = expected.get(vendor_id, dict.fromkeys(fields, 0))
+        if any((stats.get(f) or 0) != want[f] for f in fields):
+            drifted.append((vendor_id, want))
+    drifted.extend((v_id, want) for v_id, want in expected.items() if v_id not in seen)
+
+    if fix and drifted:
+        now = datetime.now(timezone.utc)
+        ops = [
+            UpdateOne({"vendor_id": v_id}, {"$set": {**want, "updated_at": now}}, upsert=True)
+            for v_id, want in drifted
+        ]
+        for i in range(0, len(ops), 1000):
+            await db.vendor_stats.bulk_write(ops[i:i + 1000], ordered=False)
+
+    return {
+        "checked": len(seen | expected.keys()),
+        "drifted": len(drifted),
+        "drifted_ids": [v_id for v_id, _ in drifted[:100]],
+        "fixed": fix
+    }
+
+async def enrich_products(products):
+    """
+    Attaches vendor, rating, reviews and reviewsCount to a page of products.
+    Runs a constant number of queries regardless of page size instead of the
+    per-product vendor and review lookups.
+    """
+    if not products:
+        return products
+
+    vendors = await resolve_vendors(p.get('vendor_id') for p in products)
 
-            if start_str:
-                start = parse_dt(start_str)
-                if start and now < start: is_timing_pass = False
-            if end_str and is_timing_pass:
-                end = parse_dt(end_str)
-                if end and now > end: is_timing_pass = False
-            
-            # Check legacy expiration field as well
-            exp_str = p.get('offer_expires_at')
-            if exp_str and is_timing_pass:
-                exp = parse_dt(exp_str)
-                if exp and now > exp: is_timing_pass = False
-        except Exception:
-            is_timing_pass = False 
-            
-        if is_timing_pass:
-            is_deal_active = True
+    vendor_real_ids = {}
+    for raw_id, vendor in vendors.items():
+        vendor_real_ids[raw_id] = vendor.get('id') or str(vendor.get('_id'))
 
-    # 3. Final Price Determination
-    final_price = normal_price
-    if is_deal_active:
-        s_type = p.get('special_offer_type', 'percentage')
-        s_val = p.get('special_offer_value', 0.0)
-        if s_type == "percentage":
-            final_price -= (normal_price * (s_val / 100))
-        else:
-            final_price -= s_val
-    
-    p['price'] = max(0.0, round(final_price, 2))
-    p['originalPrice'] = base
-    p['is_special_active'] = is_deal_active
-    if base > 0:
-        p['discount'] = int(round(((base - p['price']) / base) * 100))
-    else:
-        p['discount'] = 0
+    vendor_stats = {}
+    if vendor_real_ids:
+        cursor = db.vendor_stats.find({"vendor_id": {"$in": list(set(vendor_real_ids.values()))}})
+        async for stats in cursor:
+            vendor_stats[stats['vendor_id']] = stats
 
-    # 4. Normalize Datetimes for JSON consistency (Force UTC 'Z')
-    for key, value in p.items():
-        if isinstance(value, datetime):
-            if value.tzinfo is None:
-                value = value.replace(tzinfo=timezone.utc)
-            p[key] = value.isoformat().replace('+00:00', 'Z')
-            
-    return p
+    for p in products:
+        vendor_id = p.get('vendor_id')
+        vendor = vendors.get(str(vendor_id)) if vendor_id else None
+        v_name = "Unknown Vendor"
+        v_real_id = vendor_id
+        v_rating = 0
+        v_rev_count = 0
+
+        if vendor:
+            v_real_id = vendor_real_ids[str(vendor_id)]
+            v_name = vendor.get('business_name') or vendor.get('name') or vendor.get('owner_name') or "Unknown Vendor"
+
+            v_rating, v_rev_count = vendor_business_rating(vendor_stats.get(v_real_id))
+
+        p['vendor_name'] = v_name
+        p['vendor'] = {
+            "business_name": v_name,
+            "business_id": v_real_id if vendor else vendor_id,
+            "business_rating": v_rating or vendor.get('business_rating', 0) if vendor else 0,
+            "business_reviews_count": v_rev_count,
+            "shipping_rates": vendor.get('shipping_rates', []) if vendor else []
+        }
+
+        p['rating'], count = product_rating(p)
+        p['reviews'] = count
+        p['reviewsCount'] = count
+
+    return products
 
 @api_router.post("/products")
 async def add_product(product_data: ProductCreate, current_user: Annotated[dict, Depends(get_current_user)]):
@@ -1726,8 +4634,13 @@ async def add_product(product_data: ProductCreate, current_user: Annotated[dict,
     
     # Calculate dynamic price and discounts using unified logic
     doc = sync_product_price(doc)
+    doc = materialize_deal_window(doc)
+    doc.update(empty_rating_summary())
 
     await db.products.insert_one(doc)
+    await bump_vendor_stats(current_user['id'], product_count=1)
+    deal_scheduler.schedule(doc)
+    # Pending products are not public, so there are no cached responses to purge
     
     # Notify Admins of new pending product
     admins = await db.users.find({"user_type": "admin"}).to_list(None)
@@ -1750,24 +4663,75 @@ async def refresh_product_prices(product_ids: List[str]):
     Used by frontend to ensure cart prices are fresh (especially for guests).
     """
     try:
-        products_cursor = db.products.find({"id": {"$in": product_ids}})
-        updated_prices = {}
-        async for p in products_cursor:
-            p = sync_product_price(p)
-            updated_prices[p['id']] = p.get('price')
-        return updated_prices
+        products = await db.products.find({"id": {"$in": product_ids}}, PRICE_PROJECTION).to_list(None)
+        products = bulk_sync_product_prices(products)
+        return {p['id']: p.get('price') for p in products}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@api_router.get("/products")
-async def list_public_products(
-    limit: int = 100, 
-    sort: str = "newest", 
-    category: Optional[str] = None,
-    sub_category: Optional[str] = None,
-    exclude: Optional[str] = None,
-    only_deals: bool = False
-):
+# Keyset sort orders for the public catalog. Every order ends with "id" so
+# the cursor position is unique even when the sort key ties.
+PRODUCT_SORTS = {
+    "newest": [("created_at", -1), ("id", -1)],
+    # Trending = High sales + New arrival (weighted)
+    "trending": [("sales_count", -1), ("created_at", -1), ("id", -1)],
+    "price_low": [("price", 1), ("id", 1)],
+    "price_high": [("price", -1), ("id", -1)],
+    # Only valid together with the active deal filter (see list_public_products)
+    "ending_soon": [("deal_ends_at", 1), ("id", 1)],
+}
+
+# Sorts available on deal listings, indexed behind the deal equality filter
+DEAL_SORTS = ["newest", "ending_soon"]
+
+def encode_product_cursor(sort, spec, doc):
+    from bson import json_util
+    import base64
+
+    payload = {"s": sort, "k": [doc.get(field) for field, _ in spec]}
+    return base64.urlsafe_b64encode(json_util.dumps(payload).encode()).decode().rstrip("=")
+
+def decode_product_cursor(sort, spec, cursor):
+    from bson import json_util
+    import base64
+
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json_util.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+        values = payload["k"]
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid pagination cursor.")
+    if payload.get("s") != sort or len(values) != len(spec):
+        raise HTTPException(status_code=400, detail="Pagination cursor does not match the requested sort.")
+    return values
+
+def keyset_filter(spec, values):
+    """
+    Builds the "strictly after this position" predicate for a compound sort:
+    (k1 past v1) OR (k1 = v1 AND k2 past v2) OR ...
+    """
+    clauses = []
+    for i, (field, direction) in enumerate(spec):
+        value = values[i]
+        clause = {f: v for (f, _), v in zip(spec[:i], values[:i])}
+        if value is None:
+            # Nulls sort first: ascending order continues with every non-null
+            # value, descending order has nothing left past a null key
+            if direction == -1:
+                continue
+            clause[field] = {"$ne": None}
+        elif direction == -1:
+            # $lt never matches null, but nulls follow every value here
+            clauses.append({**clause, field: None})
+            clause[field] = {"$lt": value}
+        else:
+            clause[field] = {"$gt": value}
+        clauses.append(clause)
+    # An empty disjunction means nothing sorts after the cursor
+    return {"$or": clauses} if clauses else {"_id": {"$exists": False}}
+
+def public_product_query(category=None, sub_category=None, exclude=None, only_deals=False):
+    """Filter shared by the public listing and its facets."""
     # Base filter: only show approved products
     query = {"status": "approved"}
     if category:
@@ -1777,110 +4741,200 @@ async def list_public_products(
     if exclude:
         query["id"] = {"$ne": exclude}
     if only_deals:
-        query["special_offer_enabled"] = True
-        
-    products_cursor = db.products.find(query)
-    
-    # Apply sorting
-    if sort == "trending":
-        # Trending = High sales + New arrival (weighted)
-        products_cursor = products_cursor.sort([("sales_count", -1), ("created_at", -1)])
-    elif sort == "newest":
-        products_cursor = products_cursor.sort("created_at", -1)
-    elif sort == "price_low":
-        products_cursor = products_cursor.sort("price", 1)
-    elif sort == "price_high":
-        products_cursor = products_cursor.sort("price", -1)
+        query.update(active_deal_filter())
+    return query
+
+# Upper bounds of the price facet buckets; anything above the last is "50000+"
+PRICE_FACET_BOUNDARIES = [0, 500, 1000, 2500, 5000, 10000, 25000, 50000]
+RATING_FACET_BANDS = [4, 3, 2, 1]
+
+@api_router.get("/products")
+async def list_public_products(
+    limit: int = 100, 
+    sort: str = "newest", 
+    category: Optional[str] = None,
+    sub_category: Optional[str] = None,
+    exclude: Optional[str] = None,
+    only_deals: bool = False,
+    cursor: Optional[str] = None
+):
+    """
+    Lists approved products. Passing `cursor` (empty for the first page)
+    switches to keyset pagination and returns {"items", "next_cursor"}.
+    """
+    cache_key = ("products", limit, sort, category, sub_category, exclude, only_deals, cursor)
+    body = response_cache.get(cache_key)
+    if body is not None:
+        return cached_json(body)
+    started_at = time.monotonic()
+
+    query = public_product_query(category, sub_category, exclude, only_deals or sort == "ending_soon")
+    if sort == "ending_soon":
+        # Deals without an end date never end, so they are not listed here
+        query["deal_ends_at"]["$ne"] = None
+
+    spec = PRODUCT_SORTS.get(sort, PRODUCT_SORTS["newest"])
+    if cursor:
+        values = decode_product_cursor(sort, spec, cursor)
+        query.setdefault("$and", []).append(keyset_filter(spec, values))
         
-    # Apply limit
-    products_cursor = products_cursor.limit(limit)
+    # Fetch one extra document to know whether another page exists
+    products_cursor = db.products.find(query).sort(spec).limit(limit + 1)
+    
+    docs = await products_cursor.to_list(None)
+    has_more = len(docs) > limit
+    docs = docs[:limit]
+    # Encoded from the stored sort keys, before dates become ISO strings, so
+    # the next page compares like with like (legacy rows without id carry null)
+    next_cursor = encode_product_cursor(sort, spec, docs[-1]) if has_more and docs else None
     
     products = []
-    async for p in products_cursor:
+    for p in docs:
         p_id = p.get('id') or str(p['_id'])
         p['id'] = p_id
         if '_id' in p: del p['_id']
         
-        # Sync price dynamically
-        p = sync_product_price(p)
-        
-        # If only deals are requested, skip if the deal is not active
-        if only_deals and not p.get('is_special_active'):
-            continue
+        # Effective price is materialized by the deal scheduler
+        p = stored_product_price(p)
+        products.append(p)
 
-        # Robust vendor lookup
-        vendor_id = p.get('vendor_id')
-        v_name = "Unknown Vendor"
-        v_real_id = vendor_id
-        v_rating = 0
-        v_rev_count = 0
-        vendor = None
-        
-        if vendor_id:
-            # 1. Try string 'id' in vendors
-            vendor = await db.vendors.find_one({"id": str(vendor_id)})
-            if not vendor:
-                vendor = await db.users.find_one({"id": str(vendor_id)})
-            
-            # 2. Try ObjectId check
-            if not vendor:
-                from bson import ObjectId
-                try:
-                    obj_id = ObjectId(vendor_id)
-                    vendor = await db.vendors.find_one({"_id": obj_id}) or await db.users.find_one({"_id": obj_id})
-                except:
-                    pass
-            
-            if vendor:
-                v_real_id = vendor.get('id') or str(vendor.get('_id'))
-                v_name = vendor.get('business_name') or vendor.get('name') or vendor.get('owner_name') or "Unknown Vendor"
-                
-                # Calculate overall business rating for this vendor
-                vendor_products_cursor = db.products.find({"vendor_id": v_real_id}, {"id": 1})
-                v_product_ids = [p['id'] async for p in vendor_products_cursor]
-                
-                v_rating = 0
-                v_rev_count = 0
-                if v_product_ids:
-                    v_reviews_cursor = db.reviews.find({"product_id": {"$in": v_product_ids}})
-                    v_reviews = await v_reviews_cursor.to_list(None)
-                    if v_reviews:
-                        v_rev_count = len(v_reviews)
-                        v_rating = round(sum(r.get('rating', 0) for r in v_reviews) / v_rev_count, 1)
+    # Vendor and rating details are resolved for the whole page at once
+    products = await enrich_products(products)
+    
+    result = products if cursor is None else {"items": products, "next_cursor": next_cursor}
+    tags = product_tags(products) | {f"category:{category or '*'}"}
+    return cached_json(response_cache.set(cache_key, result, tags, CACHE_TTL["products"], started_at))
 
-        p['vendor_name'] = v_name
-        p['vendor'] = {
-            "business_name": v_name,
-            "business_id": v_real_id if vendor else vendor_id, # Use v_real_id if vendor object was found, otherwise fallback to original vendor_id
-            "business_rating": v_rating or vendor.get('business_rating', 0) if vendor else 0,
-            "business_reviews_count": v_rev_count,
-            "shipping_rates": vendor.get('shipping_rates', []) if vendor else []
-        }
+@api_router.get("/products/facets")
+async def get_product_facets(
+    category: Optional[str] = None,
+    sub_category: Optional[str] = None,
+    only_deals: bool = False
+):
+    """
+    Counts per sub_category, brand, price bucket, deal status and rating band
+    for the same filters as GET /api/products, in one aggregation.
+    """
+    category, sub_category = (category or "").strip() or None, (sub_category or "").strip() or None
+    cache_key = ("facets", category, sub_category, only_deals)
+    body = response_cache.get(cache_key)
+    if body is not None:
+        return cached_json(body)
+    started_at = time.monotonic()
+
+    # The $match is the listing's equality prefix, so it uses the catalog indexes
+    pipeline = [
+        {"$match": public_product_query(category, sub_category, only_deals=only_deals)},
+        {"$facet": {
+            "total": [{"$count": "count"}],
+            "sub_category": [
+                {"$match": {"sub_category": {"$nin": [None, ""]}}},
+                {"$group": {"_id": "$sub_category", "count": {"$sum": 1}}},
+                {"$sort": {"count": -1, "_id": 1}}
+            ],
+            "brand": [
+                {"$match": {"brand": {"$nin": [None, ""]}}},
+                {"$group": {"_id": "$brand", "count": {"$sum": 1}}},
+                {"$sort": {"count": -1, "_id": 1}},
+                {"$limit": 50}
+            ],
+            "price": [
+                {"$bucket": {
+                    "groupBy": "$price",
+                    "boundaries": PRICE_FACET_BOUNDARIES,
+                    "default": "other",
+                    "output": {"count": {"$sum": 1}}
+                }}
+            ],
+            "deals": [{"$match": active_deal_filter()}, {"$count": "count"}],
+            # Bucketed by whole star of the average product_rating displays,
+            # which is rounded to one decimal (3.96 shows as 4.0)
+            "rating": [
+                {"$match": {"rating_count": {"$gt": 0}}},
+                {"$group": {
+                    "_id": {"$floor": {"$add": [{"$divide": ["$rating_sum", "$rating_count"]}, 0.05]}},
+                    "count": {"$sum": 1}
+                }}
+            ]
+        }}
+    ]
+    result = (await db.products.aggregate(pipeline).to_list(1))[0]
+
+    total = result["total"][0]["count"] if result["total"] else 0
+    price_counts = {bucket["_id"]: bucket["count"] for bucket in result["price"]}
+    price_facet = []
+    for low, high in zip(PRICE_FACET_BOUNDARIES, PRICE_FACET_BOUNDARIES[1:]):
+        price_facet.append({"min": low, "max": high, "count": price_counts.get(low, 0)})
+    # Prices above the last boundary land in the default bucket
+    price_facet.append({"min": PRICE_FACET_BOUNDARIES[-1], "max": None, "count": price_counts.get("other", 0)})
+
+    star_counts = {int(band["_id"]): band["count"] for band in result["rating"] if band["_id"] is not None}
+    rating_facet = [
+        {"min_rating": band, "count": sum(count for star, count in star_counts.items() if star >= band)}
+        for band in RATING_FACET_BANDS
+    ]
+    deal_count = result["deals"][0]["count"] if result["deals"] else 0
+
+    facets = {
+        "total": total,
+        "sub_category": [{"value": g["_id"], "count": g["count"]} for g in result["sub_category"]],
+        "brand": [{"value": g["_id"], "count": g["count"]} for g in result["brand"]],
+        "price": price_facet,
+        "deals": {"active": deal_count, "regular": total - deal_count},
+        "rating": rating_facet
+    }
+    tags = {f"category:{category or '*'}", "facets"}
+    return cached_json(response_cache.set(cache_key, facets, tags, CACHE_TTL["facets"], started_at))
+
+@api_router.get("/products/search")
+async def search_products(
+    q: str,
+    page: int = 1,
+    limit: int = 20,
+    category: Optional[str] = None,
+    sub_category: Optional[str] = None
+):
+    """
+    Relevance-ranked search over approved products. Each item carries
+    `search_highlight` with the matching words of its name and brand
+    wrapped in <mark>.
+    """
+    page = max(page, 1)
+    limit = min(max(limit, 1), 100)
+    await search_index.ready.wait()
 
-        # Calculate product rating
-        reviews_cursor_p = db.reviews.find({"product_id": p['id']})
-        reviews_p = await reviews_cursor_p.to_list(None)
-        if reviews_p:
-            total_rating = sum(r.get('rating', 0) for r in reviews_p)
-            p['rating'] = round(total_rating / len(reviews_p), 1)
-            p['reviews'] = len(reviews_p)
-            p['reviewsCount'] = len(reviews_p)
-        else:
-            p['rating'] = 0
-            p['reviews'] = 0
-            p['reviewsCount'] = 0
+    total, hits = search_index.search(q, offset=(page - 1) * limit, limit=limit, category=category, sub_category=sub_category)
+    ids = [product_id for product_id, _ in hits]
+    docs = {p['id']: p for p in await db.products.find({"id": {"$in": ids}, "status": "approved"}, {"_id": 0}).to_list(None)}
 
+    terms = set(search_index.query_terms(q))
+    products = []
+    for product_id, score in hits:
+        p = docs.get(product_id)
+        if not p:
+            continue
+        p = stored_product_price(p)
+        p['relevance'] = round(score, 4)
+        p['search_highlight'] = {
+            field: marked for field in SEARCH_HIGHLIGHT_FIELDS
+            if (marked := search_index.highlight(p.get(field) or "", terms))
+        }
         products.append(p)
-    return products
+    products = await enrich_products(products)
+
+    return {
+        "query": q,
+        "items": products,
+        "total": total,
+        "page": page,
+        "limit": limit,
+        "has_more": page * limit < total
+    }
 
 @api_router.get("/coupons/validate/{code}")
 async def validate_coupon(code: str):
-    # Find active coupon by code
-    coupon = await db.coupons.find_one({
-        "code": code.upper(),
-        "status": "active",
-        "expires": {"$gte": datetime.now(timezone.utc).strftime("%Y-%m-%d")}
-    })
+    # Find active coupon by code; unknown codes are cached too
+    coupon = await lookup_coupon(code)
 
     if not coupon:
         raise HTTPException(status_code=404, detail="Invalid or expired coupon code.")
@@ -1889,9 +4943,6 @@ async def validate_coupon(code: str):
     if coupon.get('usage', 0) >= coupon.get('limit', 0):
         raise HTTPException(status_code=400, detail="Coupon usage limit exceeded.")
 
-    coupon['id'] = str(coupon.get('id') or coupon['_id'])
-    if '_id' in coupon: del coupon['_id']
-
     return coupon
 
 @api_router.get("/vendor/products")
@@ -1904,12 +4955,81 @@ async def list_vendor_products(current_user: Annotated[dict, Depends(get_current
         p_id = p.get('id') or str(p['_id'])
         p['id'] = p_id
         if '_id' in p: del p['_id']
-        p = sync_product_price(p)
+        p = stored_product_price(p)
         products.append(p)
     return products
 
+# Keyset sort orders for a product's reviews
+REVIEW_SORTS = {
+    "newest": [("created_at", -1), ("id", -1)],
+    "helpful": [("helpful_count", -1), ("created_at", -1), ("id", -1)],
+    "rating": [("rating", -1), ("created_at", -1), ("id", -1)],
+}
+REVIEW_PAGE_SIZE = 10
+
+async def attach_reviewer_names(reviews, fallback="Customer"):
+    """
+    Fills user_name on reviews written before it was stored with the review,
+    using one $in lookup per collection instead of one per review.
+    """
+    missing = {r.get('user_id') for r in reviews if not r.get('user_name') and r.get('user_id')}
+    names = {}
+    if missing:
+        async for u in db.users.find({"id": {"$in": list(missing)}}, {"id": 1, "name": 1, "business_name": 1}):
+            names[u['id']] = u.get('name') or u.get('business_name')
+        remaining = [uid for uid in missing if uid not in names]
+        if remaining:
+            async for v in db.vendors.find({"id": {"$in": remaining}}, {"id": 1, "name": 1, "business_name": 1}):
+                names[v['id']] = v.get('name') or v.get('business_name')
+    for r in reviews:
+        if not r.get('user_name'):
+            r['user_name'] = names.get(r.get('user_id')) or fallback
+    return reviews
+
+async def fetch_review_page(product_id, sort="newest", cursor=None, limit=REVIEW_PAGE_SIZE):
+    """One page of a product's reviews and the cursor for the next one."""
+    if sort not in REVIEW_SORTS:
+        raise HTTPException(status_code=400, detail=f"Unknown review sort. Use one of: {', '.join(REVIEW_SORTS)}.")
+    limit = min(max(limit, 1), 50)
+    spec = REVIEW_SORTS[sort]
+
+    query = {"product_id": product_id}
+    if cursor:
+        query["$and"] = [keyset_filter(spec, decode_product_cursor(sort, spec, cursor))]
+    docs = await db.reviews.find(query, {"_id": 0}).sort(spec).limit(limit + 1).to_list(None)
+
+    next_cursor = encode_product_cursor(sort, spec, docs[limit - 1]) if len(docs) > limit else None
+    reviews = await attach_reviewer_names(docs[:limit])
+    for r in reviews:
+        r.setdefault('helpful_count', 0)
+    return reviews, next_cursor
+
+@api_router.get("/products/{product_id}/reviews")
+async def list_product_reviews(product_id: str, sort: str = "newest", cursor: Optional[str] = None, limit: int = REVIEW_PAGE_SIZE):
+    """Cursor-paginated reviews; sort is newest, helpful or rating."""
+    cache_key = ("reviews", product_id, sort, cursor, limit)
+    body = response_cache.get(cache_key)
+    if body is not None:
+        return cached_json(body)
+    started_at = time.monotonic()
+
+    reviews, next_cursor = await fetch_review_page(product_id, sort, cursor, limit)
+    result = {"items": reviews, "next_cursor": next_cursor, "sort": sort}
+    return cached_json(response_cache.set(cache_key, result, {f"product:{product_id}"}, CACHE_TTL["product"], started_at))
+
 @api_router.get("/products/{product_id}")
-async def get_product(product_id: str):
+async def get_product(product_id: str, include_reviews: bool = True):
+    """
+    Product detail with its rating summary. The first page of reviews is
+    embedded unless include_reviews=false; further pages come from
+    GET /api/products/{id}/reviews starting at reviews_next_cursor.
+    """
+    cache_key = ("product", product_id, include_reviews)
+    body = response_cache.get(cache_key)
+    if body is not None:
+        return cached_json(body)
+    started_at = time.monotonic()
+
     # Try custom id first, then _id
     product = await db.products.find_one({"id": product_id})
     if not product:
@@ -1925,50 +5045,29 @@ async def get_product(product_id: str):
     product['id'] = product.get('id') or str(product['_id'])
     if '_id' in product: del product['_id']
     
-    # Recalculate dynamic price
-    product = sync_product_price(product)
+    # Effective price is materialized by the deal scheduler
+    product = stored_product_price(product)
 
     # Robust vendor lookup
     vendor_id = product.get('vendor_id')
     vendor_data = {"business_name": "Unknown Vendor", "business_id": vendor_id, "business_rating": 0}
     
     if vendor_id:
-        # 1. Try string 'id' in vendors
-        vendor = await db.vendors.find_one({"id": str(vendor_id)})
-        # 2. Try string 'id' in users (some vendors might be there)
-        if not vendor:
-            vendor = await db.users.find_one({"id": str(vendor_id)})
-        # 3. Try _id if it's potentially an ObjectId
-        if not vendor:
-            from bson import ObjectId
-            try:
-                obj_id = ObjectId(vendor_id)
-                vendor = await db.vendors.find_one({"_id": obj_id}) or await db.users.find_one({"_id": obj_id})
-            except:
-                pass
+        vendor = (await resolve_vendors([vendor_id])).get(str(vendor_id))
         
         if vendor:
             v_real_id = vendor.get('id') or str(vendor.get('_id'))
             v_name = vendor.get('business_name') or vendor.get('name') or vendor.get('owner_name') or "Unknown Vendor"
             
-            # Calculate overall business rating for this vendor
-            # 1. Get all product IDs for this vendor
-            vendor_products_cursor = db.products.find({"vendor_id": v_real_id}, {"id": 1})
-            v_product_ids = [p['id'] async for p in vendor_products_cursor]
-            
-            # 2. Get all reviews for these products
-            v_rating = 0
-            if v_product_ids:
-                v_reviews_cursor = db.reviews.find({"product_id": {"$in": v_product_ids}})
-                v_reviews = await v_reviews_cursor.to_list(None)
-                if v_reviews:
-                    v_rating = round(sum(r.get('rating', 0) for r in v_reviews) / len(v_reviews), 1)
+            # Overall business rating comes from the vendor's rollup
+            stats = await db.vendor_stats.find_one({"vendor_id": v_real_id})
+            v_rating, v_rev_count = vendor_business_rating(stats)
             
             vendor_data = {
                 "business_name": v_name,
                 "business_id": v_real_id,
                 "business_rating": v_rating or vendor.get('business_rating', 0),
-                "business_reviews_count": len(v_reviews) if v_product_ids and v_reviews else 0,
+                "business_reviews_count": v_rev_count,
                 "shipping_rates": vendor.get('shipping_rates', [])
             }
             product['vendor_name'] = v_name
@@ -1977,27 +5076,21 @@ async def get_product(product_id: str):
 
     product['vendor'] = vendor_data
 
-    # Add reviews information
-    reviews_cursor = db.reviews.find({"product_id": product['id']})
-    reviews = []
-    total_rating = 0
-    async for r in reviews_cursor:
-        if '_id' in r: del r['_id']
-        # Get reviewer name
-        reviewer = await db.users.find_one({"id": r.get('user_id')}) or await db.vendors.find_one({"id": r.get('user_id')})
-        if reviewer:
-            r['user_name'] = reviewer.get('name') or reviewer.get('business_name') or "Customer"
-        else:
-            r['user_name'] = "Customer"
-        
-        reviews.append(r)
-        total_rating += r.get('rating', 0)
-    
-    product['reviews'] = reviews
-    product['rating'] = round(total_rating / len(reviews), 1) if reviews else 0
-    product['reviews_count'] = len(reviews)
+    # Summary fields come from the stored aggregates, not the review list
+    product['rating'], product['reviews_count'] = product_rating(product)
+    product['rating_histogram'] = rating_histogram(product)
+    product['rating_summary'] = {
+        "average": product['rating'],
+        "count": product['reviews_count'],
+        "histogram": product['rating_histogram']
+    }
 
-    return product
+    if include_reviews:
+        product['reviews'], product['reviews_next_cursor'] = await fetch_review_page(product['id'])
+
+    # Tagged with the requested id too, in case it was the ObjectId form
+    tags = product_tags([product]) | {f"product:{product_id}"}
+    return cached_json(response_cache.set(cache_key, product, tags, CACHE_TTL["product"], started_at))
 
 @api_router.put("/products/{product_id}")
 async def update_product(product_id: str, product_data: ProductCreate, current_user: Annotated[dict, Depends(get_current_user)]):
@@ -2021,15 +5114,26 @@ async def update_product(product_id: str, product_data: ProductCreate, current_u
     
     update_doc = product_data.model_dump()
     update_doc['status'] = 'pending'
+    # Set separately so units held by open reservations are accounted for
+    on_hand = update_doc.pop('stock')
 
     # Calculate dynamic price and discounts using unified logic
     update_doc = sync_product_price(update_doc)
+    update_doc = materialize_deal_window(update_doc)
     
     # Ensure current ID stays the same
     if existing_product.get('id'):
         update_doc['id'] = existing_product['id']
     
-    await db.products.update_one(query, {"$set": update_doc})
+    previous = await db.products.find_one_and_update(query, {"$set": update_doc}, projection={"status": 1})
+    await set_stock_on_hand(query, on_hand)
+    if previous and previous.get('status') == 'approved':
+        await bump_vendor_stats(current_user['id'], approved_product_count=-1)
+        await response_cache.purge("stats", "facets")
+    deal_scheduler.schedule(update_doc)
+    # Back to pending: drops out of every cached listing and detail view
+    await response_cache.purge(f"product:{product_id}", f"product:{existing_product.get('id')}")
+
     # Notify Admins of product update
     admins = await db.users.find({"user_type": "admin"}).to_list(None)
     for admin in admins:
@@ -2051,18 +5155,34 @@ async def delete_product(product_id: str, current_user: Annotated[dict, Depends(
         raise HTTPException(status_code=403, detail="Merchant clearance required.")
     
     # Try custom id first
-    result = await db.products.delete_one({"id": product_id, "vendor_id": current_user['id']})
+    deleted = await db.products.find_one_and_delete({"id": product_id, "vendor_id": current_user['id']})
     
-    if result.deleted_count == 0:
+    if not deleted:
         from bson import ObjectId
         try:
-            result = await db.products.delete_one({"_id": ObjectId(product_id), "vendor_id": current_user['id']})
+            deleted = await db.products.find_one_and_delete({"_id": ObjectId(product_id), "vendor_id": current_user['id']})
         except:
             pass
             
-    if result.deleted_count == 0:
+    if not deleted:
         raise HTTPException(status_code=404, detail="Inventory entity not found or access restricted.")
     
+    await bump_vendor_stats(
+        current_user['id'],
+        product_count=-1,
+        approved_product_count=-1 if deleted.get('status') == 'approved' else 0,
+        review_count=-(deleted.get('rating_count') or 0),
+        rating_sum=-(deleted.get('rating_sum') or 0)
+    )
+    await response_cache.purge(
+        f"product:{product_id}",
+        f"product:{deleted.get('id')}",
+        "stats" if deleted.get('status') == 'approved' else None,
+        "facets" if deleted.get('status') == 'approved' else None,
+        # The vendor's business rating shown on its other products changed
+        f"vendor:{current_user['id']}" if deleted.get('rating_count') else None
+    )
+    
     return {"message": "Inventory successfully decommissioned."}
 
 @api_router.get("/admin/products/pending")
@@ -2088,7 +5208,15 @@ async def approve_product(product_id: str, current_user: Annotated[dict, Depends
     if not product:
         raise HTTPException(status_code=404, detail="Entity not found.")
         
-    await db.products.update_one({"id": product_id}, {"$set": {"status": "approved"}})
+    result = await db.products.update_one(
+        {"id": product_id, "status": {"$ne": "approved"}},
+        {"$set": {"status": "approved"}}
+    )
+    if result.modified_count:
+        await bump_vendor_stats(product['vendor_id'], approved_product_count=1)
+        # Newly visible, so it can enter category listings it was not in
+        await purge_product(product, listed=True)
+        await response_cache.purge("stats", "facets")
     
     # Notify Vendor
     await db.notifications.insert_one({
@@ -2116,6 +5244,7 @@ async def approve_vendor(vendor_id: str, current_user: Annotated[dict, Depends(g
         raise HTTPException(status_code=403, detail="Unauthorized.")
     
     await db.vendors.update_one({"id": vendor_id}, {"$set": {"status": "active"}})
+    await invalidate_principal(vendor_id)
     
     # Notify Vendor
     await db.notifications.insert_one({
@@ -2136,6 +5265,7 @@ async def reject_vendor(vendor_id: str, data: dict, current_user: Annotated[dict
     
     reason = data.get('reason', "Compliance failure.")
     await db.vendors.update_one({"id": vendor_id}, {"$set": {"status": "rejected", "rejection_reason": reason}})
+    await invalidate_principal(vendor_id)
     return {"message": "Vendor rejected."}
 
 @api_router.post("/vendor/shipping-rates")
@@ -2238,7 +5368,15 @@ async def reject_product(product_id: str, reason: dict, current_user: Annotated[
         raise HTTPException(status_code=404, detail="Entity not found.")
         
     rejection_reason = reason.get("reason", "Incomplete compliance.")
-    await db.products.update_one({"id": product_id}, {"$set": {"status": "rejected", "rejection_reason": rejection_reason}})
+    previous = await db.products.find_one_and_update(
+        {"id": product_id},
+        {"$set": {"status": "rejected", "rejection_reason": rejection_reason}},
+        projection={"status": 1}
+    )
+    if previous and previous.get('status') == 'approved':
+        await bump_vendor_stats(product['vendor_id'], approved_product_count=-1)
+        await purge_product(product)
+        await response_cache.purge("stats", "facets")
     
     # Notify Vendor
     await db.notifications.insert_one({
@@ -2296,16 +5434,17 @@ async def update_order_delivery(order_id: str, delivery_data: DeliveryUpdate, cu
 # --- Delivery Partner Workflows ---
 
 @api_router.post("/rider/toggle-status")
-async def toggle_rider_status(current_user: Annotated[dict, Depends(get_current_user)]):
+async def toggle_rider_status(current_user: Annotated[dict, Depends(get_current_user_fresh)]):
     if current_user['user_type'] != 'delivery_partner':
         raise HTTPException(status_code=403, detail="Rider credentials required.")
     
     new_status = "online" if current_user.get('availability_status') == "offline" else "offline"
     await db.users.update_one({"id": current_user['id']}, {"$set": {"availability_status": new_status}})
+    await invalidate_principal(current_user['id'])
     return {"status": new_status}
 
 @api_router.get("/rider/stats")
-async def get_rider_stats(current_user: Annotated[dict, Depends(get_current_user)]):
+async def get_rider_stats(current_user: Annotated[dict, Depends(get_current_user_fresh)]):
     if current_user['user_type'] != 'delivery_partner':
         raise HTTPException(status_code=403, detail="Rider credentials required.")
     
@@ -2348,7 +5487,7 @@ async def get_rider_history(current_user: Annotated[dict, Depends(get_current_us
     return history
 
 @api_router.post("/rider/withdraw")
-async def rider_withdraw_request(current_user: Annotated[dict, Depends(get_current_user)]):
+async def rider_withdraw_request(current_user: Annotated[dict, Depends(get_current_user_fresh)]):
     if current_user['user_type'] != 'delivery_partner':
         raise HTTPException(status_code=403, detail="Rider credentials required.")
     
@@ -2365,6 +5504,7 @@ async def rider_withdraw_request(current_user: Annotated[dict, Depends(get_curre
     })
     
     await db.users.update_one({"id": current_user['id']}, {"$set": {"wallet_balance": 0.0}})
+    await invalidate_principal(current_user['id'])
     return {"message": "Withdrawal request authenticated and queued for processing."}
 
 @api_router.get("/admin/riders")
@@ -2471,8 +5611,10 @@ async def get_vendor_stats(current_user: Annotated[dict, Depends(get_current_use
     vendor_id = current_user['id']
     
     # Products count
-    total_products = await db.products.count_documents({"vendor_id": vendor_id})
-    approved_products = await db.products.count_documents({"vendor_id": vendor_id, "status": "approved"})
+    stats = await db.vendor_stats.find_one({"vendor_id": vendor_id}) or {}
+    total_products = stats.get('product_count', 0)
+    approved_products = stats.get('approved_product_count', 0)
+    business_rating, business_reviews_count = vendor_business_rating(stats)
     
     # Orders and Revenue
     orders_cursor = db.orders.find({"items.vendor_id": vendor_id})
@@ -2494,6 +5636,8 @@ async def get_vendor_stats(current_user: Annotated[dict, Depends(get_current_use
         "totalRevenue": total_revenue,
         "totalOrders": total_orders,
         "uniqueCustomers": len(unique_customers),
+        "businessRating": business_rating,
+        "businessReviewsCount": business_reviews_count,
         "performance": [
             {"name": "Orders", "value": total_orders},
             {"name": "Revenue", "value": total_revenue}
@@ -2628,25 +5772,22 @@ async def update_product_stock(product_id: str, stock_data: dict, current_user:
     vendor_id = current_user.get('id')
     
     # Try updating by 'id' field first
-    result = await db.products.update_one(
-        {"id": product_id, "vendor_id": vendor_id},
-        {"$set": {"stock": int(new_stock)}}
-    )
+    updated = await set_stock_on_hand({"id": product_id, "vendor_id": vendor_id}, int(new_stock))
     
-    if result.matched_count == 0:
+    if not updated:
          # Try updating by MongoDB '_id'
          from bson import ObjectId
          try:
-             result = await db.products.update_one(
-                 {"_id": ObjectId(product_id), "vendor_id": vendor_id},
-                 {"$set": {"stock": int(new_stock)}}
-             )
+             updated = await set_stock_on_hand({"_id": ObjectId(product_id), "vendor_id": vendor_id}, int(new_stock))
+         except HTTPException:
+             raise
          except:
              pass
 
-    if result.matched_count == 0:
+    if not updated:
         raise HTTPException(status_code=404, detail="Product not found or access restricted.")
     
+    await response_cache.purge(f"product:{product_id}")
     return {"message": "Stock updated successfully.", "new_stock": new_stock}
 
 @api_router.post("/vendor/support/tickets")
@@ -2712,7 +5853,9 @@ async def update_permissions(perm_data: list, current_user: Annotated[dict, Depe
 
 @api_router.get("/user/permissions")
 async def get_user_permissions(current_user: Annotated[dict, Depends(get_current_user)]):
-    role = current_user.get('user_type', 'user')
+    return await resolve_permissions(current_user.get('user_type', 'user'))
+
+async def resolve_permissions(role):
     
     # Standard default modules for first-time setup or recovery
     default_modules = {
@@ -2829,6 +5972,8 @@ async def create_vendor_coupon(coupon_data: CouponCreate, current_user: Annotate
     coupon_obj = Coupon(**coupon_data.model_dump(), vendor_id=current_user['id'])
     doc = coupon_obj.model_dump()
     _ = await db.coupons.insert_one(doc)
+    # The code may be cached as unknown
+    await response_cache.purge(f"coupon:{coupon_obj.code.upper()}")
     return {"message": "Coupon created successfully.", "id": coupon_obj.id}
 
 @api_router.put("/vendor/profile")
@@ -2836,11 +5981,17 @@ async def update_vendor_profile(profile_data: dict, current_user: Annotated[dict
     if current_user['user_type'] != 'vendor':
         raise HTTPException(status_code=403, detail="Unauthorized.")
 
+    from pymongo.errors import DuplicateKeyError
+
     allowed_fields = ['business_name', 'owner_name', 'address', 'phone', 'logo', 'banner']
-    update_data = {k: v for k, v in profile_data.items() if k in allowed_fields}
-    result = await db.vendors.update_one({"id": current_user['id']}, {"$set": update_data})
+    update_data = with_login_keys({k: v for k, v in profile_data.items() if k in allowed_fields})
+    try:
+        result = await db.vendors.update_one({"id": current_user['id']}, {"$set": update_data})
+    except DuplicateKeyError:
+        raise login_key_conflict()
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Vendor not found.")
+    await invalidate_principal(current_user['id'])
     return {"message": "Profile updated successfully."}
 
 @api_router.get("/admin/payouts")
@@ -3052,15 +6203,18 @@ async def admin_get_all_restaurants(current_user: Annotated[dict, Depends(get_cu
 
 @api_router.get("/notifications")
 async def get_notifications(current_user: Annotated[dict, Depends(get_current_user)]):
+    return await take_unread_notifications(current_user['id'])
+
+async def take_unread_notifications(user_id):
     # Find all unread notifications
-    cursor = db.notifications.find({"user_id": current_user['id'], "is_read": False}, {"_id": 0}).sort("created_at", -1)
+    cursor = db.notifications.find({"user_id": user_id, "is_read": False}, {"_id": 0}).sort("created_at", -1)
     notifications = await cursor.to_list(100)
     
     # Immediately mark these as "read" in the DB so they won't be returned again
     if notifications:
         notification_ids = [n['id'] for n in notifications]
         await db.notifications.update_many(
-            {"id": {"$in": notification_ids}, "user_id": current_user['id']},
+            {"id": {"$in": notification_ids}, "user_id": user_id},
             {"$set": {"is_read": True}}
         )
         
@@ -3086,38 +6240,42 @@ async def get_public_stats():
     """
     Returns platform-wide metrics for public display
     """
+    body = response_cache.get(("stats",))
+    if body is not None:
+        return cached_json(body)
+    started_at = time.monotonic()
+
     user_count = await db.users.count_documents({})
     vendor_count = await db.vendors.count_documents({})
     product_count = await db.products.count_documents({"status": "approved"})
     
     # Real dynamic counts from database
-    return {
+    stats = {
         "happy_customers": user_count,
         "total_products": product_count,
         "total_vendors": vendor_count,
         "satisfaction_rate": "100%"
     }
+    return cached_json(response_cache.set(("stats",), stats, {"stats"}, CACHE_TTL["stats"], started_at))
 
 @api_router.get("/public/reviews")
 async def get_public_reviews():
     """
     Returns latest reviews for public display
     """
+    body = response_cache.get(("reviews",))
+    if body is not None:
+        return cached_json(body)
+    started_at = time.monotonic()
+
     reviews_cursor = db.reviews.find().sort("created_at", -1).limit(6)
     reviews = []
     async for review in reviews_cursor:
         review['id'] = str(review.get('id') or review['_id'])
         if '_id' in review: del review['_id']
-        
-        # Fetch user name
-        user = await db.users.find_one({"id": review['user_id']})
-        if user:
-            review['user_name'] = user['name']
-        else:
-            review['user_name'] = "Anonymous"
-            
         reviews.append(review)
-    return reviews
+    reviews = await attach_reviewer_names(reviews, fallback="Anonymous")
+    return cached_json(response_cache.set(("reviews",), reviews, {"reviews"}, CACHE_TTL["reviews"], started_at))
 
 @api_router.get("/public/about", response_model=AboutData)
 async def get_about_data():
@@ -3221,13 +6379,18 @@ async def get_public_categories():
     """
     Returns all categories for home page display
     """
+    body = response_cache.get(("categories",))
+    if body is not None:
+        return cached_json(body)
+    started_at = time.monotonic()
+
     categories_cursor = db.categories.find().sort("name", 1)
     categories = []
     async for cat in categories_cursor:
         cat['id'] = str(cat.get('id') or cat['_id'])
         if '_id' in cat: del cat['_id']
         categories.append(cat)
-    return categories
+    return cached_json(response_cache.set(("categories",), categories, {"categories"}, CACHE_TTL["categories"], started_at))
 
 @api_router.get("/public/categories/hierarchical")
 async def get_hierarchical_categories():
@@ -3235,6 +6398,11 @@ async def get_hierarchical_categories():
     Returns all categories with subcategories in a hierarchical structure.
     Each subcategory includes the main category name for display purposes.
     """
+    body = response_cache.get(("categories/hierarchical",))
+    if body is not None:
+        return cached_json(body)
+    started_at = time.monotonic()
+
     categories_cursor = db.categories.find().sort("name", 1)
     hierarchical = []
     
@@ -3264,7 +6432,7 @@ async def get_hierarchical_categories():
             "link": cat.get('link', '')
         })
     
-    return hierarchical
+    return cached_json(response_cache.set(("categories/hierarchical",), hierarchical, {"categories"}, CACHE_TTL["categories"], started_at))
 
 @api_router.get("/public/categories/all-subcategories")
 async def get_all_subcategories():
@@ -3272,6 +6440,11 @@ async def get_all_subcategories():
     Returns all subcategories from all categories flattened into a single list.
     Each subcategory includes the main category name.
     """
+    body = response_cache.get(("categories/all-subcategories",))
+    if body is not None:
+        return cached_json(body)
+    started_at = time.monotonic()
+
     all_subs = []
     
     categories_cursor = db.categories.find().sort("name", 1)
@@ -3287,7 +6460,7 @@ async def get_all_subcategories():
                 "link": f"/shop?category={main_slug}&subcategory={sub.replace(' ', '-').lower()}"
             })
     
-    return all_subs
+    return cached_json(response_cache.set(("categories/all-subcategories",), all_subs, {"categories"}, CACHE_TTL["categories"], started_at))
 
 @api_router.post("/categories")
 async def add_category(category: Category, current_user: Annotated[dict, Depends(get_current_user)]):
@@ -3306,6 +6479,7 @@ async def add_category(category: Category, current_user: Annotated[dict, Depends
     
     cat_dict['created_at'] = datetime.now(timezone.utc)
     await db.categories.insert_one(cat_dict)
+    await response_cache.purge("categories")
     return {"message": "Category added successfully.", "category": cat_dict}
 
 @api_router.post("/vendor/categories")
@@ -3334,43 +6508,127 @@ async def add_vendor_category(category_data: dict, current_user: Annotated[dict,
     cat_dict['created_at'] = datetime.now(timezone.utc)
 
     await db.categories.insert_one(cat_dict)
+    await response_cache.purge("categories")
     return {"message": "Custom category added successfully.", "category": cat_dict}
 
 @api_router.post("/reviews")
 async def add_review(review: Review, current_user: Annotated[dict, Depends(get_current_user)]):
+    if review.rating < 1 or review.rating > 5:
+        raise HTTPException(status_code=400, detail="Rating must be between 1 and 5.")
+
     review_dict = review.model_dump()
     review_dict['user_id'] = current_user['id']
+    # Stored with the review so listing pages need no reviewer lookups
+    review_dict['user_name'] = current_user.get('name') or current_user.get('business_name') or "Customer"
+    review_dict['helpful_count'] = 0
     review_dict['created_at'] = review_dict['created_at'].isoformat()
     
     await db.reviews.insert_one(review_dict)
+
+    # Keep the product's rating summary and its vendor's rollup in step
+    product = await db.products.find_one_and_update(
+        {"id": review.product_id},
+        {"$inc": rating_summary_inc(review.rating)},
+        projection={"vendor_id": 1}
+    )
+    if product:
+        await bump_vendor_stats(product.get('vendor_id'), review_count=1, rating_sum=review.rating)
+    await response_cache.purge(
+        f"product:{review.product_id}",
+        # Vendor business rating is shown on all of the vendor's products
+        f"vendor:{product.get('vendor_id')}" if product else None,
+        # Rating bands shift with the new average
+        "facets",
+        "reviews"
+    )
     return {"message": "Review submitted successfully."}
 
+@api_router.post("/reviews/{review_id}/helpful")
+async def mark_review_helpful(review_id: str, current_user: Annotated[dict, Depends(get_current_user)]):
+    from pymongo.errors import DuplicateKeyError
+
+    review = await db.reviews.find_one({"id": review_id}, {"product_id": 1, "user_id": 1})
+    if not review:
+        raise HTTPException(status_code=404, detail="Review not found.")
+    if review.get('user_id') == current_user['id']:
+        raise HTTPException(status_code=400, detail="You cannot vote on your own review.")
+
+    # The unique (review_id, user_id) index makes each vote count once
+    try:
+        await db.review_votes.insert_one({
+            "review_id": review_id,
+            "user_id": current_user['id'],
+            "created_at": datetime.now(timezone.utc).isoformat()
+        })
+    except DuplicateKeyError:
+        return {"message": "Already marked as helpful."}
+
+    await db.reviews.update_one({"id": review_id}, {"$inc": {"helpful_count": 1}})
+    await response_cache.purge(f"product:{review.get('product_id')}")
+    return {"message": "Marked as helpful."}
+
+@api_router.post("/admin/ratings/reconcile")
+async def reconcile_ratings(current_user: Annotated[dict, Depends(get_current_user)], fix: bool = False):
+    if current_user['user_type'] != 'admin':
+        raise HTTPException(status_code=403, detail="Unauthorized.")
+
+    return {
+        "products": await reconcile_rating_summaries(fix=fix),
+        "vendors": await reconcile_vendor_stats(fix=fix)
+    }
+
+@api_router.get("/admin/metrics")
+async def get_admin_metrics(current_user: Annotated[dict, Depends(get_current_user)]):
+    """Per-worker runtime counters for tuning caches and pools"""
+    if current_user['user_type'] != 'admin':
+        raise HTTPException(status_code=403, detail="Unauthorized.")
+
+    return {
+        "worker_pid": os.getpid(),
+        "response_cache": response_cache.metrics(),
+        "principal_cache": principal_cache.metrics(),
+        "password_hasher": password_hasher.metrics(),
+        "rate_limiter": rate_limiter.metrics(),
+        "history_buffer": history_buffer.metrics(),
+        "checkout_transactions": checkout_transactions.metrics(),
+        "stock_reservations": stock_reservations.metrics(),
+        "idempotency": idempotency_store.metrics(),
+        "coupons": dict(coupon_stats),
+        "deal_scheduler": deal_scheduler.metrics()
+    }
+
 @api_router.put("/users/{user_id}")
 async def update_user(user_id: str, update_data: dict, current_user: Annotated[dict, Depends(get_current_user)]):
     # Security Check: Only self or admin can update
     if current_user['id'] != user_id and current_user['user_type'] != 'admin':
         raise HTTPException(status_code=403, detail="Operation restricted. Security clearance insufficient.")
 
-    # Remove None values
-    update_data = {k: v for k, v in update_data.items() if v is not None}
+    from pymongo.errors import DuplicateKeyError
 
-    # Try users collection first
-    result = await db.users.update_one(
-        {"id": user_id},
-        {"$set": update_data}
-    )
+    # Remove None values
+    update_data = with_login_keys({k: v for k, v in update_data.items() if v is not None})
 
-    if result.modified_count == 0:
-        # Try vendors collection
-        result = await db.vendors.update_one(
+    try:
+        # Try users collection first
+        result = await db.users.update_one(
             {"id": user_id},
             {"$set": update_data}
         )
 
+        if result.modified_count == 0:
+            # Try vendors collection
+            result = await db.vendors.update_one(
+                {"id": user_id},
+                {"$set": update_data}
+            )
+    except DuplicateKeyError:
+        raise login_key_conflict()
+
     if result.modified_count == 0:
         from fastapi import HTTPException
         raise HTTPException(status_code=404, detail="User not found")
 
+    await invalidate_principal(user_id)
     return {"message": "User updated successfully"}
 
 # =============================================================================
@@ -3408,18 +6666,22 @@ class MenuItemAvailability(BaseModel):
 # Restaurant Registration
 @api_router.post("/food/restuarent/register")
 async def register_restaurant(request: Request, vendor_data: FoodVendorCreate):
+    from pymongo.errors import DuplicateKeyError
+
     try:
         # Log raw request for debugging
         raw_body = await request.body()
         logging.info(f"Registration request for: {vendor_data.email}, raw body length: {len(raw_body)}")
         # Check if vendor already exists by email
-        existing_by_email = await food_db.restuarent.find_one({"email": vendor_data.email})
+        email_lc = normalize_email(vendor_data.email)
+        existing_by_email = email_lc and await find_login_account("restuarent", vendor_data.email)
         if existing_by_email:
             raise HTTPException(status_code=400, detail=f"Email '{vendor_data.email}' is already registered. Please use a different email or login.")
         
         # Check by phone only if phone is provided
-        if vendor_data.phone and vendor_data.phone.strip():
-            existing_by_phone = await food_db.restuarent.find_one({"phone": vendor_data.phone})
+        phone_e164 = normalize_phone(vendor_data.phone)
+        if phone_e164:
+            existing_by_phone = await find_login_account("restuarent", vendor_data.phone)
             if existing_by_phone:
                 raise HTTPException(status_code=400, detail=f"Phone '{vendor_data.phone}' is already registered. Please use a different phone number.")
         
@@ -3431,8 +6693,10 @@ async def register_restaurant(request: Request, vendor_data: FoodVendorCreate):
             "id": vendor_id,
             "name": vendor_data.owner_name,
             "email": vendor_data.email,
+            "email_lc": email_lc,
             "phone": vendor_data.phone,
-            "password": get_password_hash(vendor_data.password),
+            "phone_e164": phone_e164,
+            "password": await password_hasher.hash(vendor_data.password),
             "restaurant_name": vendor_data.restaurant_name,
             "owner_name": vendor_data.owner_name,
             "restaurant_type": vendor_data.restaurant_type,
@@ -3455,12 +6719,20 @@ async def register_restaurant(request: Request, vendor_data: FoodVendorCreate):
         }
         
         # Store in restuarent collection (primary)
-        await food_db.restuarent.insert_one(vendor_doc.copy())
+        try:
+            await food_db.restuarent.insert_one(vendor_doc.copy())
+        except DuplicateKeyError:
+            raise login_key_conflict()
         
         # Also store in food_vendors collection (for compatibility)
         food_vendor_doc = vendor_doc.copy()
         food_vendor_doc.pop('_id', None)  # Remove _id if added by first insert
-        await food_db.food_vendors.insert_one(food_vendor_doc)
+        try:
+            await food_db.food_vendors.insert_one(food_vendor_doc)
+        except DuplicateKeyError:
+            # A legacy food_vendors row already holds these keys; the
+            # restuarent document is the one login reads first
+            logging.warning(f"food_vendors already has an account for {vendor_data.email}")
         
         logging.info(f"Registered new restaurant: {vendor_data.email}")
         
@@ -3600,6 +6872,7 @@ async def update_restaurant_profile(restaurant_data: dict, current_vendor: Annot
         {"$set": {
             "restaurant_name": data_to_update.get('name', current_vendor.get('restaurant_name')),
             "phone": data_to_update.get('phone', current_vendor.get('phone')),
+            "phone_e164": normalize_phone(data_to_update.get('phone', current_vendor.get('phone'))),
             "address": data_to_update.get('address', current_vendor.get('address')),
             "cuisine_type": data_to_update.get('cuisine_type', current_vendor.get('cuisine_type')),
             "opening_time": data_to_update.get('opening_time', current_vendor.get('opening_time')),
@@ -3607,6 +6880,7 @@ async def update_restaurant_profile(restaurant_data: dict, current_vendor: Annot
             "image": data_to_update.get('image', ''),
         }}
     )
+    await invalidate_principal(current_vendor['id'])
 
     return {"message": "Restaurant profile updated successfully"}
 
@@ -3993,7 +7267,24 @@ async def validate_food_coupon(data: dict):
 
 # Public Food Order Endpoints
 @api_router.post("/food/orders")
-async def place_food_order(order: dict, current_user: Annotated[dict, Depends(get_current_user)]):
+async def place_food_order(
+    order: dict,
+    current_user: Annotated[dict, Depends(get_current_user)],
+    idempotency_key: Annotated[Optional[str], Header()] = None
+):
+    async def place(idempotency_id):
+        return await insert_food_order(order, current_user, idempotency_id)
+
+    async def recover(idempotency_id):
+        placed = await food_db.food_orders.find_one({"idempotency_id": idempotency_id}, {"_id": 0})
+        return food_order_response(placed) if placed else None
+
+    return await idempotency_store.run("food_order", current_user['id'], idempotency_key, order, place, recover)
+
+def food_order_response(order_doc):
+    return {"id": order_doc['id'], "message": "Order placed successfully", "total": order_doc['total']}
+
+async def insert_food_order(order: dict, current_user, idempotency_id=None):
     order_id = str(uuid.uuid4())
     
     # Financial calculations
@@ -4028,8 +7319,10 @@ async def place_food_order(order: dict, current_user: Annotated[dict, Depends(ge
         "delivery_address": order.get('delivery_address', current_user.get('address', '')),
         "invoice_generated": True
     }
+    if idempotency_id:
+        order_doc['idempotency_id'] = idempotency_id
     await food_db.food_orders.insert_one(order_doc)
-    return {"id": order_id, "message": "Order placed successfully", "total": total_amount}
+    return food_order_response(order_doc)
 
 @api_router.put("/food/orders/{order_id}/status")
 async def update_food_order_status(
@@ -4370,7 +7663,7 @@ async def seed_restaurants():
     return {"message": "Enhanced food data seeded successfully", "restaurants": len(restaurants), "items": len(menu_items)}
 
 @api_router.post("/user/wallet/add")
-async def add_wallet_money(amount: float, current_user: Annotated[dict, Depends(get_current_user)]):
+async def add_wallet_money(amount: float, current_user: Annotated[dict, Depends(get_current_user_fresh)]):
     if amount <= 0:
         raise HTTPException(status_code=400, detail="Amount must be positive")
         
@@ -4384,11 +7677,12 @@ async def add_wallet_money(amount: float, current_user: Annotated[dict, Depends(
         {"id": current_user['id']},
         {"$inc": {"wallet_balance": amount}}
     )
+    await invalidate_principal(current_user['id'])
     
     return {"message": f"Added ₹{amount} to wallet", "new_balance": (current_user.get('wallet_balance', 0) + amount)}
 
 @api_router.post("/user/favorites/restaurants/{restaurant_id}")
-async def toggle_fav_restaurant(restaurant_id: str, current_user: Annotated[dict, Depends(get_current_user)]):
+async def toggle_fav_restaurant(restaurant_id: str, current_user: Annotated[dict, Depends(get_current_user_fresh)]):
     collection = db.users
     if current_user.get('user_type') == "restaurant":
         collection = food_db.restuarent
@@ -4398,9 +7692,11 @@ async def toggle_fav_restaurant(restaurant_id: str, current_user: Annotated[dict
     favorites = current_user.get('favorite_restaurants', [])
     if restaurant_id in favorites:
         await collection.update_one({"id": current_user['id']}, {"$pull": {"favorite_restaurants": restaurant_id}})
+        await invalidate_principal(current_user['id'])
         return {"message": "Removed from favorites", "is_favorite": False}
     else:
         await collection.update_one({"id": current_user['id']}, {"$push": {"favorite_restaurants": restaurant_id}})
+        await invalidate_principal(current_user['id'])
         return {"message": "Added to favorites", "is_favorite": True}
 
 @api_router.put("/delivery/location")
@@ -4412,6 +7708,7 @@ async def update_rider_location(location: dict, current_user: Annotated[dict, De
         {"id": current_user['id']},
         {"$set": {"live_location": location, "availability_status": "online"}}
     )
+    await invalidate_principal(current_user['id'])
     return {"status": "success", "location": location}
 
 @api_router.get("/delivery/orders")
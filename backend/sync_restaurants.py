@@ -5,6 +5,8 @@ import os
 from dotenv import load_dotenv
 from datetime import datetime, timezone
 
+from server import with_login_keys
+
 load_dotenv()
 
 async def sync_restaurants():
@@ -60,7 +62,7 @@ async def sync_restaurants():
         exists = await db.restaurants.find_one({"vendor_id": vendor['id']})
         if not exists:
             # Create public profile
-            rest_doc = {
+            rest_doc = with_login_keys({
                 "id": vendor.get('restaurant_id') or f"rest-{vendor['id'][:6]}",
                 "vendor_id": vendor['id'],
                 "name": vendor.get('restaurant_name') or vendor.get('business_name') or "My Restaurant",
@@ -73,7 +75,7 @@ async def sync_restaurants():
                 "delivery_time": "30-45",
                 "image": "https://images.unsplash.com/photo-1517248135467-4c7edcad34c4?w=600&h=400&fit=crop",
                 "created_at": datetime.now(timezone.utc).isoformat()
-            }
+            })
             await db.restaurants.insert_one(rest_doc)
             print(f"Added public profile for vendor: {rest_doc['name']}")
         else:
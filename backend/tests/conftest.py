@@ -0,0 +1,121 @@
+"""
+Runs server.py against an in-memory mongomock database. Collections are
+wrapped in a thin async shim so the motor-style awaits in server.py work
+unchanged, and every command the server issues is counted per
+(collection, operation) so tests can assert query counts.
+"""
+import asyncio
+import os
+import sys
+from collections import Counter
+from pathlib import Path
+
+import mongomock
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_database")
+# mongomock has no sessions, so checkout runs its writes without a transaction
+os.environ["MONGO_TRANSACTIONS"] = "off"
+
+import server  # noqa: E402
+
+class CommandLog:
+    """Commands issued through the shim; raw is the synchronous database for seeding and asserts."""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.commands = Counter()
+
+    def record(self, collection, operation):
+        self.commands[(collection, operation)] += 1
+
+    def total(self, collection=None):
+        return sum(n for (name, _), n in self.commands.items() if collection in (None, name))
+
+    def clear(self):
+        self.commands.clear()
+
+class AsyncCursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def sort(self, *args, **kwargs):
+        self.cursor = self.cursor.sort(*args, **kwargs)
+        return self
+
+    def limit(self, n):
+        self.cursor = self.cursor.limit(n)
+        return self
+
+    def skip(self, n):
+        self.cursor = self.cursor.skip(n)
+        return self
+
+    def hint(self, *args):
+        return self
+
+    def __aiter__(self):
+        self._iter = iter(self.cursor)
+        return self
+
+    async def __anext__(self):
+        # Yield to the loop like a network round trip would
+        await asyncio.sleep(0)
+        try:
+            return next(self._iter)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def to_list(self, length=None):
+        await asyncio.sleep(0)
+        docs = list(self.cursor)
+        return docs if length is None else docs[:length]
+
+class AsyncCollection:
+    def __init__(self, collection, log):
+        self.collection = collection
+        self.log = log
+
+    def find(self, *args, **kwargs):
+        self.log.record(self.collection.name, "find")
+        return AsyncCursor(self.collection.find(*args, **kwargs))
+
+    def aggregate(self, pipeline, **kwargs):
+        self.log.record(self.collection.name, "aggregate")
+        return AsyncCursor(iter(list(self.collection.aggregate(pipeline))))
+
+    def __getattr__(self, name):
+        attr = getattr(self.collection, name)
+        if not callable(attr):
+            return attr
+
+        async def command(*args, **kwargs):
+            self.log.record(self.collection.name, name)
+            kwargs.pop("session", None)
+            # Interleave concurrent callers between commands
+            await asyncio.sleep(0)
+            return attr(*args, **kwargs)
+        return command
+
+class AsyncDatabase:
+    def __init__(self, database, log):
+        self.database = database
+        self.log = log
+
+    def __getattr__(self, name):
+        return AsyncCollection(self.database[name], self.log)
+
+    def __getitem__(self, name):
+        return AsyncCollection(self.database[name], self.log)
+
+@pytest.fixture
+def mongo(monkeypatch):
+    """Points server.db and server.food_db at a fresh mongomock client."""
+    client = mongomock.MongoClient()
+    log = CommandLog(client["test_database"])
+    monkeypatch.setattr(server, "db", AsyncDatabase(client["test_database"], log))
+    monkeypatch.setattr(server, "food_db", AsyncDatabase(client["restuarent"], log))
+    monkeypatch.setattr(server.response_cache, "enabled", False)
+    return log
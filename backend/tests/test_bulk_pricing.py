@@ -0,0 +1,33 @@
+import pytest
+
+import server
+from bench_pricing import PRICE_FIELDS, make_products
+
+@pytest.mark.parametrize("n", [1, server.BULK_PRICING_MIN_PRODUCTS - 1, server.BULK_PRICING_MIN_PRODUCTS, 2000])
+def test_bulk_matches_scalar_values_and_types(n):
+    products = make_products(n, seed=n)
+
+    scalar = [server.sync_product_price(dict(p)) for p in products]
+    bulk = server.bulk_sync_product_prices([dict(p) for p in products])
+
+    for s, b in zip(scalar, bulk):
+        for field in PRICE_FIELDS:
+            assert (type(b[field]), repr(b[field])) == (type(s[field]), repr(s[field])), (s['id'], field)
+
+def test_int_prices_stay_int():
+    product = {"base_price": 500, "normal_discount_type": "fixed", "normal_discount_value": 50}
+
+    priced = server.bulk_sync_product_prices([dict(product) for _ in range(server.BULK_PRICING_MIN_PRODUCTS)])
+
+    assert priced[0]['price'] == 450 and type(priced[0]['price']) is int
+
+def test_small_batches_leave_datetimes_untouched():
+    from datetime import datetime, timezone
+
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    product = {"base_price": 100.0, "special_offer_enabled": True, "special_offer_start": start}
+
+    priced = server.bulk_sync_product_prices([product])[0]
+
+    assert priced['special_offer_start'] is start
+    assert priced['is_special_active'] is True
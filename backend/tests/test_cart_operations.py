@@ -0,0 +1,46 @@
+import asyncio
+
+import pytest
+from pydantic import ValidationError
+
+import server
+
+USER = {"id": "user-1", "user_type": "user"}
+
+def item(product_id, quantity=1):
+    return {"id": product_id, "name": product_id, "price": 100.0, "quantity": quantity, "image": ""}
+
+def patch(*operations):
+    return asyncio.run(server.patch_cart([server.CartOperation(**op) for op in operations], USER))
+
+def test_move_sees_line_added_earlier_in_the_batch(mongo):
+    mongo.raw.users.insert_one({"id": USER['id'], "cart": [], "wishlist": []})
+
+    result = patch(
+        {"op": "add", "id": "a", "item": item("a", 2)},
+        {"op": "move_to_wishlist", "id": "a"},
+    )
+
+    user = mongo.raw.users.find_one({"id": USER['id']})
+    assert result['cart'] == [] and user['cart'] == []
+    assert [w['id'] for w in user['wishlist']] == ["a"]
+
+def test_move_copies_the_line_as_changed_by_the_batch(mongo):
+    mongo.raw.users.insert_one({"id": USER['id'], "cart": [item("a")], "wishlist": []})
+
+    patch(
+        {"op": "add", "id": "b", "item": item("b")},
+        {"op": "set_qty", "id": "a", "quantity": 5},
+        {"op": "move_to_wishlist", "id": "a"},
+        {"op": "remove", "id": "b"},
+        {"op": "move_to_wishlist", "id": "b"},
+    )
+
+    user = mongo.raw.users.find_one({"id": USER['id']})
+    assert user['cart'] == []
+    # b was removed before its move, so only a reaches the wishlist
+    assert [w['id'] for w in user['wishlist']] == ["a"]
+
+def test_unknown_operation_is_rejected():
+    with pytest.raises(ValidationError):
+        server.CartOperation(op="explode", id="a")
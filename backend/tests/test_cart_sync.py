@@ -0,0 +1,52 @@
+import asyncio
+import re
+
+import server
+
+class ArrayFilterCollection:
+    """
+    Stands in for the users collection: mongomock has no arrayFilters, so
+    this applies "cart.$[slot].field" updates whose filters match on id.
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self.updates = []
+
+    async def update_one(self, query, update, array_filters=None):
+        self.updates.append(update)
+        filters = {f: cond for af in array_filters for f, cond in af.items()}
+        for path, value in update["$set"].items():
+            array, slot, name = re.fullmatch(r"(\w+)\.\$\[(\w+)\]\.(\w+)", path).groups()
+            for line in self.user[array]:
+                if line['id'] == filters[f"{slot}.id"]:
+                    line[name] = value
+
+def sync(collection, products):
+    user = {"id": "u1", "cart": [dict(line) for line in collection.user['cart']]}
+    return asyncio.run(server.refresh_cart_prices(collection, user, product_details=products))
+
+def test_duplicate_lines_reach_steady_state():
+    products = {"p1": {"id": "p1", "price": 90.0, "delivery_type": "fixed", "delivery_charge": 40.0, "free_delivery_above": 0.0}}
+    collection = ArrayFilterCollection({"id": "u1", "cart": [
+        # The first line already has the new price, the second drifted on delivery too
+        {"id": "p1", "price": 90.0, "delivery_type": "free", "delivery_charge": 40.0, "free_delivery_above": 0.0},
+        {"id": "p1", "price": 100.0, "delivery_type": "free", "delivery_charge": 0.0, "free_delivery_above": 0.0},
+    ]})
+
+    first = sync(collection, products)
+    second = sync(collection, products)
+
+    assert len(first['cart_changes']) == 2
+    assert all(line['delivery_charge'] == 40.0 and line['delivery_type'] == "fixed" for line in collection.user['cart'])
+    assert second['cart_changes'] == []
+    assert len(collection.updates) == 1
+
+def test_unchanged_cart_writes_nothing():
+    products = {"p1": {"id": "p1", "price": 90.0}}
+    collection = ArrayFilterCollection({"id": "u1", "cart": [
+        {"id": "p1", "price": 90.0, "delivery_type": "free", "delivery_charge": 0.0, "free_delivery_above": 0.0},
+    ]})
+
+    assert sync(collection, products)['cart_changes'] == []
+    assert collection.updates == []
@@ -0,0 +1,132 @@
+import asyncio
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi import HTTPException
+from pymongo.errors import OperationFailure
+
+import server
+
+SKU = "sku-1"
+
+def order(quantity=1, **kwargs):
+    item = server.OrderItem(product_id=SKU, name="Item", price=499.0, quantity=quantity, image="", vendor_id="vendor-1")
+    return server.OrderCreate(
+        customer_name="Buyer", email="buyer@example.com", address="1 Test Street",
+        items=[item], total_amount=item.price * quantity, **kwargs
+    )
+
+def buyer():
+    return {"id": str(uuid.uuid4()), "user_type": "user"}
+
+async def attempt(order_data, user=None):
+    try:
+        await server.place_order(order_data, user or buyer())
+        return "ok"
+    except HTTPException as e:
+        return e.status_code
+
+def seed_product(mongo, stock):
+    mongo.raw.products.insert_one({"id": SKU, "name": "Item", "price": 499.0, "status": "approved", "stock": stock, "sales_count": 0, "vendor_id": "vendor-1"})
+
+def test_exactly_the_stock_sells_to_concurrent_buyers(mongo):
+    seed_product(mongo, stock=10)
+
+    async def scenario():
+        return Counter(await asyncio.gather(*(attempt(order()) for _ in range(50))))
+
+    assert asyncio.run(scenario()) == {"ok": 10, 409: 40}
+    product = mongo.raw.products.find_one({"id": SKU})
+    assert (product['stock'], product['sales_count'], product.get('stock_holds', {})) == (0, 10, {})
+    assert mongo.raw.orders.count_documents({}) == 10
+
+def test_checkout_aborts_when_the_sweep_released_the_claim(mongo, monkeypatch):
+    seed_product(mongo, stock=1)
+    user = buyer()
+    claim = server.stock_reservations.claim
+
+    async def claim_then_lapse(*args):
+        claimed = await claim(*args)
+        # The claim lapses and a sweep gives the stock back mid-checkout
+        mongo.raw.stock_reservations.update_one(
+            {"id": claimed['id']}, {"$set": {"expires_at": datetime.now(timezone.utc) - timedelta(seconds=1)}}
+        )
+        await server.stock_reservations.sweep()
+        return claimed
+
+    monkeypatch.setattr(server.stock_reservations, "claim", claim_then_lapse)
+
+    async def scenario():
+        reservation = await server.stock_reservations.reserve(user['id'], order().items, ttl=60)
+        return await attempt(order(reservation_id=reservation['id']), user)
+
+    assert asyncio.run(scenario()) == 409
+    assert mongo.raw.orders.count_documents({}) == 0
+    product = mongo.raw.products.find_one({"id": SKU})
+    assert (product['stock'], product['sales_count']) == (1, 0)
+
+def test_checkout_command_count_does_not_grow_with_the_cart(mongo):
+    counts = {}
+    for lines in (1, 30):
+        mongo.raw.client.drop_database(mongo.raw.name)
+        mongo.raw.products.insert_many([
+            {"id": f"sku-{i}", "name": f"Item {i}", "price": 100.0, "status": "approved", "stock": 10, "sales_count": 0}
+            for i in range(lines)
+        ])
+        items = [
+            server.OrderItem(product_id=f"sku-{i}", name=f"Item {i}", price=100.0, quantity=1, image="", vendor_id=f"vendor-{i % 3}")
+            for i in range(lines)
+        ]
+        order_data = server.OrderCreate(
+            customer_name="Buyer", email="buyer@example.com", address="1 Test Street",
+            items=items, total_amount=100.0 * lines
+        )
+        mongo.clear()
+        assert asyncio.run(attempt(order_data)) == "ok"
+        counts[lines] = mongo.total()
+
+    assert counts[1] == counts[30]
+
+def seed_coupon(mongo):
+    mongo.raw.coupons.insert_one(server.Coupon(
+        vendor_id="vendor-1", code="SAVE10", discount="10%", limit=5, expires="2999-12-31"
+    ).model_dump())
+
+def failing(collection, monkeypatch, name):
+    def fail(*args, **kwargs):
+        raise OperationFailure("write failed")
+    monkeypatch.setattr(collection, name, fail)
+
+def test_failure_after_the_order_keeps_its_stock_and_coupon(mongo, monkeypatch):
+    seed_product(mongo, stock=3)
+    seed_coupon(mongo)
+    failing(mongo.raw.notifications, monkeypatch, "insert_many")
+
+    assert asyncio.run(attempt(order(coupon_code="SAVE10"))) == "ok"
+
+    assert mongo.raw.orders.count_documents({}) == 1
+    assert mongo.raw.products.find_one({"id": SKU})['stock'] == 2
+    assert mongo.raw.coupons.find_one({"code": "SAVE10"})['usage'] == 1
+
+def test_failure_before_the_order_gives_stock_and_coupon_back(mongo, monkeypatch):
+    seed_product(mongo, stock=3)
+    seed_coupon(mongo)
+    failing(mongo.raw.orders, monkeypatch, "insert_one")
+
+    with pytest.raises(OperationFailure):
+        asyncio.run(server.place_order(order(coupon_code="SAVE10"), buyer()))
+
+    assert mongo.raw.products.find_one({"id": SKU})['stock'] == 3
+    assert mongo.raw.coupons.find_one({"code": "SAVE10"})['usage'] == 0
+
+def test_products_hidden_from_the_catalog_cannot_be_bought(mongo):
+    seed_product(mongo, stock=5)
+    mongo.raw.products.update_one({"id": SKU}, {"$set": {"status": "pending"}})
+
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(server.place_order(order(), buyer()))
+
+    assert (e.value.status_code, e.value.detail) == (409, f"No longer available: {SKU}")
+    assert mongo.raw.products.find_one({"id": SKU})['stock'] == 5
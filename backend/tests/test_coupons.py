@@ -0,0 +1,47 @@
+import asyncio
+import uuid
+from collections import Counter
+
+from fastapi import HTTPException
+
+import server
+
+CODE = "LASTONE"
+
+def seed_coupon(mongo, limit, usage):
+    mongo.raw.coupons.insert_one(server.Coupon(
+        vendor_id="vendor-1", code=CODE, discount="10%", limit=limit, usage=usage, expires="2999-12-31"
+    ).model_dump())
+
+async def outcome(call):
+    try:
+        await call
+        return "ok"
+    except HTTPException as e:
+        return e.detail
+
+def test_one_of_many_concurrent_redemptions_gets_the_last_use(mongo):
+    seed_coupon(mongo, limit=10, usage=9)
+
+    async def scenario():
+        return Counter(await asyncio.gather(*(outcome(server.redeem_coupon(CODE)) for _ in range(25))))
+
+    assert asyncio.run(scenario()) == {"ok": 1, "Coupon usage limit exceeded.": 24}
+    assert mongo.raw.coupons.find_one({"code": CODE})['usage'] == 10
+
+def test_one_of_many_concurrent_checkouts_gets_the_last_use(mongo):
+    seed_coupon(mongo, limit=10, usage=9)
+    mongo.raw.products.insert_one({"id": "sku-1", "name": "Item", "price": 499.0, "status": "approved", "stock": 100, "sales_count": 0, "vendor_id": "vendor-1"})
+    item = server.OrderItem(product_id="sku-1", name="Item", price=499.0, quantity=1, image="", vendor_id="vendor-1")
+    order_data = server.OrderCreate(
+        customer_name="Buyer", email="buyer@example.com", address="1 Test Street",
+        items=[item], total_amount=item.price, coupon_code=CODE
+    )
+
+    async def scenario():
+        checkouts = (server.place_order(order_data, {"id": str(uuid.uuid4()), "user_type": "user"}) for _ in range(25))
+        return Counter(await asyncio.gather(*(outcome(c) for c in checkouts)))
+
+    assert asyncio.run(scenario()) == {"ok": 1, "Coupon usage limit exceeded.": 24}
+    assert mongo.raw.coupons.find_one({"code": CODE})['usage'] == 10
+    assert mongo.raw.orders.count_documents({"coupon_code": CODE}) == 1
@@ -0,0 +1,66 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import server
+
+def deal_product(product_id, starts_at, ends_at, is_special_active):
+    return {
+        "id": product_id,
+        "base_price": 1000.0,
+        "price": 900.0 if is_special_active else 1000.0,
+        "originalPrice": 1000.0,
+        "discount": 10 if is_special_active else 0,
+        "is_special_active": is_special_active,
+        "special_offer_enabled": True,
+        "special_offer_type": "percentage",
+        "special_offer_value": 10.0,
+        "special_offer_start": starts_at.isoformat(),
+        "special_offer_end": ends_at.isoformat(),
+        "deal_starts_at": starts_at,
+        "deal_ends_at": ends_at,
+    }
+
+def test_only_one_worker_holds_the_lease(mongo):
+    first, second = server.DealScheduler(), server.DealScheduler()
+
+    async def scenario():
+        held = [await first.acquire_lease(), await second.acquire_lease()]
+        # Renewing keeps it; stopping hands it over
+        held.append(await first.acquire_lease())
+        await first.stop()
+        held.append(await second.acquire_lease())
+        return held
+
+    assert asyncio.run(scenario()) == [True, False, True, True]
+
+def test_lapsed_lease_is_taken_over(mongo):
+    crashed, survivor = server.DealScheduler(), server.DealScheduler()
+
+    async def scenario():
+        await crashed.acquire_lease()
+        mongo.raw.scheduler_leases.update_one(
+            {"_id": server.DEAL_LEASE_ID},
+            {"$set": {"expires_at": datetime.now(timezone.utc) - timedelta(seconds=1)}}
+        )
+        return await survivor.acquire_lease()
+
+    assert asyncio.run(scenario()) is True
+    assert mongo.raw.scheduler_leases.find_one()['owner'] == survivor.owner
+
+def test_poll_reprices_boundaries_scheduled_elsewhere(mongo):
+    now = datetime.now(timezone.utc)
+    mongo.raw.products.insert_many([
+        # Started after another worker saved it as inactive
+        deal_product("started", now - timedelta(minutes=1), now + timedelta(hours=1), False),
+        # Ended while still stored as active
+        deal_product("ended", now - timedelta(hours=2), now - timedelta(minutes=1), True),
+        # Already correct
+        deal_product("running", now - timedelta(hours=1), now + timedelta(hours=1), True),
+    ])
+
+    changed = asyncio.run(server.DealScheduler().poll())
+
+    assert sorted(p['id'] for p in changed) == ["ended", "started"]
+    stored = {p['id']: p for p in mongo.raw.products.find()}
+    assert (stored["started"]['is_special_active'], stored["started"]['price']) == (True, 900.0)
+    assert (stored["ended"]['is_special_active'], stored["ended"]['price']) == (False, 1000.0)
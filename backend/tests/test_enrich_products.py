@@ -0,0 +1,53 @@
+import asyncio
+
+from bson import ObjectId
+
+import server
+
+def seed_page(mongo, n):
+    """n products spread over vendors found by each lookup in resolve_vendors."""
+    legacy_vendor = ObjectId()
+    legacy_user = ObjectId()
+    mongo.raw.vendors.insert_many([
+        {"id": "vendor-a", "business_name": "Vendor A"},
+        {"_id": legacy_vendor, "business_name": "Legacy Vendor"},
+    ])
+    mongo.raw.users.insert_many([
+        {"id": "user-b", "name": "User B"},
+        {"_id": legacy_user, "name": "Legacy User"},
+    ])
+    mongo.raw.vendor_stats.insert_one({"vendor_id": "vendor-a", "rating_sum": 9, "review_count": 2})
+    vendor_ids = ["vendor-a", "user-b", str(legacy_vendor), str(legacy_user), "missing"]
+    return [
+        {"id": f"p{i}", "vendor_id": vendor_ids[i % len(vendor_ids)], "rating_sum": 4 * i, "rating_count": i}
+        for i in range(n)
+    ]
+
+def test_enrich_products_query_count_is_fixed(mongo):
+    counts = {}
+    for n in (5, 50):
+        mongo.raw.client.drop_database(mongo.raw.name)
+        products = seed_page(mongo, n)
+        mongo.clear()
+        enriched = asyncio.run(server.enrich_products(products))
+        counts[n] = mongo.total()
+        assert len(enriched) == n
+
+    # vendors.id, users.id, vendors._id, users._id and vendor_stats
+    assert counts == {5: 5, 50: 5}
+
+def test_enrich_products_resolves_every_vendor_kind(mongo):
+    products = asyncio.run(server.enrich_products(seed_page(mongo, 5)))
+
+    names = [p['vendor_name'] for p in products]
+    assert names == ["Vendor A", "User B", "Legacy Vendor", "Legacy User", "Unknown Vendor"]
+    assert products[0]['vendor']['business_id'] == "vendor-a"
+    assert products[0]['vendor']['business_reviews_count'] == 2
+    assert (products[1]['rating'], products[1]['reviewsCount']) == (4.0, 1)
+
+def test_enrich_products_skips_queries_for_resolved_vendors(mongo):
+    mongo.raw.vendors.insert_one({"id": "vendor-a", "business_name": "Vendor A"})
+    mongo.clear()
+    asyncio.run(server.enrich_products([{"id": f"p{i}", "vendor_id": "vendor-a"} for i in range(20)]))
+
+    assert mongo.total() == 2
@@ -0,0 +1,92 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+import server
+
+GUEST = "guest-0001"
+USER = {"id": "user-1", "user_type": "user"}
+
+def line(product_id, quantity):
+    return {"id": product_id, "name": product_id, "price": 100.0, "quantity": quantity, "image": ""}
+
+def seed(mongo):
+    mongo.raw.carts.insert_one({"guest_id": GUEST, "items": [line("a", 2), line("b", 1), line("c", 4)]})
+    mongo.raw.users.insert_one({"id": USER['id'], "cart": [line("a", 1)]})
+
+def user_cart(mongo):
+    return {item['id']: item['quantity'] for item in mongo.raw.users.find_one({"id": USER['id']})['cart']}
+
+def test_merge_sums_lines_and_deletes_the_guest_cart(mongo):
+    seed(mongo)
+
+    result = asyncio.run(server.merge_guest_cart(USER, GUEST))
+
+    assert result['merged'] == 3
+    assert user_cart(mongo) == {"a": 3, "b": 1, "c": 4}
+    assert mongo.raw.carts.count_documents({}) == 0
+
+def test_concurrent_merges_apply_the_guest_cart_once(mongo):
+    seed(mongo)
+
+    async def scenario():
+        return await asyncio.gather(*(server.merge_guest_cart(USER, GUEST) for _ in range(3)))
+
+    results = asyncio.run(scenario())
+
+    assert sorted(r['merged'] for r in results) == [0, 0, 3]
+    assert user_cart(mongo) == {"a": 3, "b": 1, "c": 4}
+
+def test_failed_merge_keeps_unmerged_lines_for_a_retry(mongo, monkeypatch):
+    seed(mongo)
+    bulk_write = mongo.raw.users.bulk_write
+
+    def fail_after_first_line(ops, **kwargs):
+        bulk_write(ops[:2], **kwargs)
+        raise BulkWriteError({"writeErrors": [{"index": 2, "code": 1, "errmsg": "boom"}]})
+
+    monkeypatch.setattr(mongo.raw.users, "bulk_write", fail_after_first_line)
+    with pytest.raises(BulkWriteError):
+        asyncio.run(server.merge_guest_cart(USER, GUEST))
+
+    guest_cart = mongo.raw.carts.find_one({"guest_id": GUEST})
+    assert [item['id'] for item in guest_cart['items']] == ["b", "c"]
+    assert "merge_id" not in guest_cart
+    assert user_cart(mongo) == {"a": 3}
+
+def test_retry_after_failed_merge_adds_each_line_once(mongo, monkeypatch):
+    seed(mongo)
+    bulk_write = mongo.raw.users.bulk_write
+    calls = []
+
+    def fail_once(ops, **kwargs):
+        calls.append(len(ops))
+        if len(calls) == 1:
+            bulk_write(ops[:2], **kwargs)
+            raise BulkWriteError({"writeErrors": [{"index": 2, "code": 1, "errmsg": "boom"}]})
+        return bulk_write(ops, **kwargs)
+
+    monkeypatch.setattr(mongo.raw.users, "bulk_write", fail_once)
+    with pytest.raises(BulkWriteError):
+        asyncio.run(server.merge_guest_cart(USER, GUEST))
+    asyncio.run(server.merge_guest_cart(USER, GUEST))
+
+    assert user_cart(mongo) == {"a": 3, "b": 1, "c": 4}
+    assert mongo.raw.carts.count_documents({}) == 0
+
+def test_add_reports_a_conflict_when_retries_run_out(mongo, monkeypatch):
+    mongo.raw.products.insert_one({"id": "a", "name": "A", "price": 100.0, "base_price": 100.0})
+    update_one = mongo.raw.carts.update_one
+
+    def always_collide(filter, update, upsert=False, **kwargs):
+        if upsert:
+            raise DuplicateKeyError("E11000 duplicate key error")
+        return update_one(filter, update, **kwargs)
+
+    monkeypatch.setattr(mongo.raw.carts, "update_one", always_collide)
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(server.add_to_guest_cart(server.CartItem(**line("a", 1)), GUEST))
+
+    assert e.value.status_code == 409
@@ -0,0 +1,87 @@
+import asyncio
+
+import server
+
+USER = {"id": "user-1", "user_type": "user"}
+
+def fresh_buffer(monkeypatch, **kwargs):
+    options = {"flush_seconds": server.history_buffer.flush_seconds, "max_pending": 5000, **kwargs}
+    buffer = server.HistoryBuffer(**options)
+    monkeypatch.setattr(server, "history_buffer", buffer)
+    return buffer
+
+def test_history_endpoints_do_not_wait_on_the_database_by_default(mongo, monkeypatch):
+    buffer = fresh_buffer(monkeypatch)
+    assert buffer.enabled
+
+    async def scenario():
+        for product_id in ("a", "b", "a"):
+            await server.append_recently_viewed(product_id, USER)
+        await server.append_recent_search(USER, "Shoes")
+        requests = mongo.total()
+        await buffer.flush()
+        return requests
+
+    assert asyncio.run(scenario()) == 0
+    # One bulk write for both coalesced fields
+    assert mongo.commands == {("users", "bulk_write"): 1}
+    assert buffer.stats["coalesced"] == 2
+
+def test_full_buffer_flushes_in_the_background(mongo, monkeypatch):
+    buffer = fresh_buffer(monkeypatch, max_pending=2)
+
+    async def scenario():
+        await server.append_recently_viewed("a", USER)
+        await server.append_recently_viewed("a", {"id": "user-2", "user_type": "user"})
+        requests = mongo.total()
+        await buffer.stop()
+        return requests
+
+    assert asyncio.run(scenario()) == 0
+    assert mongo.commands == {("users", "bulk_write"): 1}
+    assert buffer.metrics()["pending"] == 0
+
+def test_zero_interval_writes_inline(mongo, monkeypatch):
+    buffer = fresh_buffer(monkeypatch, flush_seconds=0)
+
+    asyncio.run(server.append_pickup_item("a", USER))
+
+    assert not buffer.enabled
+    assert mongo.commands == {("users", "update_one"): 1}
+
+def apply_update(mongo, field, values):
+    """Runs the pipeline update's stages as an aggregation; mongomock has no pipeline updates."""
+    pipeline = [{"$match": {"id": USER['id']}}, *server.history_prepend_update(field, values)]
+    return list(mongo.raw.users.aggregate(pipeline))[0][field]
+
+def bare_strings(update):
+    """Strings in the update outside $literal, which MongoDB may read as expressions."""
+    if isinstance(update, dict):
+        return [v for key, value in update.items() if key != "$literal" for v in bare_strings(value)]
+    if isinstance(update, list):
+        return [v for value in update for v in bare_strings(value)]
+    return [update] if isinstance(update, str) else []
+
+def test_prepend_dedupes_orders_and_caps(mongo):
+    mongo.raw.users.insert_one({"id": USER['id'], "recently_viewed": [f"p{i}" for i in range(20)]})
+
+    viewed = apply_update(mongo, "recently_viewed", ["p5", "new"])
+
+    assert viewed[:3] == ["p5", "new", "p0"]
+    assert len(viewed) == server.HISTORY_LIMITS["recently_viewed"]
+    assert viewed.count("p5") == 1 and "p19" not in viewed
+
+def test_searches_dedupe_case_insensitively(mongo):
+    mongo.raw.users.insert_one({"id": USER['id'], "recent_searches": ["Shoes", "hats"]})
+
+    assert apply_update(mongo, "recent_searches", ["shoes"]) == ["shoes", "hats"]
+
+def test_values_starting_with_a_dollar_stay_literal(mongo):
+    mongo.raw.users.insert_one({"id": USER['id'], "password": "hash", "email": "a@b.c", "recent_searches": ["$email"]})
+
+    searches = apply_update(mongo, "recent_searches", ["$password", "$EMAIL"])
+
+    assert searches == ["$password", "$EMAIL"]
+    for field in ("recent_searches", "recently_viewed"):
+        update = server.history_prepend_update(field, ["$password", "$$ROOT"])
+        assert not {"$password", "$$ROOT", "$$root"} & set(bare_strings(update))
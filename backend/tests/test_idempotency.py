@@ -0,0 +1,71 @@
+import asyncio
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi import Response
+from pymongo.errors import OperationFailure
+
+import server
+
+USER = {"id": "user-1", "user_type": "user"}
+KEY = "order-attempt-1"
+
+def order():
+    item = server.OrderItem(product_id="sku-1", name="Item", price=499.0, quantity=1, image="", vendor_id="vendor-1")
+    return server.OrderCreate(
+        customer_name="Buyer", email="buyer@example.com", address="1 Test Street",
+        items=[item], total_amount=item.price
+    )
+
+def checkout():
+    return asyncio.run(server.checkout(order(), None, Response(), USER, KEY))
+
+def body(result):
+    return json.loads(result.body) if isinstance(result, Response) else result
+
+@pytest.fixture
+def store(mongo, monkeypatch):
+    mongo.raw.products.insert_one({"id": "sku-1", "name": "Item", "price": 499.0, "status": "approved", "stock": 5, "sales_count": 0, "vendor_id": "vendor-1"})
+    store = server.IdempotencyStore(poll_seconds=0)
+    monkeypatch.setattr(server, "idempotency_store", store)
+    return store
+
+def lapse_lease(mongo):
+    mongo.raw.idempotency_keys.update_one({}, {"$set": {"lease_until": datetime.now(timezone.utc) - timedelta(seconds=1)}})
+
+def test_retry_after_a_lost_response_returns_the_placed_order(mongo, store, monkeypatch):
+    store_response = store._store
+
+    async def fail_store(*args):
+        raise OperationFailure("write failed")
+
+    monkeypatch.setattr(store, "_store", fail_store)
+    with pytest.raises(OperationFailure):
+        checkout()
+    monkeypatch.setattr(store, "_store", store_response)
+    lapse_lease(mongo)
+
+    first = mongo.raw.orders.find_one()
+    retried = body(checkout())
+
+    assert mongo.raw.orders.count_documents({}) == 1
+    assert retried == server.placed_order_response(first)
+    assert mongo.raw.products.find_one({"id": "sku-1"})['stock'] == 4
+    assert store.stats["recovered"] == 1
+    # Later retries replay the stored response
+    assert body(checkout()) == retried
+
+def test_retry_after_the_record_was_dropped_returns_the_placed_order(mongo, store):
+    placed = body(checkout())
+    # The holder placed the order but its record went, e.g. cancelled mid-store
+    mongo.raw.idempotency_keys.delete_many({})
+
+    assert body(checkout()) == placed
+    assert mongo.raw.orders.count_documents({}) == 1
+
+def test_recovered_response_matches_the_original(mongo, store):
+    placed = body(checkout())
+
+    assert placed == server.placed_order_response(mongo.raw.orders.find_one())
+    assert set(placed) == {"message", "order_id", *server.ORDER_QUOTE_FIELDS}
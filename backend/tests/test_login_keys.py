@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import server
+
+@pytest.fixture
+def legacy_user(mongo, monkeypatch):
+    """An account written before login keys existed."""
+    monkeypatch.setattr(server, "legacy_login_collections", set())
+    mongo.raw.users.insert_one({
+        "id": "u1", "name": "Legacy", "email": "Foo@Example.com", "phone": "9876543210",
+        "password": server.pwd_context.hash("secret"), "user_type": "user", "token_version": 1,
+    })
+    asyncio.run(server.ensure_login_key_indexes())
+    return mongo
+
+def login(identifier, password="secret"):
+    return asyncio.run(server.login_user(server.UserLogin(identifier=identifier, password=password), None))
+
+def test_legacy_account_logs_in_and_gets_keys(legacy_user):
+    assert "users" in server.legacy_login_collections
+
+    user = login("foo@example.com")
+
+    assert user['id'] == "u1" and user['token']
+    stored = legacy_user.raw.users.find_one({"id": "u1"})
+    assert (stored['email_lc'], stored['phone_e164']) == ("foo@example.com", "+919876543210")
+
+def test_keyed_lookup_after_first_login(legacy_user):
+    login("foo@example.com")
+    legacy_user.clear()
+
+    assert login("+91 98765 43210")['id'] == "u1"
+    assert legacy_user.commands[("users", "find_one")] == 1
+
+def test_legacy_phone_matches_verify_otp(legacy_user):
+    result = asyncio.run(server.verify_otp("9876543210", "123456"))
+
+    assert result['user_exists'] is True and result['id'] == "u1"
+
+def test_signup_rejects_legacy_duplicate(legacy_user):
+    data = server.UserCreate(name="Dup", email="FOO@example.com", password="x")
+
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(server.signup_user(data))
+    assert e.value.status_code == 400
+
+def test_fallback_off_once_backfilled(legacy_user):
+    asyncio.run(server.backfill_login_keys(fix=True))
+    asyncio.run(server.ensure_login_key_indexes())
+
+    assert server.legacy_login_collections == set()
+    assert login("FOO@example.com")['id'] == "u1"
+    with pytest.raises(HTTPException) as e:
+        login("nobody@example.com")
+    assert e.value.status_code == 404
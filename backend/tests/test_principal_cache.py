@@ -0,0 +1,51 @@
+import pytest
+
+import server
+
+@pytest.mark.parametrize("env, expected", [
+    ({}, True),
+    ({"WEB_CONCURRENCY": "1"}, True),
+    ({"WEB_CONCURRENCY": "4"}, False),
+    ({"WEB_CONCURRENCY": "4", "RESPONSE_CACHE_BACKEND": "mongo"}, True),
+    ({"WEB_CONCURRENCY": "4", "PRINCIPAL_CACHE_ENABLED": "1"}, True),
+    ({"PRINCIPAL_CACHE_ENABLED": "0"}, False),
+])
+def test_cache_needs_shared_purges_with_several_workers(monkeypatch, env, expected):
+    for name in ("WEB_CONCURRENCY", "RESPONSE_CACHE_BACKEND", "PRINCIPAL_CACHE_ENABLED"):
+        monkeypatch.delenv(name, raising=False)
+    for name, value in env.items():
+        monkeypatch.setenv(name, value)
+
+    assert server.principal_cache_enabled() is expected
+
+def test_disabled_cache_always_misses():
+    cache = server.PrincipalCache(max_entries=10, ttl=30, enabled=False)
+    cache.set("u1", 1, {"id": "u1"})
+
+    assert cache.get("u1", 1) is None
+
+def test_purge_invalidates_cached_principal():
+    cache = server.PrincipalCache(max_entries=10, ttl=30)
+    cache.set("u1", 1, {"id": "u1"})
+    cache.on_purge(["principal:u1"])
+
+    assert cache.get("u1", 1) is None
+
+def test_handlers_cannot_change_the_cached_principal():
+    cache = server.PrincipalCache(max_entries=10, ttl=30)
+    user = {"id": "u1", "user_type": "user", "address": {"city": "Pune"}, "favorite_restaurants": ["r1"]}
+    cache.set("u1", 1, user)
+
+    # Changes to the source document and to a served copy stay out of the cache
+    user["address"]["city"] = "Goa"
+    served = cache.get("u1", 1)
+    served["address"]["city"] = "Delhi"
+    served["favorite_restaurants"].append("r2")
+
+    assert cache.get("u1", 1) == {"id": "u1", "user_type": "user", "address": {"city": "Pune"}, "favorite_restaurants": ["r1"]}
+
+def test_cached_principal_leaves_out_password_and_cart():
+    cache = server.PrincipalCache(max_entries=10, ttl=30)
+    cache.set("u1", 1, {"id": "u1", "password": "$2b$hash", "cart": [{"id": "p1"}], "recent_searches": ["shoes"]})
+
+    assert cache.get("u1", 1) == {"id": "u1"}
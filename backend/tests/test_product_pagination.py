@@ -0,0 +1,67 @@
+import asyncio
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import server
+
+def fetch_all(sort, limit):
+    """Walks every page of GET /api/products and returns the ids in order."""
+    ids, cursor = [], ""
+    while True:
+        response = asyncio.run(server.list_public_products(limit=limit, sort=sort, cursor=cursor))
+        page = json.loads(response.body)
+        ids += [p['id'] for p in page['items']]
+        cursor = page['next_cursor']
+        if not cursor:
+            return ids
+
+@pytest.mark.parametrize("sort", ["newest", "trending", "price_low", "price_high"])
+def test_pages_cover_every_product_once(mongo, sort):
+    docs = []
+    for i in range(23):
+        doc = {"id": f"p{i:02d}", "status": "approved", "price": float(i % 4 * 100), "created_at": f"2024-01-{i % 5 + 1:02d}"}
+        # Legacy documents lack the counters the sorts use
+        if i % 3:
+            doc["sales_count"] = i % 4
+        docs.append(doc)
+    mongo.raw.products.insert_many(docs)
+
+    ids = fetch_all(sort, limit=4)
+
+    assert sorted(ids) == sorted(d['id'] for d in docs)
+    assert len(ids) == len(set(ids))
+
+@pytest.mark.parametrize("sort", ["newest", "trending", "price_low", "price_high"])
+def test_pages_continue_past_bson_date_keys(mongo, sort):
+    now = datetime.now(timezone.utc)
+    mongo.raw.products.insert_many([
+        {"id": f"p{i}", "status": "approved", "price": 100.0, "sales_count": i % 2, "created_at": now - timedelta(days=i)}
+        for i in range(6)
+    ])
+
+    ids = fetch_all(sort, limit=2)
+
+    assert sorted(ids) == [f"p{i}" for i in range(6)]
+    assert len(ids) == len(set(ids))
+
+def test_ending_soon_deals_page_past_the_first_page(mongo):
+    now = datetime.now(timezone.utc)
+    mongo.raw.products.insert_many([{
+        "id": f"d{i}", "status": "approved", "price": 90.0, "special_offer_enabled": True,
+        "deal_starts_at": now - timedelta(hours=1), "deal_ends_at": now + timedelta(hours=i + 1),
+    } for i in range(6)])
+
+    ids = fetch_all("ending_soon", limit=2)
+
+    assert ids == [f"d{i}" for i in range(6)]
+
+def test_legacy_documents_without_id_page_through(mongo):
+    mongo.raw.products.insert_many([
+        {"status": "approved", "created_at": datetime(2024, 1, i + 1, tzinfo=timezone.utc)} for i in range(5)
+    ])
+
+    ids = fetch_all("newest", limit=2)
+
+    assert len(ids) == 5 and len(set(ids)) == 5
@@ -0,0 +1,73 @@
+import asyncio
+import time
+
+import server
+
+def line(product_id, quantity):
+    return server.OrderLine(product_id=product_id, quantity=quantity)
+
+def cache_product_page(product_id):
+    key = ("product", product_id)
+    server.response_cache.set(key, {"id": product_id}, {f"product:{product_id}"}, 60, time.monotonic())
+    return key
+
+def test_reserve_and_release_purge_cached_product_pages(mongo, monkeypatch):
+    monkeypatch.setattr(server.response_cache, "enabled", True)
+    mongo.raw.products.insert_one({"id": "p1", "stock": 5})
+
+    async def scenario():
+        key = cache_product_page("p1")
+        reservation = await server.stock_reservations.reserve("u1", [line("p1", 2)], ttl=60)
+        after_reserve = server.response_cache.get(key)
+
+        cache_product_page("p1")
+        await server.stock_reservations.release(reservation)
+        return after_reserve, server.response_cache.get(key)
+
+    assert asyncio.run(scenario()) == (None, None)
+    assert mongo.raw.products.find_one({"id": "p1"})['stock'] == 5
+
+def test_sweep_purges_cached_product_pages(mongo, monkeypatch):
+    monkeypatch.setattr(server.response_cache, "enabled", True)
+    mongo.raw.products.insert_one({"id": "p1", "stock": 5})
+
+    async def scenario():
+        await server.stock_reservations.reserve("u1", [line("p1", 2)], ttl=0)
+        key = cache_product_page("p1")
+        swept = await server.stock_reservations.sweep()
+        return swept, server.response_cache.get(key)
+
+    assert asyncio.run(scenario()) == (1, None)
+
+VENDOR = {"id": "v1", "user_type": "vendor"}
+
+def test_vendor_stock_write_leaves_room_for_open_holds(mongo):
+    mongo.raw.products.insert_one({"id": "p1", "vendor_id": "v1", "stock": 5})
+
+    async def scenario():
+        reservation = await server.stock_reservations.reserve("u1", [line("p1", 2)], ttl=60)
+        await server.update_product_stock("p1", {"stock": 10}, VENDOR)
+        during = mongo.raw.products.find_one({"id": "p1"})['stock']
+        await server.stock_reservations.release(reservation)
+        return during
+
+    # 2 of the 10 on hand are still held, and come back on release
+    assert asyncio.run(scenario()) == 8
+    assert mongo.raw.products.find_one({"id": "p1"})['stock'] == 10
+
+def test_vendor_stock_write_retries_when_a_hold_moves(mongo, monkeypatch):
+    mongo.raw.products.insert_one({"id": "p1", "vendor_id": "v1", "stock": 5})
+    find_one = mongo.raw.products.find_one
+    reserved = []
+
+    def reserve_between_read_and_write(*args, **kwargs):
+        product = find_one(*args, **kwargs)
+        if not reserved:
+            # Another checkout holds 3 units after stock_holds was read
+            reserved.append(mongo.raw.products.update_one({"id": "p1"}, {"$inc": {"stock": -3}, "$set": {"stock_holds.r1": 3}}))
+        return product
+
+    monkeypatch.setattr(mongo.raw.products, "find_one", reserve_between_read_and_write)
+    asyncio.run(server.update_product_stock("p1", {"stock": 10}, VENDOR))
+
+    assert mongo.raw.products.find_one({"id": "p1"})['stock'] == 7
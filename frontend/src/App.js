@@ -361,8 +361,7 @@ const RecentlyViewedProvider = ({ children }) => {
         if (user?.id) {
           try {
             const token = localStorage.getItem('token');
-            const ids = newList.map(p => p.id);
-            await axios.put(`${API}/users/recently-viewed`, ids, {
+            await axios.post(`${API}/users/recently-viewed/${product.id}`, null, {
               headers: { Authorization: `Bearer ${token}` }
             });
           } catch (e) { }
@@ -383,8 +382,7 @@ const RecentlyViewedProvider = ({ children }) => {
         if (user?.id) {
           try {
             const token = localStorage.getItem('token');
-            const ids = newList.map(p => p.id);
-            await axios.put(`${API}/users/pickup-items`, ids, {
+            await axios.post(`${API}/users/pickup-items/${product.id}`, null, {
               headers: { Authorization: `Bearer ${token}` }
             });
           } catch (e) { }
@@ -403,19 +401,59 @@ const RecentlyViewedProvider = ({ children }) => {
   );
 };
 
+// Guests keep their cart on the server under an id generated once per browser
+const GUEST_ID_KEY = 'DACHCart_guest_id';
+
+const getGuestId = () => {
+  let guestId = localStorage.getItem(GUEST_ID_KEY);
+  if (!guestId) {
+    guestId = window.crypto?.randomUUID ? window.crypto.randomUUID() : `${Date.now()}-${Math.random().toString(36).slice(2, 12)}`;
+    localStorage.setItem(GUEST_ID_KEY, guestId);
+  }
+  return guestId;
+};
+
+const guestHeaders = () => ({ 'X-Guest-Id': getGuestId() });
+
+const cartItemPayload = (product) => ({
+  id: product.id,
+  name: product.name,
+  price: product.price,
+  quantity: product.quantity || 1,
+  image: product.image || (product.images && product.images[0]) || "",
+  vendor_id: product.vendor_id,
+  category: product.category,
+  delivery_type: product.delivery_type,
+  delivery_charge: product.delivery_charge,
+  free_delivery_above: product.free_delivery_above,
+  selected: true
+});
+
 const CartProvider = ({ children }) => {
   const { user } = useAuth();
   const [cartItems, setCartItems] = useState([]);
   const cartLoaded = useRef(false);
-  const userKey = user?.id ? `DACHCart_cart_${user.id}` : 'DACHCart_cart_guest';
+  const userKey = user?.id ? `DACHCart_cart_${user.id}` : null;
 
   // Load cart when user changes
   useEffect(() => {
     const fetchCart = async () => {
       cartLoaded.current = false;
-      const guestItems = JSON.parse(localStorage.getItem('DACHCart_cart_guest') || '[]');
       let finalCart = [];
 
+      // Carts saved in local storage before guest carts moved to the server
+      const legacyItems = JSON.parse(localStorage.getItem('DACHCart_cart_guest') || '[]');
+      if (legacyItems.length > 0) {
+        try {
+          for (const item of legacyItems) {
+            await axios.post(`${API}/guest/cart/items`, cartItemPayload(item), { headers: guestHeaders() });
+          }
+          localStorage.removeItem('DACHCart_cart_guest');
+        } catch (e) {
+          console.error("Failed to move saved cart to the server", e);
+        }
+      }
+
       if (user?.id) {
         try {
           const token = localStorage.getItem('token');
@@ -424,47 +462,27 @@ const CartProvider = ({ children }) => {
             headers: { Authorization: `Bearer ${token}` }
           });
           if (response.data && response.data.cart) {
-            let updatedCart = response.data.cart;
-            if (guestItems.length > 0) {
-              const userCartIds = new Set(updatedCart.map(i => i.id));
-              const uniqueGuestItems = guestItems.filter(i => !userCartIds.has(i.id));
-              if (uniqueGuestItems.length > 0) {
-                for (const item of uniqueGuestItems) {
-                  await axios.post(`${API}/users/cart/items`, item, {
-                    headers: { Authorization: `Bearer ${token}` }
-                  });
-                }
-                const refetch = await axios.get(`${API}/users/sync`, {
-                  headers: { Authorization: `Bearer ${token}` }
-                });
-                updatedCart = refetch.data.cart;
-                localStorage.removeItem('DACHCart_cart_guest');
-              }
+            finalCart = response.data.cart;
+          }
+          if (localStorage.getItem(GUEST_ID_KEY)) {
+            // Fold the guest cart into the account; the server deletes it once merged
+            const merge = await axios.post(`${API}/users/cart/merge`, null, {
+              headers: { Authorization: `Bearer ${token}`, ...guestHeaders() }
+            });
+            if (merge.data.merged > 0) {
+              finalCart = merge.data.cart;
             }
-            finalCart = updatedCart;
           }
         } catch (e) {
           console.error("Failed to sync cart from backend", e);
         }
       } else {
-        // Guest mode: Refresh prices for local items
+        // Guest mode: the server prices the lines on every read
         try {
-          const savedCart = localStorage.getItem(userKey);
-          let localItems = savedCart ? JSON.parse(savedCart) : [];
-
-          if (localItems.length > 0) {
-            const productIds = localItems.map(item => item.id);
-            const priceRes = await axios.post(`${API}/products/refresh-prices`, productIds);
-            const updatedPrices = priceRes.data;
-
-            localItems = localItems.map(item => ({
-              ...item,
-              price: updatedPrices[item.id] !== undefined ? updatedPrices[item.id] : item.price
-            }));
-          }
-          finalCart = localItems;
+          const response = await axios.get(`${API}/guest/cart`, { headers: guestHeaders() });
+          finalCart = response.data.items || [];
         } catch (e) {
-          console.error("Failed to refresh guest cart prices", e);
+          console.error("Failed to load guest cart", e);
           finalCart = [];
         }
       }
@@ -476,9 +494,9 @@ const CartProvider = ({ children }) => {
     fetchCart();
   }, [user?.id, userKey]);
 
-  // Save cart to local storage always
+  // Keep a local copy of signed-in carts
   useEffect(() => {
-    if (cartItems.length > 0 || localStorage.getItem(userKey)) {
+    if (userKey && (cartItems.length > 0 || localStorage.getItem(userKey))) {
       localStorage.setItem(userKey, JSON.stringify(cartItems));
     }
   }, [cartItems, userKey]);
@@ -506,31 +524,19 @@ const CartProvider = ({ children }) => {
       }
     });
 
-    // 2. Backend Sync if logged in
-    if (user?.id) {
-      try {
+    // 2. Backend Sync
+    try {
+      if (user?.id) {
         const token = localStorage.getItem('token');
-        // Construct the item payload exactly as expected by backend model
-        const itemPayload = {
-          id: product.id,
-          name: product.name,
-          price: product.price,
-          quantity: product.quantity || 1,
-          image: product.image || (product.images && product.images[0]) || "",
-          vendor_id: product.vendor_id,
-          category: product.category,
-          delivery_type: product.delivery_type,
-          delivery_charge: product.delivery_charge,
-          free_delivery_above: product.free_delivery_above,
-          selected: true
-        };
-        await axios.post(`${API}/users/cart/items`, itemPayload, {
+        await axios.post(`${API}/users/cart/items`, cartItemPayload(product), {
           headers: { Authorization: `Bearer ${token}` }
         });
-      } catch (e) {
-        console.error("Failed to add to cart backend", e);
-        // Optionally revert state here if strict consistency needed
+      } else {
+        await axios.post(`${API}/guest/cart/items`, cartItemPayload(product), { headers: guestHeaders() });
       }
+    } catch (e) {
+      console.error("Failed to add to cart backend", e);
+      // Optionally revert state here if strict consistency needed
     }
   };
 
@@ -546,6 +552,12 @@ const CartProvider = ({ children }) => {
       } catch (e) {
         console.error("Failed to remove from cart backend", e);
       }
+    } else {
+      try {
+        await axios.delete(`${API}/guest/cart/items/${id}`, { headers: guestHeaders() });
+      } catch (e) {
+        console.error("Failed to remove from guest cart", e);
+      }
     }
   };
 
@@ -582,7 +594,13 @@ const CartProvider = ({ children }) => {
     // if we don't want to make a new "set quantity" endpoint.
     // Lets use the existing Bulk PUT for quantity updates to be safe, but explicitly triggered, not effect based.
 
-    if (user?.id) {
+    if (!user?.id) {
+      try {
+        await axios.put(`${API}/guest/cart/items/${id}`, { quantity }, { headers: guestHeaders() });
+      } catch (e) {
+        console.error("Failed to update guest cart quantity", e);
+      }
+    } else {
       // Create a small debounce or just fire and forget (eventual consistency)
       // We'll use a timeout ref in a real app, but here:
       setTimeout(async () => {
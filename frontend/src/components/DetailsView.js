@@ -155,7 +155,7 @@ const DetailsView = () => {
                     images: p.images && p.images.length > 0 ? [p.image, ...p.images] : [p.image],
                     category: p.category,
                     rating: p.rating || 0,
-                    reviewsCount: p.reviews ? p.reviews.length : 0,
+                    reviewsCount: p.reviews_count ?? (p.reviews ? p.reviews.length : 0),
                     stock: p.stock,
                     brand: p.brand || "Generic",
                     offers: p.offers || "",
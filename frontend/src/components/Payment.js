@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import { useNavigate, Link, useLocation } from 'react-router-dom';
 import axios from 'axios';
 import { Button } from "@/components/ui/button";
@@ -42,6 +42,8 @@ const Payment = () => {
     const [orderComplete, setOrderComplete] = useState(false);
     const [paymentMethod, setPaymentMethod] = useState('card');
     const [appliedCoupon, setAppliedCoupon] = useState(location.state?.appliedCoupon || null);
+    // One key per order attempt so a retried or double-submitted checkout is placed once
+    const idempotencyKey = useRef(null);
 
     const [address, setAddress] = useState({
         email: user?.email || '',
@@ -155,12 +157,22 @@ const Payment = () => {
                 discount_amount: discount
             };
 
+            if (!idempotencyKey.current) {
+                idempotencyKey.current = window.crypto?.randomUUID?.() || `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+            }
             const response = await axios.post(`${API_BASE}/api/orders/checkout`, orderPayload, {
-                headers: { Authorization: `Bearer ${localStorage.getItem('token')}` }
+                headers: {
+                    Authorization: `Bearer ${localStorage.getItem('token')}`,
+                    'Idempotency-Key': idempotencyKey.current
+                }
             });
+            idempotencyKey.current = null;
 
             addOrder({
                 ...orderPayload,
+                // The server prices the order; show what was actually charged
+                total_amount: response.data.total_amount ?? orderPayload.total_amount,
+                discount_amount: response.data.discount_amount ?? orderPayload.discount_amount,
                 id: response.data.order_id,
                 date: new Date().toLocaleDateString('en-IN'),
                 status: 'Confirmed'
@@ -169,6 +181,8 @@ const Payment = () => {
             setIsProcessing(false);
             setOrderComplete(true);
         } catch (e) {
+            // Keep the key when the outcome is unknown (no response) so a retry replays it
+            if (e.response) idempotencyKey.current = null;
             alert("Order Failed");
             setIsProcessing(false);
         }